@@ -0,0 +1,54 @@
+"""
+Benchmark the bulk forcing csv encoder against building a DataFrame and
+calling to_csv for every catchment, as write_data_df used to.
+
+python benchmarks/bench_csv.py --ncatchments 20000 --ntimes 24
+"""
+
+import argparse
+import time
+from datetime import datetime, timedelta
+from io import BytesIO
+import numpy as np
+import pandas as pd
+from forcingprocessor.utils import ngen_variables
+from forcingprocessor.write_tools import ForcingCSVEncoder
+
+
+def encode_dataframes(data, t_ax):
+    out = []
+    for j in range(data.shape[2]):
+        df = pd.DataFrame(data[:, :, j], columns=ngen_variables)
+        df.insert(0, "time", t_ax)
+        buf = BytesIO()
+        df.to_csv(buf, index=False)
+        out.append(buf.getvalue())
+    return out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ncatchments", type=int, default=20000)
+    parser.add_argument("--ntimes", type=int, default=24)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    data = rng.random((args.ntimes, len(ngen_variables), args.ncatchments)) * 300
+    t0 = datetime(2024, 1, 1)
+    t_ax = [
+        datetime.strftime(t0 + timedelta(hours=x), "%Y-%m-%d %H:%M:%S")
+        for x in range(args.ntimes)
+    ]
+
+    t0 = time.perf_counter()
+    ref = encode_dataframes(data, t_ax)
+    t_df = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    out = list(ForcingCSVEncoder(t_ax, ngen_variables).encode(data))
+    t_enc = time.perf_counter() - t0
+
+    print(f"DataFrame.to_csv : {t_df:.3f} s ({args.ncatchments / t_df:.0f} files/s)")
+    print(f"bulk encoder     : {t_enc:.3f} s ({args.ncatchments / t_enc:.0f} files/s)")
+    print(f"speedup          : {t_df / t_enc:.1f}x")
+    print(f"identical output : {out == ref}")
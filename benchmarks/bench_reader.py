@@ -0,0 +1,72 @@
+"""
+Benchmark reading the window of the forcing variables out of NWM files with
+h5py hyperslabs against xarray, as forcing_grid2catchment does with
+nwm_reader set to h5py and xarray.
+
+python benchmarks/bench_reader.py nwm.t00z.short_range.forcing.f001.conus.nc ... --window 0 4607 0 3839
+"""
+
+import argparse
+import time
+import numpy as np
+import xarray as xr
+from forcingprocessor.io_tools import read_nwm_window
+from forcingprocessor.utils import ngen_variables, variable_plan
+
+
+def read_xarray(nwm_file, variables, window, out):
+    x_min, x_max, y_min, y_max = window
+    with xr.open_dataset(nwm_file) as nwm_data:
+        shp = nwm_data["U2D"].shape
+        for j, jvar in enumerate(variables):
+            out[j] = np.flip(
+                np.squeeze(
+                    nwm_data[jvar]
+                    .isel(
+                        x=slice(x_min, x_max + 1),
+                        y=slice(shp[1] - (y_max + 1), shp[1] - y_min),
+                    )
+                    .values
+                ),
+                axis=0,
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("nwm_files", nargs="+", help="local NetCDF4 NWM forcing files")
+    parser.add_argument(
+        "--window",
+        type=int,
+        nargs=4,
+        default=[0, 4607, 0, 3839],
+        metavar=("X_MIN", "X_MAX", "Y_MIN", "Y_MAX"),
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    source_vars, _, _ = variable_plan(ngen_variables)
+    x_min, x_max, y_min, y_max = args.window
+    shape = (len(source_vars), y_max - y_min + 1, x_max - x_min + 1)
+    ref = np.zeros(shape)
+    out = np.zeros(shape)
+
+    t_xr = 0
+    t_h5 = 0
+    identical = True
+    for _ in range(args.repeat):
+        for nwm_file in args.nwm_files:
+            t0 = time.perf_counter()
+            read_xarray(nwm_file, source_vars, args.window, ref)
+            t_xr += time.perf_counter() - t0
+
+            t0 = time.perf_counter()
+            read_nwm_window(nwm_file, source_vars, args.window, out)
+            t_h5 += time.perf_counter() - t0
+            identical &= np.array_equal(ref, out, equal_nan=True)
+
+    nreads = args.repeat * len(args.nwm_files)
+    print(f"xarray  : {t_xr / nreads:.3f} s per file")
+    print(f"h5py    : {t_h5 / nreads:.3f} s per file")
+    print(f"speedup : {t_xr / t_h5:.1f}x")
+    print(f"identical output : {identical}")
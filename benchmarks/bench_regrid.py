@@ -0,0 +1,100 @@
+"""
+Benchmark the sparse regridding operator against the per-catchment loop that
+forcing_grid2catchment used previously.
+
+python benchmarks/bench_regrid.py --ncatchments 100000 --nfiles 3
+"""
+
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from forcingprocessor.regrid_tools import WeightsOperator, NX, NY
+from forcingprocessor.utils import nwm_variables
+
+
+def make_weights_df(ncatchments, window, seed=0):
+    x_min, x_max, y_min, y_max = window
+    rng = np.random.default_rng(seed)
+    cell_ids = []
+    coverages = []
+    for _ in range(ncatchments):
+        n = int(rng.integers(1, 40))
+        cx = rng.integers(x_min, x_max - 8)
+        cy = rng.integers(y_min, y_max - 8)
+        xs = cx + rng.integers(0, 8, n)
+        ys = cy + rng.integers(0, 8, n)
+        cell_ids.append([int(x) for x in np.unique(xs + ys * NX)])
+        coverages.append(list(rng.random(len(cell_ids[-1]))))
+    return pd.DataFrame(
+        {"cell_id": cell_ids, "coverage": coverages},
+        index=[f"cat-{x}" for x in range(ncatchments)],
+    )
+
+
+def regrid_loop(weights_df, data_allvars, window):
+    x_min, x_max, y_min, y_max = window
+    dx = x_max - x_min + 1
+    dy = y_max - y_min + 1
+    nvar = data_allvars.shape[0]
+    data_allvars = data_allvars.reshape(nvar, dx * dy)
+    data_array = np.zeros((nvar, len(weights_df)), dtype=np.float64)
+    jcatch = 0
+    for row in weights_df.itertuples():
+        weights = row.cell_id
+        coverage = np.array(row.coverage)
+        coverage_mat = np.repeat(coverage[None, :], nvar, axis=0)
+        weights_dx, weights_dy = np.unravel_index(weights, (NX, NY), order="F")
+        weights_dx_shifted = list(weights_dx - x_min)
+        weights_dy_shifted = list(weights_dy - y_min)
+        weights_window = np.ravel_multi_index(
+            np.array([weights_dx_shifted, weights_dy_shifted]), (dx, dy), order="F"
+        )
+        jcatch_data_mask = data_allvars[:, weights_window]
+        weight_sum = np.sum(coverage)
+        data_array[:, jcatch] = (
+            np.sum(coverage_mat * jcatch_data_mask, axis=1) / weight_sum
+        )
+        jcatch += 1
+    return data_array
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ncatchments", type=int, default=50000)
+    parser.add_argument("--nfiles", type=int, default=3)
+    parser.add_argument("--window", type=int, nargs=4, default=[1000, 2000, 1000, 2000])
+    args = parser.parse_args()
+
+    window = tuple(args.window)
+    dx = window[1] - window[0] + 1
+    dy = window[3] - window[2] + 1
+    nvar = len(nwm_variables)
+    print(f"Building {args.ncatchments} synthetic catchment weights", flush=True)
+    weights_df = make_weights_df(args.ncatchments, window)
+    rng = np.random.default_rng(1)
+    grids = [rng.random((nvar, dy, dx)) * 300 for _ in range(args.nfiles)]
+
+    t0 = time.perf_counter()
+    op = WeightsOperator.from_weights_df(weights_df, window)
+    t_build = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    ref = [regrid_loop(weights_df, x, window) for x in grids]
+    t_loop = (time.perf_counter() - t0) / args.nfiles
+
+    t0 = time.perf_counter()
+    out = [op.apply(x) for x in grids]
+    t_op = (time.perf_counter() - t0) / args.nfiles
+
+    max_rel = max(
+        float(np.max(np.abs(a - b) / np.maximum(np.abs(b), 1e-300)))
+        for a, b in zip(out, ref)
+    )
+    identical = np.mean([np.mean(a == b) for a, b in zip(out, ref)])
+    print(f"operator build          : {t_build:.3f} s (once per run)")
+    print(f"per-catchment loop      : {t_loop:.3f} s/file")
+    print(f"sparse operator         : {t_op:.4f} s/file")
+    print(f"speedup                 : {t_loop / t_op:.1f}x")
+    print(f"max relative difference : {max_rel:.2e}")
+    print(f"bit identical values    : {100 * identical:.1f}%")
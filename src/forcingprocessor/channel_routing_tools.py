@@ -3,12 +3,10 @@ t-route. Translates between NWM and NGEN IDs!"""
 
 import itertools
 import os
-from io import BytesIO
 import time
 from datetime import datetime
 from pathlib import Path
 import gcsfs
-import requests
 import xarray as xr
 import numpy as np
 import pandas as pd
@@ -16,6 +14,7 @@ import boto3
 import traceback
 import tempfile
 from forcingprocessor.utils import convert_url2key, report_usage, make_forcing_netcdf
+from forcingprocessor.io_tools import fetch_nwm_file, format_http_stats
 
 B2MB = 1048576
 
@@ -26,6 +25,8 @@ def channelrouting_nwm2ngen(
     fs_type_arg: str,
     fs_arg=None,
     ii_verbose_arg: bool = False,
+    range_reads_arg: bool = False,
+    cache_arg=None,
 ):
     """
     Retrieve catchment level data from national water model files
@@ -36,11 +37,14 @@ def channelrouting_nwm2ngen(
     mapping_arg (dict): dictionary of NWM to NGEN ID maps
     fs_type_arg (str): type of file system
     ii_verbose_arg (bool): verbosity
+    range_reads_arg (bool): read urls with HTTP range requests instead of downloading them whole
+    cache_arg (NWMFileCache): optional disk cache of remote files
 
-    Outputs: [data_list, t_list, nwm_file_sizes_MB]
+    Outputs: [data_list, t_list, nwm_file_sizes_MB, cache_counts]
     data_list (list): list of ngen forcings ordered in time.
     t_list (list): list of model output times
     nwm_file_sizes_MB (list): list of file sizes of input CHRTOUT data
+    cache_counts (tuple): hits and misses of cache_arg
     """
     topen = 0
     txrds = 0
@@ -60,24 +64,11 @@ def channelrouting_nwm2ngen(
     nwm_file_sizes_MB = []
     for j, nwm_file in enumerate(nwm_files):
         t0 = time.perf_counter()
-        if fs_arg:
-            if nwm_file.find("https://") >= 0:
-                _, bucket_key = convert_url2key(nwm_file, fs_type_arg)
-            else:
-                bucket_key = nwm_file
-            file_obj = fs_arg.open(bucket_key, mode="rb")
-            nwm_file_sizes_MB.append(file_obj.details["size"])
-        elif "https://" in nwm_file:
-            response = requests.get(nwm_file, timeout=10)
-
-            if response.status_code == 200:
-                file_obj = BytesIO(response.content)
-            else:
-                raise RuntimeError(f"{nwm_file} does not exist")
-            nwm_file_sizes_MB.append(len(response.content) / B2MB)
-        else:
-            file_obj = nwm_file
-            nwm_file_sizes_MB.append(os.path.getsize(nwm_file / B2MB))
+        # with range reads xarray only fetches the lateral flow variables
+        file_obj, file_size, _ = fetch_nwm_file(
+            nwm_file, fs_arg, fs_type_arg, range_reads=range_reads_arg, cache=cache_arg
+        )
+        nwm_file_sizes_MB.append(file_size)
 
         topen += time.perf_counter() - t0
         t0 = time.perf_counter()
@@ -153,11 +144,15 @@ def channelrouting_nwm2ngen(
         report_usage()
 
     if ii_verbose_arg:
+        http_summary = format_http_stats()
+        if http_summary:
+            print(f"Process #{pid} HTTP connections\n{http_summary}", flush=True)
         print(
             f"Process #{pid} completed data extraction, returning data to primary process",
             flush=True,
         )
-    return [data_list, t_list, nwm_file_sizes_MB]
+    cache_counts = (cache_arg.hits, cache_arg.misses) if cache_arg else (0, 0)
+    return [data_list, t_list, nwm_file_sizes_MB, cache_counts]
 
 
 def write_netcdf_chrt(
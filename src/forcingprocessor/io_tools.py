@@ -0,0 +1,765 @@
+"""Tools to fetch NWM input files and overlap those reads with compute."""
+
+import base64
+import hashlib
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import deque
+from io import BytesIO
+import io
+import concurrent.futures as cf
+from urllib.parse import urlsplit
+import h5py
+import numpy as np
+import requests
+from forcingprocessor.utils import convert_url2key
+
+B2MB = 1048576
+NWM_READERS = ("xarray", "h5py")
+HDF5_SIGNATURE = b"\x89HDF\r\n\x1a\n"
+# granularity of the ranged GETs and the cache of HTTPRangeFile
+RANGE_BLOCK_SIZE = 1 << 18
+# settings of the per process HTTP session, see configure_http
+HTTP_CONFIG = {"pool_size": 16, "timeout": 60, "retries": 4, "backoff": 0.5}
+HTTP_RETRY_STATUS = (429, 500, 502, 503, 504)
+# seconds after which NWMFileCache.evict removes a leftover temporary file
+CACHE_PART_MAX_AGE = 3600
+
+_http_session = None
+_http_session_pid = None
+_http_stats = {}
+_http_lock = threading.Lock()
+
+
+class HTTPValidationError(IOError):
+    """A response body that does not match its Content-Length or checksum"""
+
+
+def configure_http(pool_size: int = None, timeout: float = None, retries: int = None, backoff: float = None):
+    """
+    Set up the HTTP session used by http_get. Processes forked afterwards
+    inherit the settings and open their own session on first use.
+
+    Parameters:
+        pool_size (int): connections kept alive per host
+        timeout (float): connect and read timeout in seconds
+        retries (int): retries of a failed request
+        backoff (float): base of the jittered exponential backoff between retries, in seconds
+    """
+    global _http_session
+    for key, value in dict(
+        pool_size=pool_size, timeout=timeout, retries=retries, backoff=backoff
+    ).items():
+        if value is not None:
+            HTTP_CONFIG[key] = value
+    _http_session = None
+
+
+def http_session() -> requests.Session:
+    """This process's keep-alive session, created on first use"""
+    global _http_session, _http_session_pid
+    with _http_lock:
+        if _http_session is None or _http_session_pid != os.getpid():
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=HTTP_CONFIG["pool_size"],
+                pool_maxsize=HTTP_CONFIG["pool_size"],
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _http_session = session
+            _http_session_pid = os.getpid()
+            _http_stats.clear()
+        return _http_session
+
+
+def _validate(response: requests.Response):
+    """Raise HTTPValidationError if the body is shorter or other than the headers say"""
+    headers = response.headers
+    content = response.content
+    if "Content-Length" in headers and "Content-Encoding" not in headers:
+        if len(content) != int(headers["Content-Length"]):
+            raise HTTPValidationError(
+                f"{response.url} sent {len(content)} of {headers['Content-Length']} bytes"
+            )
+    if response.status_code != 200:
+        # checksums cover the whole object, not a range of it
+        return
+    md5 = headers.get("Content-MD5")
+    for jhash in headers.get("x-goog-hash", "").split(","):
+        if jhash.strip().startswith("md5="):
+            md5 = jhash.strip()[4:]
+    if md5 and base64.b64encode(hashlib.md5(content).digest()).decode() != md5:
+        raise HTTPValidationError(f"{response.url} failed its md5 checksum")
+
+
+def http_get(url: str, headers: dict = None) -> requests.Response:
+    """
+    GET url with the pooled session of this process.
+
+    Connection errors, timeouts, 429 and 5xx responses and bodies that fail
+    validation (Content-Length, or the Content-MD5 / x-goog-hash md5 of a whole
+    object) are retried up to HTTP_CONFIG["retries"] times, sleeping a random
+    time up to backoff * 2**attempt between tries. Other responses, 404
+    included, are returned for the caller to check.
+    """
+    return _http_request("GET", url, headers)
+
+
+def http_head(url: str) -> requests.Response:
+    """HEAD url with the pooled session of this process, retried like http_get"""
+    return _http_request("HEAD", url)
+
+
+def _http_request(method: str, url: str, headers: dict = None) -> requests.Response:
+    session = http_session()
+    host = urlsplit(url).netloc
+    t0 = time.perf_counter()
+    attempt = 0
+    while True:
+        try:
+            response = session.request(
+                method, url, headers=headers, timeout=HTTP_CONFIG["timeout"]
+            )
+            if method == "GET" and response.status_code not in HTTP_RETRY_STATUS:
+                _validate(response)
+            error = None
+        except (requests.ConnectionError, requests.Timeout, HTTPValidationError) as e:
+            response = None
+            error = e
+        retry = error is not None or response.status_code in HTTP_RETRY_STATUS
+        if not retry or attempt >= HTTP_CONFIG["retries"]:
+            break
+        attempt += 1
+        time.sleep(random.uniform(0, HTTP_CONFIG["backoff"] * 2**attempt))
+
+    with _http_lock:
+        stats = _http_stats.setdefault(
+            host, {"requests": 0, "retries": 0, "failures": 0, "bytes": 0, "seconds": 0.0}
+        )
+        stats["requests"] += 1
+        stats["retries"] += attempt
+        stats["failures"] += retry
+        stats["bytes"] += len(response.content) if response is not None else 0
+        stats["seconds"] += time.perf_counter() - t0
+    if error is not None:
+        raise error
+    return response
+
+
+def http_stats() -> dict:
+    """
+    Per host counts of this process's requests: requests, retries, failures
+    (requests still failing after the retries), bytes, seconds and the new
+    connections opened, the rest reused a kept-alive one.
+    """
+    connections = {}
+    if _http_session is not None and _http_session_pid == os.getpid():
+        for adapter in set(_http_session.adapters.values()):
+            for key in adapter.poolmanager.pools.keys():
+                pool = adapter.poolmanager.pools[key]
+                host = pool.host if pool.port in (None, 80, 443) else f"{pool.host}:{pool.port}"
+                connections[host] = connections.get(host, 0) + pool.num_connections
+    with _http_lock:
+        return {
+            host: dict(stats, connections=connections.get(host, 0))
+            for host, stats in _http_stats.items()
+        }
+
+
+def format_http_stats() -> str:
+    """http_stats as lines for the verbose output, empty without requests"""
+    lines = []
+    for host, stats in http_stats().items():
+        lines.append(
+            f"{host}: {stats['requests']} requests over {stats['connections']} connections, "
+            f"{stats['retries']} retries, {stats['failures']} failed, "
+            f"{stats['bytes'] / B2MB:.1f} MB in {stats['seconds']:.2f} s"
+        )
+    return "\n".join(lines)
+
+
+def fetch_nwm_file(
+    nwm_file: str,
+    fs=None,
+    fs_type: str = None,
+    in_memory=False,
+    range_reads=False,
+    variables: list = None,
+    window: tuple = None,
+    cache=None,
+):
+    """
+    Open an NWM file from cloud storage, a url or local disk.
+
+    Parameters:
+        nwm_file (str): url, bucket key or local path
+        fs (filesystem): optional file system for cloud storage reads
+        fs_type (str): type of file system, s3 or google
+        in_memory (bool): read cloud storage objects fully instead of returning a lazy handle
+        range_reads (bool): open urls as an HTTPRangeFile instead of downloading them
+        variables (list): with range_reads and window, the variables whose chunks
+            covering the window are fetched up front
+        window (tuple): x_min, x_max, y_min, y_max of the window on the NWM grid,
+            or a list of them to fetch the chunks of several windows
+        cache (NWMFileCache): disk cache for whole remote files. A hit is
+            returned as a local path, a miss is downloaded whole and stored.
+            Range reads bypass it.
+
+    Returns:
+        file_obj: file-like object or local path, ready for xr.open_dataset
+        file_size: size of the file as reported for the metadata
+        nbytes (int): bytes held in memory by file_obj
+    """
+    if fs:
+        if nwm_file.find("https://") >= 0:
+            _, bucket_key = convert_url2key(nwm_file, fs_type)
+        else:
+            bucket_key = nwm_file
+        if cache:
+            key = cache.key(nwm_file, nwm_file_version(nwm_file, fs, fs_type))
+            cached = cache.get(key)
+            if cached:
+                return cached, os.path.getsize(cached), 0
+        file_obj = fs.open(bucket_key, mode="rb")
+        if in_memory or cache:
+            with file_obj:
+                file_obj = BytesIO(file_obj.read())
+            nbytes = file_obj.getbuffer().nbytes
+            if cache:
+                cache.put(key, file_obj.getbuffer())
+            return file_obj, nbytes, nbytes
+        return file_obj, file_obj.details["size"], 0
+    elif range_reads and ("https://" in nwm_file or "http://" in nwm_file):
+        file_obj = HTTPRangeFile(nwm_file)
+        if window is not None and is_hdf5(file_obj):
+            ranges = []
+            for jwindow in window if isinstance(window, list) else [window]:
+                ranges += nwm_chunk_ranges(file_obj, variables, jwindow)
+            file_obj.fetch_ranges(ranges)
+        return file_obj, file_obj.size / B2MB, file_obj.nbytes
+    elif "https://" in nwm_file or "http://" in nwm_file:
+        key = None
+        if cache:
+            version = nwm_file_version(nwm_file)
+            if version:
+                key = cache.key(nwm_file, version)
+                cached = cache.get(key)
+                if cached:
+                    return cached, os.path.getsize(cached) / B2MB, 0
+        response = http_get(nwm_file)
+
+        if response.status_code == 200:
+            file_obj = BytesIO(response.content)
+        else:
+            raise Exception(f"{nwm_file} does not exist")
+        if key:
+            cache.put(key, response.content)
+        return file_obj, len(response.content) / B2MB, len(response.content)
+    else:
+        return nwm_file, os.path.getsize(nwm_file) / B2MB, 0
+
+
+def nwm_file_version(nwm_file: str, fs=None, fs_type: str = None):
+    """
+    Version of an NWM file for cache keys, without reading it: the ETag (or
+    size) of a cloud object or url, the size and modification time of a local
+    file. None when a server reports neither.
+    """
+    if fs:
+        if nwm_file.find("https://") >= 0:
+            _, bucket_key = convert_url2key(nwm_file, fs_type)
+        else:
+            bucket_key = nwm_file
+        info = fs.info(bucket_key)
+        return str(info.get("ETag") or info.get("etag") or info.get("md5Hash") or info["size"])
+    if "https://" in nwm_file or "http://" in nwm_file:
+        headers = http_head(nwm_file).headers
+        return headers.get("ETag") or headers.get("Content-Length")
+    stat = os.stat(nwm_file)
+    return f"{stat.st_size}/{stat.st_mtime_ns}"
+
+
+def remote_version(uri: str):
+    """
+    Version of a remote object (url, s3:// or gs:// uri) for cache keys,
+    without reading it: its ETag, else its last modification time. None when
+    the store reports neither.
+    """
+    if "https://" in uri or "http://" in uri:
+        response = http_head(uri)
+        if response.status_code != 200:
+            return None
+        return response.headers.get("ETag") or response.headers.get("Last-Modified")
+    import fsspec
+
+    options = {"anon": True} if uri.startswith("s3://") else {}
+    fs, path = fsspec.core.url_to_fs(uri, **options)
+    info = fs.info(path)
+    for field in ("ETag", "etag", "md5Hash", "LastModified", "updated", "mtime"):
+        if info.get(field):
+            return str(info[field])
+    return None
+
+
+def nwm_grid_shape(nwm_file: str, fs=None, fs_type: str = None, variable: str = "U2D") -> tuple:
+    """
+    Shape of the NWM grid of a forcing file, read from the file's header
+    without reading any data. Urls are opened with ranged reads.
+
+    Returns:
+        nx, ny: number of cells in the west_east and south_north directions
+    """
+    if fs:
+        if nwm_file.find("https://") >= 0:
+            _, bucket_key = convert_url2key(nwm_file, fs_type)
+        else:
+            bucket_key = nwm_file
+        file_obj = fs.open(bucket_key, mode="rb")
+    elif "https://" in nwm_file or "http://" in nwm_file:
+        file_obj = HTTPRangeFile(nwm_file)
+    else:
+        file_obj = open(nwm_file, "rb")
+    with file_obj:
+        if is_hdf5(file_obj):
+            with h5py.File(file_obj, "r") as f:
+                shape = f[variable].shape
+        else:
+            import xarray as xr
+
+            with xr.open_dataset(file_obj) as ds:
+                shape = ds[variable].shape
+    return shape[-1], shape[-2]
+
+
+def prefetch(items: list, fetch, depth: int = 2, max_bytes: int = 0):
+    """
+    Yield fetch(item) for each item in order, fetching up to `depth` items
+    ahead in background threads while the caller works on the current one.
+
+    fetch must return a tuple whose last element is the number of bytes the
+    result holds in memory. New fetches are not started while the bytes held
+    by finished-but-unconsumed results plus the running average file size
+    for each pending fetch would exceed max_bytes (0 for no limit). At least
+    one fetch is always in flight, so a single file larger than the budget
+    still gets through.
+
+    Yields:
+        (result, fetch_time, wait_time): fetch's result, the seconds the
+        fetch took in its thread and the seconds the caller blocked on it
+    """
+    if depth <= 0:
+        for item in items:
+            t0 = time.perf_counter()
+            result = fetch(item)
+            dt = time.perf_counter() - t0
+            yield result, dt, dt
+        return
+
+    def timed_fetch(item):
+        t0 = time.perf_counter()
+        result = fetch(item)
+        return result, time.perf_counter() - t0
+
+    pending = deque()
+    nfetched = 0
+    bytes_fetched = 0
+    items = iter(items)
+    exhausted = False
+    with cf.ThreadPoolExecutor(max_workers=depth) as pool:
+        while True:
+            while not exhausted and len(pending) < depth:
+                if pending and max_bytes > 0:
+                    avg_bytes = bytes_fetched / nfetched if nfetched else 0
+                    held = sum(
+                        x.result()[0][-1] if x.done() else avg_bytes for x in pending
+                    )
+                    if held + avg_bytes > max_bytes:
+                        break
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending.append(pool.submit(timed_fetch, item))
+            if not pending:
+                return
+            t0 = time.perf_counter()
+            result, fetch_time = pending.popleft().result()
+            wait_time = time.perf_counter() - t0
+            nfetched += 1
+            bytes_fetched += result[-1]
+            yield result, fetch_time, wait_time
+
+
+def is_hdf5(file_obj) -> bool:
+    """
+    True if file_obj (a local path or a seekable binary file object) starts
+    with the HDF5 signature, as NetCDF4 files do. The position of a file
+    object is left unchanged.
+    """
+    if isinstance(file_obj, (str, os.PathLike)):
+        with open(file_obj, "rb") as f:
+            return f.read(8) == HDF5_SIGNATURE
+    pos = file_obj.tell()
+    try:
+        file_obj.seek(0)
+        return file_obj.read(8) == HDF5_SIGNATURE
+    finally:
+        file_obj.seek(pos)
+
+
+def _attr(value):
+    """Plain python or numpy scalar of an h5py attribute"""
+    value = np.asarray(value).reshape(-1)[0]
+    if isinstance(value, bytes):
+        return value.decode()
+    return value
+
+
+def _unpacked_dtype(dtype: np.dtype, scale_factor, add_offset) -> np.dtype:
+    """Float type xarray decodes packed data to, so both readers agree"""
+    if scale_factor is not None and add_offset is not None:
+        scale_type = np.asarray(scale_factor).dtype
+        if scale_type == np.asarray(add_offset).dtype and scale_type.kind == "f":
+            if dtype.kind in "iu" and dtype.itemsize >= 4:
+                return np.dtype(np.float64)
+            return scale_type
+    if add_offset is not None:
+        return np.dtype(np.float64)
+    return np.asarray(scale_factor).dtype
+
+
+def read_nwm_window(file_obj, variables: list, window: tuple, out: np.ndarray) -> dict:
+    """
+    Read the window of each variable of a NetCDF4 NWM forcing file with h5py,
+    without building an xarray dataset.
+
+    Only the hyperslab of the window is read, from the first time step, and
+    written to out flipped south to north, exactly like
+    ``np.flip(ds[var].isel(...).values, axis=0)`` on a CF decoded dataset:
+    fill values become NaN and packed variables are scaled and offset.
+
+    Parameters:
+        file_obj: local path or binary file object of the NWM file
+        variables (list): NWM variables to read, in out order
+        window (tuple): x_min, x_max, y_min, y_max of the window on the NWM grid
+        out (np.ndarray): (nvar, dy, dx) float buffer to read into
+
+    Returns:
+        attrs (dict): global attributes of the file, plus "dims", the names of
+        the file's dimensions
+    """
+    return read_nwm_windows(file_obj, variables, [window], [out])
+
+
+def read_nwm_windows(file_obj, variables: list, windows: list, outs: list) -> dict:
+    """
+    read_nwm_window for several windows of the same file, opened once.
+
+    Parameters:
+        windows (list): x_min, x_max, y_min, y_max of each window
+        outs (list): (nvar, dy, dx) buffer of each window
+    """
+    with h5py.File(file_obj, "r") as f:
+        for jvar, name in enumerate(variables):
+            ds = f[name]
+            ny = ds.shape[-2]
+            fill = [
+                _attr(ds.attrs[x]) for x in ("_FillValue", "missing_value") if x in ds.attrs
+            ]
+            scale_factor = _attr(ds.attrs["scale_factor"]) if "scale_factor" in ds.attrs else None
+            add_offset = _attr(ds.attrs["add_offset"]) if "add_offset" in ds.attrs else None
+            for (x_min, x_max, y_min, y_max), out in zip(windows, outs):
+                # leading (time) dimensions take their first index, as squeeze did
+                sel = (0,) * (ds.ndim - 2) + (
+                    slice(ny - (y_max + 1), ny - y_min),
+                    slice(x_min, x_max + 1),
+                )
+                if scale_factor is None and add_offset is None:
+                    ds.read_direct(out, np.s_[sel], np.s_[jvar])
+                    values = out[jvar]
+                    for jfill in fill:
+                        values[values == jfill] = np.nan
+                else:
+                    raw = ds[sel]
+                    values = raw.astype(_unpacked_dtype(raw.dtype, scale_factor, add_offset))
+                    for jfill in fill:
+                        values[raw == jfill] = np.nan
+                    if scale_factor is not None:
+                        values *= scale_factor
+                    if add_offset is not None:
+                        values += add_offset
+                    out[jvar] = values
+                out[jvar] = out[jvar, ::-1]
+        attrs = {k: _attr(v) for k, v in f.attrs.items()}
+        attrs["dims"] = [k for k, v in f.items() if isinstance(v, h5py.Dataset) and v.is_scale]
+    return attrs
+
+
+class HTTPRangeFile(io.RawIOBase):
+    """
+    Read-only, seekable file object over a url, read with HTTP range requests.
+
+    The file is read in blocks of block_size bytes, each fetched at most once
+    and kept in memory, so h5py or xarray opening it only download the parts
+    of the file they touch. Contiguous missing blocks are fetched with a
+    single GET. A server that ignores Range headers sends the whole file on
+    the first request, which is then served from memory.
+
+    Parameters:
+        url (str): http(s) url of the file
+        block_size (int): bytes per ranged GET and cache block
+    """
+
+    def __init__(self, url: str, block_size: int = RANGE_BLOCK_SIZE):
+        super().__init__()
+        self.url = url
+        self.block_size = block_size
+        self.nrequests = 0
+        self.nbytes = 0
+        self._blocks = {}
+        self._pos = 0
+        self.size = None
+        self._fetch(0, 1)
+
+    def _fetch(self, first: int, last: int):
+        """Fetch blocks first to last, inclusive, with one request"""
+        start = first * self.block_size
+        end = (last + 1) * self.block_size - 1
+        if self.size is not None:
+            end = min(end, self.size - 1)
+        response = http_get(self.url, headers={"Range": f"bytes={start}-{end}"})
+        self.nrequests += 1
+        if response.status_code == 206:
+            if self.size is None:
+                self.size = int(response.headers["Content-Range"].split("/")[-1])
+        elif response.status_code == 200:
+            # no range support, keep everything that was sent
+            self.size = len(response.content)
+            start = 0
+            first = 0
+        elif response.status_code == 416 and self.size is None:
+            self.size = 0
+            return
+        else:
+            raise Exception(f"{self.url} does not exist")
+        content = response.content
+        for jblock in range(len(content) // self.block_size + 1):
+            block = content[jblock * self.block_size : (jblock + 1) * self.block_size]
+            if block and first + jblock not in self._blocks:
+                self._blocks[first + jblock] = block
+                self.nbytes += len(block)
+
+    def fetch_ranges(self, ranges: list):
+        """
+        Fetch the blocks covering a list of (offset, length) byte ranges, a
+        request per run of contiguous missing blocks.
+        """
+        needed = set()
+        for offset, length in ranges:
+            if length > 0:
+                needed.update(
+                    range(offset // self.block_size, (offset + length - 1) // self.block_size + 1)
+                )
+        missing = sorted(needed - self._blocks.keys())
+        while missing:
+            first = last = missing.pop(0)
+            while missing and missing[0] == last + 1:
+                last = missing.pop(0)
+            self._fetch(first, last)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self._pos = max(offset, 0)
+        return self._pos
+
+    def readinto(self, buffer) -> int:
+        view = memoryview(buffer).cast("B")
+        n = max(min(len(view), self.size - self._pos), 0)
+        if n == 0:
+            return 0
+        self.fetch_ranges([(self._pos, n)])
+        filled = 0
+        while filled < n:
+            pos = self._pos + filled
+            block = self._blocks[pos // self.block_size]
+            jstart = pos % self.block_size
+            jbytes = min(len(block) - jstart, n - filled)
+            view[filled : filled + jbytes] = block[jstart : jstart + jbytes]
+            filled += jbytes
+        self._pos += n
+        return n
+
+
+def nwm_chunk_ranges(file_obj, variables: list, window: tuple) -> list:
+    """
+    Byte ranges of the storage of each variable that a window read touches.
+
+    Chunked variables list the chunks intersecting the window, the same
+    hyperslab read_nwm_window reads, contiguous variables their whole
+    storage. Only the file's metadata is read to find them.
+
+    Parameters:
+        file_obj: local path or binary file object of a NetCDF4 NWM file
+        variables (list): NWM variables
+        window (tuple): x_min, x_max, y_min, y_max of the window on the NWM grid
+
+    Returns:
+        list: (offset, length) byte ranges
+    """
+    x_min, x_max, y_min, y_max = window
+    ranges = []
+    with h5py.File(file_obj, "r") as f:
+        for name in variables:
+            ds = f[name]
+            if ds.chunks is None:
+                offset = ds.id.get_offset()
+                if offset is not None:
+                    ranges.append((offset, ds.id.get_storage_size()))
+                continue
+            ny = ds.shape[-2]
+            lead = (0,) * (ds.ndim - 2)
+            cy, cx = ds.chunks[-2:]
+            for jy in range((ny - (y_max + 1)) // cy, (ny - y_min - 1) // cy + 1):
+                for jx in range(x_min // cx, x_max // cx + 1):
+                    info = ds.id.get_chunk_info_by_coord(lead + (jy * cy, jx * cx))
+                    if info.byte_offset is not None:
+                        ranges.append((info.byte_offset, info.size))
+    return ranges
+
+
+class NWMFileCache:
+    """
+    Content addressed disk cache of remote NWM files, shared by the processes
+    of a run and by later runs. With another suffix it caches other per file
+    results, such as regridded forcings.
+
+    Files are stored as ``<cache_dir>/<key><suffix>`` where the key hashes the
+    url with the object's version (see nwm_file_version), so a file replaced
+    upstream is fetched again. Files are written to a
+    temporary name and renamed into place, so concurrent processes never see a
+    partial file. Once the cache holds more than max_bytes the least recently
+    used files, by modification time which hits refresh, are removed.
+
+    Each process keeps a running total of the cache size and scans the
+    directory only when that total is over max_bytes, so the cache can run
+    over the budget by what other processes stored since the last scan.
+
+    Attributes:
+        hits (int): files this process served from the cache
+        misses (int): files this process downloaded and stored
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int, suffix: str = ".nc"):
+        self.cache_dir = str(cache_dir)
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # bytes in the cache as of the last scan plus what was stored since,
+        # None until the first scan
+        self._nbytes = None
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        state["_nbytes"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(url: str, version) -> str:
+        return hashlib.sha256(f"{url}\0{version}".encode()).hexdigest()
+
+    def get(self, key: str):
+        """Path of the cached file, None on a miss"""
+        path = os.path.join(self.cache_dir, f"{key}{self.suffix}")
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def put(self, key: str, data) -> str:
+        """Store data under key and evict down to the byte budget"""
+        path = os.path.join(self.cache_dir, f"{key}{self.suffix}")
+        f = tempfile.NamedTemporaryFile(dir=self.cache_dir, suffix=".part", delete=False)
+        try:
+            with f:
+                f.write(data)
+            os.replace(f.name, path)
+        except BaseException:
+            try:
+                os.remove(f.name)
+            except FileNotFoundError:
+                pass
+            raise
+        with self._lock:
+            if self._nbytes is not None:
+                self._nbytes += memoryview(data).nbytes
+            over = self._nbytes is None or self._nbytes > self.max_bytes
+        if over:
+            self.evict()
+        return path
+
+    def evict(self):
+        """
+        Remove the least recently used files until the cache fits max_bytes,
+        and temporary files older than CACHE_PART_MAX_AGE that failed writes
+        or dead processes left behind.
+        """
+        entries = []
+        total = 0
+        now = time.time()
+        for entry in os.scandir(self.cache_dir):
+            is_part = entry.name.endswith(".part")
+            if not is_part and not entry.name.endswith(self.suffix):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if is_part and now - stat.st_mtime > CACHE_PART_MAX_AGE:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+                continue
+            total += stat.st_size
+            if not is_part:
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # another process evicted it
+            total -= size
+        with self._lock:
+            self._nbytes = total
@@ -1,7 +1,6 @@
 import json
 import pandas as pd
 import argparse, os, json, sys, re
-import requests
 import s3fs
 import gcsfs
 from pathlib import Path
@@ -9,161 +8,271 @@ import numpy as np
 import xarray as xr
 import time
 import boto3
-from io import BytesIO, TextIOWrapper
+from io import BytesIO
 import concurrent.futures as cf
+import multiprocessing as mp
+from multiprocessing import resource_tracker
 from datetime import datetime
-import gzip
-import tarfile, tempfile
+import tarfile, tempfile, shutil
 import s3fs
 import geopandas as gpd
 from forcingprocessor.weights_hf2ds import multiprocess_hf2ds
 from forcingprocessor.plot_forcings import plot_ngen_forcings
 from forcingprocessor.utils import (
     make_forcing_netcdf,
+    append_forcing_netcdf,
     get_window,
+    get_windows,
+    window_cells,
     log_time,
     convert_url2key,
     report_usage,
-    nwm_variables,
     ngen_variables,
+    variable_plan,
     normalize_vpu_id,
+    SharedArray,
+    schedule_jobs,
+    job_blocks,
 )
 from forcingprocessor.channel_routing_tools import (
     channelrouting_nwm2ngen,
     write_netcdf_chrt,
 )
 from forcingprocessor.troute_restart_tools import create_restart, write_netcdf_restart
+from forcingprocessor.io_tools import (
+    fetch_nwm_file,
+    prefetch,
+    is_hdf5,
+    read_nwm_windows,
+    nwm_grid_shape,
+    NWM_READERS,
+    NWMFileCache,
+    nwm_file_version,
+    configure_http,
+    http_get,
+    format_http_stats,
+)
+from forcingprocessor.write_tools import (
+    ForcingCSVEncoder,
+    S3MultipartWriter,
+    open_compressed,
+    compressed_size,
+    COMPRESSION_EXTENSIONS,
+    CountingWriter,
+)
+from forcingprocessor.regrid_tools import (
+    WeightsTable,
+    WeightsOperator,
+    WindowedOperator,
+    weights_cache_key,
+    save_weights_operator,
+    load_weights_operator,
+    load_cached_weights,
+    weights_operator_hash,
+)
 
 
 B2MB = 1048576
 
+# worker processes shared by every stage of a run, see start_worker_pool
+worker_pool = None
+worker_pool_key = None
+worker_state = {}
+pool_stages = 0
+
+# when set (by forcingprocessor.server), prepared weights operators and the
+# worker pool are kept in memory for the next run instead of being rebuilt
+keep_resident = False
+resident_weights = {}
+RESIDENT_WEIGHTS_MAX = 8
+# start method of the worker processes, None for the platform default. The
+# server, which has threads running, sets forkserver, fork is unsafe there
+pool_start_method = None
+
+
+def _init_worker(state: dict):
+    global worker_state
+    worker_state = state
 
-def distribute_work(items, nprocs):
-    """
-    Distribute items evenly between processes, round robin
-    """
-    items_per_proc = [0 for x in range(nprocs)]
-    for j in range(len(items)):
-        k = j % nprocs
-        items_per_proc[k] = items_per_proc[k] + 1
-    return items_per_proc
 
+def _worker_ready() -> int:
+    return os.getpid()
 
-def load_balance(items_per_proc, launch_delay, single_ex, exec_count):
+
+def start_worker_pool(nprocs: int, state: dict):
     """
-    Python takes a couple seconds to launch a process so if this script is launched with 10's
-    of processes, it may not be optimal to distribute the work evenly.
-    This function minimizes projected processing time
+    Start the worker processes every stage of the run schedules its jobs on.
 
-    items_per_proc : list of length number of processes with each element representing the number of items the process has been assigned
-    launch_delay   : time in seconds it takes python to launch the function
-    single_ex      : time in seconds it takes to process 1 item
-    exec_count     : number of items processed per execution
+    The workers are started once, forked with the modules already imported
+    unless pool_start_method says otherwise, and state (the weights operator)
+    is installed in each of them by the pool initializer instead of being
+    pickled into every job.
 
+    Returns:
+        pool (cf.ProcessPoolExecutor): the pool, shut it down at the end of the run
+        startup (float): seconds until every worker was ready
     """
-    nprocs = len(items_per_proc)
-    nitems = np.sum(items_per_proc)
-    completion_time = [
-        single_ex * x / exec_count + launch_delay * j
-        for j, x in enumerate(items_per_proc)
-    ]
-    while True:
-        if len(np.nonzero(items_per_proc)[0]) > 0:
-            break
-        max_time = max(completion_time)
-        max_loc = completion_time.index(max_time)
-        min_time = min(completion_time)
-        min_loc = completion_time.index(min_time)
-        if max_time - min_time > single_ex:
-            items_per_proc[max_loc] -= 1
-            items_per_proc[min_loc] += 1
-        else:
-            break
-        completion_time = [
-            single_ex * x / exec_count + launch_delay * j
-            for j, x in enumerate(items_per_proc)
-        ]
+    t0 = time.perf_counter()
+    # the workers outlive shared arrays created later, start the resource
+    # tracker first so they share the primary's (see SharedArray)
+    resource_tracker.ensure_running()
+    mp_context = None
+    if pool_start_method:
+        mp_context = mp.get_context(pool_start_method)
+        if pool_start_method == "forkserver":
+            mp_context.set_forkserver_preload([__name__])
+    pool = cf.ProcessPoolExecutor(
+        max_workers=max(nprocs, 1),
+        mp_context=mp_context,
+        initializer=_init_worker,
+        initargs=(state,),
+    )
+    cf.wait([pool.submit(_worker_ready) for x in range(max(nprocs, 1))])
+    return pool, time.perf_counter() - t0
+
+
+def shutdown_worker_pool():
+    """Stop the worker pool kept by a resident process"""
+    global worker_pool, worker_pool_key
+    if worker_pool:
+        worker_pool.shutdown()
+    worker_pool = None
+    worker_pool_key = None
+
+
+def run_jobs(func, jobs: list, nprocs: int, label: str, progress=None) -> list:
+    """schedule_jobs on the run's worker pool, or on a pool of its own without one"""
+    global pool_stages
+    if worker_pool:
+        pool_stages += 1
+    return schedule_jobs(
+        func, jobs, nprocs, label, ii_verbose, worker_pool, progress
+    )
 
-    completion_time = [
-        single_ex * x / exec_count + j for j, x in enumerate(items_per_proc)
-    ]
-    global ntasked
-    ntasked = len(np.nonzero(items_per_proc)[0])
-    if nprocs > ntasked:
-        if ii_verbose:
-            print(
-                f"Not enough work for {nprocs} requested processes, downsizing to {ntasked}"
-            )
-        nprocs = ntasked
-        completion_time = completion_time[:ntasked]
-        items_per_proc = items_per_proc[:ntasked]
-    if ii_verbose:
-        print(f"item distribution {items_per_proc}")
-    return items_per_proc
+
+def files_per_job(nfiles: int, nprocs: int) -> int:
+    """
+    Files handed to a worker at a time: enough for its prefetch pipeline to
+    overlap downloads with regridding, few enough that every process gets work.
+    """
+    return max(1, min(job_files or prefetch_depth + 1, -(-nfiles // max(nprocs, 1))))
 
 
-def multiprocess_data_extract(files: list, nprocs: int, weights_df: pd.DataFrame, fs):
+def multiprocess_data_extract(
+    files: list, nprocs: int, weights_op: WeightsOperator, fs
+):
     """
     Sets up the multiprocessing pool for forcing_grid2catchment and returns the data and time axis ordered in time.
 
     Parameters:
         files (list): List of files to be processed.
         nprocs (int): Number of processes to be used.
-        weights_df (dict): DataFrame containing catchment weights.
+        weights_op (WeightsOperator): Sparse regridding operator for the window.
         fs (s3 filesystem): s3fs
 
     Returns:
-        data_array (numpy.ndarray): Concatenated array containing the extracted data.
+        data_array (numpy.ndarray): (time, forcing variable, catchment) array containing the extracted data.
         t_ax_local (list): List of time axes corresponding to the extracted data.
+        nwm_data (numpy.ndarray): NWM data saved for plotting.
+        nwm_file_sizes_out (list): List of file sizes of each input NWM file.
+        data_shared (SharedArray): Shared memory backing data_array, unlink when done with it.
     """
-    launch_time = 0.05
-    cycle_time = 35
-    files_per_cycle = 1
-    files_per_proc = distribute_work(files, nprocs)
-    files_per_proc = load_balance(
-        files_per_proc, launch_time, cycle_time, files_per_cycle
+    nfiles = len(files)
+    # workers write their time steps straight into the shared output array
+    data_shared = SharedArray.create(
+        (nfiles, len(ngen_variables), len(weights_op)),
+        weights_op.dtype,
+        shared_array_dir,
     )
-    nprocs = len(files_per_proc)
+    try:
+        t_ax_local = [None] * nfiles
+        nwm_file_sizes_out = [None] * nfiles
+
+        # files already regridded with this operator are read from the cache,
+        # only the rest are scheduled
+        todo = list(range(nfiles))
+        result_keys = [None] * nfiles
+        if regrid_cache:
+            fs_parent = gcsfs.GCSFileSystem() if fs_type == "google" else fs
+            with cf.ThreadPoolExecutor(max_workers=16) as pool:
+                versions = list(
+                    pool.map(lambda x: nwm_file_version(x, fs_parent, fs_type), files)
+                )
+            todo = []
+            for j, (jfile, jversion) in enumerate(zip(files, versions)):
+                if jversion is None:
+                    todo.append(j)
+                    continue
+                result_keys[j] = regrid_cache.key(jfile, f"{jversion}/{weights_op_hash}")
+                cached = regrid_cache.get(result_keys[j])
+                if cached:
+                    with np.load(cached, allow_pickle=False) as jresult:
+                        data_shared.array[j] = jresult["data"]
+                        t_ax_local[j] = str(jresult["t"])
+                        nwm_file_sizes_out[j] = float(jresult["file_size"])
+                else:
+                    todo.append(j)
+            regrid_cache_counts[0] += nfiles - len(todo)
+            regrid_cache_counts[1] += len(todo)
+            if ii_verbose:
+                print(
+                    f"Regrid cache: {nfiles - len(todo)} of {nfiles} files already regridded",
+                    flush=True,
+                )
 
-    start = 0
-    nfiles = len(files)
-    files_list = []
-    for i in range(nprocs):
-        end = min(start + files_per_proc[i], nfiles)
-        files_list.append(files[start:end])
-        start = end
+        jobs = []
+        job_index = []
+        for start, end in job_blocks(len(todo), files_per_job(len(todo), nprocs)):
+            jindex = todo[start:end]
+            job_index.append(jindex)
+            jobs.append(
+                (
+                    [files[j] for j in jindex],
+                    fs,
+                    ngen_variables,
+                    ngen_vars_plot,
+                    # the pool's workers already hold the operator
+                    None if worker_pool else weights_op,
+                    window,
+                    fs_type,
+                    ii_verbose,
+                    ii_plot,
+                    # only the first nts_plot files of the run are plotted
+                    max(0, min(nts_plot - jindex[0], len(jindex))),
+                    prefetch_depth,
+                    prefetch_MB,
+                    data_shared.spec,
+                    jindex,
+                    nwm_reader,
+                    range_reads,
+                    nwm_cache,
+                    regrid_cache,
+                    [result_keys[j] for j in jindex],
+                )
+            )
 
-    data_ax = []
-    t_ax_local = []
-    nwm_data = []
-    nwm_file_sizes = []
-    with cf.ProcessPoolExecutor(max_workers=nprocs) as pool:
-        for results in pool.map(
-            forcing_grid2catchment,
-            files_list,
-            [fs for x in range(nprocs)],
-            [ngen_variables for x in range(nprocs)],
-            [ngen_vars_plot for x in range(nprocs)],
-            [weights_df for x in range(nprocs)],
-            [window for x in range(nprocs)],
-            [fs_type for x in range(nprocs)],
-            [ii_verbose for x in range(nprocs)],
-            [ii_plot for x in range(nprocs)],
-            [nts_plot for x in range(nprocs)],
+        nwm_data = []
+        for jindex, results in zip(
+            job_index,
+            run_jobs(forcing_grid2catchment, jobs, nprocs, "Extract"),
         ):
-            data_ax.append(results[0])
-            t_ax_local.append(results[1])
-            nwm_data.append(results[2])
-            nwm_file_sizes.append(results[3])
+            for j, t, jsize in zip(jindex, results[1], results[3]):
+                t_ax_local[j] = t
+                nwm_file_sizes_out[j] = jsize
+            if len(results[2]):
+                nwm_data.append(results[2])
+            nwm_cache_counts[0] += results[4][0]
+            nwm_cache_counts[1] += results[4][1]
+    except BaseException:
+        # nothing else holds the array yet, free it before raising
+        data_shared.unlink()
+        raise
 
     print(f"Processes have returned")
-    del weights_df
-    data_array = np.concatenate(data_ax)
-    t_ax_local = [item for sublist in t_ax_local for item in sublist]
-    nwm_file_sizes_out = [item for sublist in nwm_file_sizes for item in sublist]
-    nwm_data = np.concatenate(nwm_data)
+    data_array = data_shared.array
+    nwm_data = np.concatenate(nwm_data) if nwm_data else np.array([])
 
-    return data_array, t_ax_local, nwm_data, nwm_file_sizes_out
+    return data_array, t_ax_local, nwm_data, nwm_file_sizes_out, data_shared
 
 
 def multiprocess_chrt_extract(files: list, num_procs: int, mapping: dict, fs):
@@ -181,38 +290,28 @@ def multiprocess_chrt_extract(files: list, num_procs: int, mapping: dict, fs):
         t_ax_local (list): List of time axes corresponding to the extracted data.
         nwm_file_sizes_out (list): List of file sizes of each input CHRTOUT file.
     """
-    launch_time = 0.05
-    cycle_time = 35
-    files_per_cycle = 1
-    files_per_proc = distribute_work(files, num_procs)
-    files_per_proc = load_balance(
-        files_per_proc, launch_time, cycle_time, files_per_cycle
-    )
-    num_procs = len(files_per_proc)
-
-    start = 0
-    nfiles = len(files)
-    files_list = []
-    for i in range(num_procs):
-        end = min(start + files_per_proc[i], nfiles)
-        files_list.append(files[start:end])
-        start = end
+    jobs = [
+        (
+            files[start:end],
+            mapping,
+            fs_type,
+            fs,
+            ii_verbose,
+            range_reads,
+            nwm_cache,
+        )
+        for start, end in job_blocks(len(files), files_per_job(len(files), num_procs))
+    ]
 
     data_ax = []
     t_ax_local = []
     nwm_file_sizes = []
-    with cf.ProcessPoolExecutor(max_workers=num_procs) as pool:
-        for results in pool.map(
-            channelrouting_nwm2ngen,
-            files_list,
-            [mapping for x in range(num_procs)],
-            [fs_type for x in range(num_procs)],
-            [fs for x in range(num_procs)],
-            [ii_verbose for x in range(num_procs)],
-        ):
-            data_ax.append(results[0])
-            t_ax_local.append(results[1])
-            nwm_file_sizes.append(results[2])
+    for results in run_jobs(channelrouting_nwm2ngen, jobs, num_procs, "Extract"):
+        data_ax.append(results[0])
+        t_ax_local.append(results[1])
+        nwm_file_sizes.append(results[2])
+        nwm_cache_counts[0] += results[3][0]
+        nwm_cache_counts[1] += results[3][1]
 
     print("Processes have returned")
     data_array_temp = np.concatenate(data_ax)
@@ -230,12 +329,21 @@ def forcing_grid2catchment(
     fs=None,
     ngen_variables=[],
     ngen_vars_plot=[],
-    weights_df=None,
+    weights_op=None,
     window=[],
     fs_type=None,
     ii_verbose=False,
     ii_plot=False,
     nts_plot=1,
+    prefetch_depth=0,
+    prefetch_MB=0,
+    out_spec=None,
+    out_index=None,
+    nwm_reader="xarray",
+    range_reads=False,
+    nwm_cache=None,
+    regrid_cache=None,
+    regrid_keys=None,
 ):
     """
     Retrieve catchment level data from national water model files
@@ -245,16 +353,27 @@ def forcing_grid2catchment(
     fs: an optional file system for cloud storage reads
     ngen_variables: List of variables to read out of the nwm netcdf
     ngen_vars_plot: List of ngen variables to plot
-    weights_df: dataframe of weights. weights are values 0-1 corresponding to the percentage an overlapping a grid point on a polygon
+    weights_op: WeightsOperator built from the weights for this window, or a WindowedOperator to read and regrid each of its windows. A WeightsTable (or weights dataframe) is also accepted and compiled on the fly.
     fs_type: type of file system
     ii_verbose: verbosity
     ii_plot: save data for plotting
     nts_plot: number of time steps to include in gif
-
-    Outputs: [data_list, t_list, nwm_data]
-    data_list : list of ngen forcings ordered in time. ngen_forcings : 2d darray (forcing_variable x catchment)
+    prefetch_depth: number of files to download ahead of the one being regridded, 0 to disable
+    prefetch_MB: cap on the memory held by prefetched files, 0 for no cap
+    out_spec: spec of a SharedArray (time x forcing_variable x catchment) to write the forcings into, instead of returning them
+    out_index: time index in the shared array of each file
+    nwm_reader: "xarray" or "h5py", to read the window of NetCDF4 files with h5py hyperslabs
+    range_reads: read urls with HTTP range requests, fetching only the chunks of the window
+    nwm_cache: NWMFileCache to serve remote files from and store them in
+    regrid_cache: NWMFileCache to store each file's regridded forcings in
+    regrid_keys: regrid_cache key of each file, None to not store it
+
+    Outputs: [data_list, t_list, nwm_data, nwm_file_sizes_MB, cache_counts]
+    data_list : list of ngen forcings ordered in time, empty if out_spec is given. ngen_forcings : 2d darray (forcing_variable x catchment)
     t : model_output_valid_time for each
     nwm_data : nwm data saved for plotting. nwm_data : 3d array (forcing_variable x west_east x south_north)
+    nwm_file_sizes_MB : size of each nwm file
+    cache_counts : hits and misses of nwm_cache
     """
     topen = 0
     txrds = 0
@@ -266,15 +385,28 @@ def forcing_grid2catchment(
         [x for x in range(len(ngen_variables)) if ngen_variables[x] in ngen_vars_plot]
     )
     nfiles = len(nwm_files)
-    nvar = len(nwm_variables)
+    source_vars, source_index, derived = variable_plan(ngen_variables)
+    nvar = len(source_vars)
 
     x_max = window[0]
     x_min = window[1]
     y_max = window[2]
     y_min = window[3]
 
-    dx = x_max - x_min + 1
-    dy = y_max - y_min + 1
+    if weights_op is None:
+        weights_op = worker_state["weights_op"]
+    if isinstance(weights_op, pd.DataFrame):
+        weights_op = WeightsTable.from_dataframe(weights_op)
+    if isinstance(weights_op, WeightsTable):
+        weights_op = WeightsOperator.from_weights(
+            weights_op, (x_min, x_max, y_min, y_max)
+        )
+    # (operator, output rows) of each window read from a file
+    if isinstance(weights_op, WindowedOperator):
+        parts = weights_op.parts
+    else:
+        parts = [(weights_op, None)]
+    windows = [x.window for x, _ in parts]
 
     if fs_type == "google":
         fs = gcsfs.GCSFileSystem()
@@ -285,132 +417,177 @@ def forcing_grid2catchment(
         )
     data_list = []
     nwm_file_sizes_MB = []
-    for j, nwm_file in enumerate(nwm_files):
-        t0 = time.perf_counter()
-        if fs:
-            if nwm_file.find("https://") >= 0:
-                _, bucket_key = convert_url2key(nwm_file, fs_type)
-            else:
-                bucket_key = nwm_file
-            file_obj = fs.open(bucket_key, mode="rb")
-            nwm_file_sizes_MB.append(file_obj.details["size"])
-        elif "https://" in nwm_file:
-            response = requests.get(nwm_file)
-
-            if response.status_code == 200:
-                file_obj = BytesIO(response.content)
-            else:
-                raise Exception(f"{nwm_file} does not exist")
-            nwm_file_sizes_MB.append(len(response.content) / B2MB)
+    out_shared = SharedArray.attach(out_spec) if out_spec else None
+    tfetch = 0
+    fetched = prefetch(
+        nwm_files,
+        lambda x: fetch_nwm_file(
+            x,
+            fs,
+            fs_type,
+            in_memory=prefetch_depth > 0,
+            range_reads=range_reads,
+            variables=source_vars,
+            window=windows if len(windows) > 1 else windows[0],
+            cache=nwm_cache,
+        ),
+        depth=prefetch_depth,
+        max_bytes=prefetch_MB * B2MB,
+    )
+    for j, (nwm_file, (fetch_result, fetch_time, wait_time)) in enumerate(
+        zip(nwm_files, fetched)
+    ):
+        file_obj, file_size, _ = fetch_result
+        nwm_file_sizes_MB.append(file_size)
+        topen += wait_time
+        tfetch += fetch_time
+
+        # grids in the operator's precision so the regrid accumulates in it
+        grids = [
+            np.zeros(
+                shape=(nvar, x[3] - x[2] + 1, x[1] - x[0] + 1), dtype=weights_op.dtype
+            )
+            for x in windows
+        ]
+        if nwm_reader == "h5py" and is_hdf5(file_obj):
+            # hyperslabs straight into the grids, no dataset to build
+            t0 = time.perf_counter()
+            attrs = read_nwm_windows(file_obj, source_vars, windows, grids)
+            t = nwm_valid_time(nwm_file, attrs["dims"], attrs)
+            tfill += time.perf_counter() - t0
         else:
-            file_obj = nwm_file
-            nwm_file_sizes_MB.append(os.path.getsize(nwm_file) / B2MB)
-
-        topen += time.perf_counter() - t0
-        t0 = time.perf_counter()
-        with xr.open_dataset(file_obj) as nwm_data:
-            txrds += time.perf_counter() - t0
             t0 = time.perf_counter()
-            shp = nwm_data["U2D"].shape
-            data_allvars = np.zeros(shape=(nvar, dy, dx), dtype=np.float64)
-            for var_dx, jvar in enumerate(nwm_variables):
-                if "retrospective-2-1" in nwm_file or (
+            with xr.open_dataset(file_obj) as nwm_data:
+                txrds += time.perf_counter() - t0
+                t0 = time.perf_counter()
+                shp = nwm_data["U2D"].shape
+                ii_south_north = (
                     "south_north" in nwm_data.dims and "west_east" in nwm_data.dims
-                ):
-                    data_allvars[var_dx, :, :] = np.flip(
-                        np.squeeze(
-                            nwm_data[jvar]
-                            .isel(
-                                west_east=slice(x_min, x_max + 1),
-                                south_north=slice(shp[1] - (y_max + 1), shp[1] - y_min),
+                )
+                for (jx_min, jx_max, jy_min, jy_max), grid in zip(windows, grids):
+                    for var_dx, jvar in enumerate(source_vars):
+                        if "retrospective-2-1" in nwm_file or ii_south_north:
+                            window_sel = dict(
+                                west_east=slice(jx_min, jx_max + 1),
+                                south_north=slice(
+                                    shp[1] - (jy_max + 1), shp[1] - jy_min
+                                ),
                             )
-                            .values
-                        ),
-                        axis=0,
-                    )
-                    t = datetime.strftime(
-                        datetime.strptime(
-                            nwm_file.split("/")[-1].split(".")[0], "%Y%m%d%H"
-                        ),
-                        "%Y-%m-%d %H:%M:%S",
-                    )
-                else:
-                    data_allvars[var_dx, :, :] = np.flip(
-                        np.squeeze(
-                            nwm_data[jvar]
-                            .isel(
-                                x=slice(x_min, x_max + 1),
-                                y=slice(shp[1] - (y_max + 1), shp[1] - y_min),
+                        else:
+                            window_sel = dict(
+                                x=slice(jx_min, jx_max + 1),
+                                y=slice(shp[1] - (jy_max + 1), shp[1] - jy_min),
                             )
-                            .values
-                        ),
-                        axis=0,
-                    )
-                    time_splt = nwm_data.attrs["model_output_valid_time"].split("_")
-                    t = time_splt[0] + " " + time_splt[1]
-            t_list.append(t)
-            if ii_plot and j < nts_plot:
-                nwm_data_plot.append(data_allvars[jplot_vars, :, :])
-        del nwm_data
-        tfill += time.perf_counter() - t0
+                        grid[var_dx, :, :] = np.flip(
+                            np.squeeze(nwm_data[jvar].isel(**window_sel).values),
+                            axis=0,
+                        )
+                t = nwm_valid_time(nwm_file, nwm_data.dims, nwm_data.attrs)
+            del nwm_data
+            tfill += time.perf_counter() - t0
+        t_list.append(t)
+        if ii_plot and j < nts_plot:
+            nwm_data_plot.append(grids[0][source_index[jplot_vars], :, :])
 
         t0 = time.perf_counter()
-        data_allvars = data_allvars.reshape(nvar, dx * dy)
-        ncatch = len(weights_df)
-        data_array = np.zeros((nvar, ncatch), dtype=np.float64)
-        jcatch = 0
-        for row in weights_df.itertuples():
-            weights = row.cell_id
-            coverage = np.array(row.coverage)
-            coverage_mat = np.repeat(coverage[None, :], nvar, axis=0)
-
-            weights_dx, weights_dy = np.unravel_index(
-                weights, (shp[2], shp[1]), order="F"
-            )
-            weights_dx_shifted = list(weights_dx - x_min)
-            weights_dy_shifted = list(weights_dy - y_min)
-            weights_window = np.ravel_multi_index(
-                np.array([weights_dx_shifted, weights_dy_shifted]), (dx, dy), order="F"
-            )
-            jcatch_data_mask = data_allvars[:, weights_window]
-
-            weight_sum = np.sum(coverage)
-            data_array[:, jcatch] = (
-                np.sum(coverage_mat * jcatch_data_mask, axis=1) / weight_sum
-            )
-            jcatch += 1
-
-        del data_allvars
-        data_list.append(data_array)
+        if len(parts) == 1:
+            source_array = parts[0][0].apply(grids[0])
+        else:
+            source_array = np.zeros((nvar, len(weights_op)), dtype=weights_op.dtype)
+            for (jop, jrows), grid in zip(parts, grids):
+                source_array[:, jrows] = jop.apply(grid)
+        del grids
+        data_array = source_array[source_index, :]
+        for jvar, func in derived.items():
+            data_array[jvar, :] = func(data_array[jvar, :])
+        del source_array
+        if regrid_cache and regrid_keys and regrid_keys[j]:
+            buf = BytesIO()
+            np.savez(buf, data=data_array, t=np.array(t), file_size=np.array(file_size))
+            regrid_cache.put(regrid_keys[j], buf.getbuffer())
+        if out_shared:
+            out_shared.array[out_index[j], :, :] = data_array
+        else:
+            data_list.append(data_array)
         tdata += time.perf_counter() - t0
         ttotal = topen + txrds + tfill + tdata
         if ii_verbose:
             print(
-                f"\nAverage time for:\nfs open file: {topen / (j + 1):.2f} s\nxarray open dataset: {txrds / (j + 1):.2f} s\nfill array: {tfill / (j + 1):.2f} s\ncalculate catchment values: {tdata / (j + 1):.2f} s\ntotal {ttotal / (j + 1):.2f} s\npercent complete {100 * (j + 1) / nfiles:.2f}",
+                f"\nAverage time for:\nfs open file: {topen / (j + 1):.2f} s (fetch {tfetch / (j + 1):.2f} s, {max(tfetch - topen, 0) / (j + 1):.2f} s hidden by prefetch)\nxarray open dataset: {txrds / (j + 1):.2f} s\nfill array: {tfill / (j + 1):.2f} s\ncalculate catchment values: {tdata / (j + 1):.2f} s\ntotal {ttotal / (j + 1):.2f} s\npercent complete {100 * (j + 1) / nfiles:.2f}",
                 end=None,
                 flush=True,
             )
         report_usage()
 
+    if out_shared:
+        out_shared.close()
     if ii_verbose:
+        http_summary = format_http_stats()
+        if http_summary:
+            print(f"Process #{id} HTTP connections\n{http_summary}", flush=True)
         print(
             f"Process #{id} completed data extraction, returning data to primary process",
             flush=True,
         )
-    return [data_list, t_list, nwm_data_plot, nwm_file_sizes_MB]
+    cache_counts = (nwm_cache.hits, nwm_cache.misses) if nwm_cache else (0, 0)
+    return [data_list, t_list, nwm_data_plot, nwm_file_sizes_MB, cache_counts]
+
+
+def nwm_valid_time(nwm_file: str, dims, attrs) -> str:
+    """
+    Valid time of an NWM forcing file as "%Y-%m-%d %H:%M:%S". Retrospective 2.1
+    and other south_north/west_east files carry it in their name, the others in
+    the model_output_valid_time attribute.
+    """
+    if "retrospective-2-1" in nwm_file or ("south_north" in dims and "west_east" in dims):
+        return datetime.strftime(
+            datetime.strptime(nwm_file.split("/")[-1].split(".")[0], "%Y%m%d%H"),
+            "%Y-%m-%d %H:%M:%S",
+        )
+    time_splt = attrs["model_output_valid_time"].split("_")
+    return time_splt[0] + " " + time_splt[1]
 
 
-def multiprocess_write_df(data, t_ax, catchments, nprocs, out_path, data_source_type):
+def catchment_slice(data, start: int, end: int):
+    """
+    Worker argument for catchments [start, end) of a (time, variable, catchment)
+    forcing array. A SharedArray is passed by spec so workers attach to it
+    instead of receiving a pickled copy of the slice.
+    """
+    if isinstance(data, SharedArray):
+        return (data.spec, start, end)
+    return data[:, :, start:end]
+
+
+def attach_catchment_slice(data):
+    """
+    Resolve a worker argument made by catchment_slice.
+
+    Returns:
+        data (numpy.ndarray): (time, variable, catchment) array for the worker's catchments
+        shared (SharedArray): attached array to close when done, None for a plain array
+    """
+    if isinstance(data, tuple):
+        spec, start, end = data
+        shared = SharedArray.attach(spec)
+        return shared.array[:, :, start:end], shared
+    return data, None
+
+
+def multiprocess_write_df(
+    data, t_ax, catchments, nprocs, out_path, data_source_type, stream=None
+):
     """
     Sets up the process pool for write_data_df.
 
     Parameters:
-        data (numpy.ndarray): 3D array containing the data to be written.
+        data (numpy.ndarray or SharedArray): 3D array containing the data to be written.
         t_ax (numpy.ndarray): Array representing the time axis of the data.
         catchments (iterable): List of catchment identifiers.
         nprocs (int): Number of processes to be used for writing data.
         out_path (str): Path where the output files will be saved.
         data_source_type (str): channel_routing or forcings
+        stream (str): None, "create" or "append", see write_data_df
 
     Returns:
         flat_ids (list): Flattened list of catchment identifiers.
@@ -420,84 +597,44 @@ def multiprocess_write_df(data, t_ax, catchments, nprocs, out_path, data_source_
         flat_file_sizes_zipped (list): Flattened list of file sizes after compression in MB.
     """
 
-    launch_time = 0.05
-    cycle_time = 1
-    catchments_per_cycle = 200
-    catchments_per_proc = distribute_work(catchments, nprocs)
-    catchments_per_proc = load_balance(
-        catchments_per_proc, launch_time, cycle_time, catchments_per_cycle
+    ncatchments = len(catchments)
+    catchments = list(catchments)
+    blocks = job_blocks(
+        ncatchments, min(job_catchments, -(-ncatchments // max(nprocs, 1)))
     )
-
-    ntasked = len(np.nonzero(catchments_per_proc)[0])
-    if nprocs > ntasked:
-        if ii_verbose:
-            print(
-                f"Not enough work for {nprocs} requested processes, downsizing to {ntasked}"
+    jobs = []
+    for start, end in blocks:
+        if data_source_type == "forcings":
+            worker_data = catchment_slice(data, start, end)
+        else:
+            worker_data = data[:, start:end, :]
+        jobs.append(
+            (
+                worker_data,
+                t_ax,
+                catchments[start:end],
+                out_path,
+                ii_verbose,
+                storage_type,
+                output_file_type,
+                data_source_type,
+                compression,
+                stream,
             )
-
-    ncatchments = len(catchments)
-    out_path_list = []
-    print_list = []
-    worker_time_list = []
-    worker_data_list = []
-    worker_catchment_list = []
-    worker_catchments = {}
-
-    i = 0
-    count = 0
-    start = 0
-    end = 0
-    ii_print = False
-    for j, jcatch in enumerate(catchments):
-        worker_catchments[jcatch] = jcatch
-        count += 1
-        if count == catchments_per_proc[i] or j == ncatchments - 1:
-            if len(worker_catchment_list) == ntasked - 1:
-                ii_print = True
-
-            end = min(start + catchments_per_proc[i], ncatchments)
-            if data_source_type == "forcings":
-                worker_data = data[:, :, start:end]
-            else:
-                worker_data = data[:, start:end, :]
-            worker_data_list.append(worker_data)
-            start = end
-
-            worker_catchment_list.append(worker_catchments)
-            out_path_list.append(out_path)
-            print_list.append(ii_print)
-            worker_time_list.append(t_ax)
-
-            worker_catchments = {}
-            count = 0
-
-            i += 1
+        )
 
     ids = []
-    dfs = []
     filenames = []
     file_sizes_MB = []
     file_sizes_zipped_MB = []
     tar_buffs = []
-    with cf.ProcessPoolExecutor(max_workers=nprocs) as pool:
-        for results in pool.map(
-            write_data_df,
-            worker_data_list,
-            worker_time_list,
-            worker_catchment_list,
-            out_path_list,
-            print_list,
-            [ii_verbose for x in range(nprocs)],
-            [storage_type for x in range(nprocs)],
-            [output_file_type for x in range(nprocs)],
-            [ntasked for x in range(nprocs)],
-            [data_source_type for x in range(nprocs)],
-        ):
-            ids.append(results[0])
-            filenames.append(results[1])
-            file_sizes_MB.append(results[2])
-            file_sizes_zipped_MB.append(results[3])
-            tar_buffs.append(results[4])
+    progress = WriteProgress(ncatchments) if ii_verbose else None
+    for results in run_jobs(write_data_df, jobs, nprocs, "Write", progress):
+        ids.append(results[0])
+        filenames.append(results[1])
+        file_sizes_MB.append(results[2])
+        file_sizes_zipped_MB.append(results[3])
+        tar_buffs.append(results[4])
     print(f"\n\nGathering data from write processes...")
 
     flat_ids = []
@@ -516,36 +653,76 @@ def multiprocess_write_df(data, t_ax, catchments, nprocs, out_path, data_source_
     return flat_ids, flat_filenames, flat_file_sizes, flat_file_sizes_zipped, flat_tar
 
 
+class WriteProgress:
+    """
+    Reports the progress of the write stage as the write_data_df jobs finish,
+    counted over all workers in the primary process.
+
+    Parameters:
+        nfiles (int): number of files the stage writes
+    """
+
+    def __init__(self, nfiles: int):
+        self.nfiles = nfiles
+        self.nwritten = 0
+        self.nbytes = 0
+        self.t0 = time.perf_counter()
+
+    def __call__(self, results):
+        self.nwritten += len(results[1])
+        self.nbytes += sum(results[2]) * B2MB
+        t_accum = time.perf_counter() - self.t0
+        rate = self.nwritten / t_accum
+        bytes2bits = 8
+        bandwidth_Mbps = self.nbytes / B2MB * bytes2bits / t_accum
+        estimate_total_time = self.nfiles / rate if rate else 0
+        report_usage()
+        msg = f"\n{self.nwritten} dataframes converted out of {self.nfiles}\n"
+        msg += f"rate             {rate:.2f} files/s\n"
+        msg += f"estimated total write time {estimate_total_time:.2f}s\n"
+        msg += f"progress                   {self.nwritten / self.nfiles * 100:.2f}%\n"
+        msg += f"Bandwidth (all processs)   {bandwidth_Mbps:.2f} Mbps"
+        print(msg, flush=True)
+
+
 def write_data_df(
     data,
     t_ax,
     catchments,
     out_path,
-    ii_print,
     ii_verbose,
     storage_type,
     output_file_type,
-    ntasked,
     data_source_arg,
+    compression=("gzip", None, 1),
+    stream=None,
 ):
     """
     Write catchment forcing data to csv or parquet if requested. Also responsible for
     creating/formatting data in memory for tar writing and metadata collection.
+    File sizes are counted from the bytes written, no files are probed on disk.
 
     Args:
         data: Input data to be written (numpy array)
         t_ax: Time axis data (numpy array)
         catchments: List of catchment identifiers
         out_path: Output path for writing files
-        ii_print: Flag for printing progress information
+        compression: (compression, level, threads) used to report compressed file sizes
+        stream: None to write the whole run, "create" to start the csv files of a time
+            streamed run or "append" to add time steps to them (local storage)
 
     Returns:
         forcing_cat_ids: List of catchment identifiers
         filenames: List of filenames
-        file_size_MB: List containing the size of each file in MB
-        file_zipped_size_MB: List containing the size of each zipped file in MB
+        file_size_MB: List containing the size of each csv or parquet file written in MB,
+            when appending csv the size of the rows appended
+        file_zipped_size_MB: List containing the size of each file once compressed in MB
         tar_buffs: List of BytesIO buffer objects of data. This is precalculated for performance.
+            Empty for shared forcings, which the tar writers read directly.
     """
+    shared = None
+    if data_source_arg == "forcings":
+        data, shared = attach_catchment_slice(data)
     s3_client = boto3.session.Session().client("s3")
     nfiles = len(catchments)
     id = os.getpid()
@@ -553,20 +730,27 @@ def write_data_df(
     tar_buffs = []
     filenames = []
     filename = ""
-    write_int = 400
-    t_df = 0
+    file_sizes = []
+    file_zipped_sizes = []
     bucket = None
     key_prefix = None
     if storage_type == "s3":
         bucket, key_prefix = convert_url2key(out_path, storage_type)
 
-    t00 = time.perf_counter()
+    if data_source_arg == "forcings":
+        encoder = ForcingCSVEncoder(t_ax, ngen_variables, header=stream != "append")
+        ii_csv = "csv" in output_file_type or ("tar" in output_file_type and not shared)
+        if ii_csv:
+            csv_bytes = encoder.encode(data)
+
     for j, jcatch in enumerate(catchments):
-        t0 = time.perf_counter()
         if data_source_arg == "forcings":
-            df_data = data[:, :, j]
-            df = pd.DataFrame(df_data, columns=ngen_variables)
-            df.insert(0, "time", t_ax)
+            df = None
+            if "parquet" in output_file_type:
+                df = pd.DataFrame(data[:, :, j], columns=ngen_variables)
+                df.insert(0, "time", t_ax)
+            if ii_csv:
+                jcsv = next(csv_bytes)
         else:
             df_data = data[:, j, :]
             try:
@@ -577,7 +761,6 @@ def write_data_df(
             df = df[["q_lateral"]]
             df["time"] = t_ax
             df = df[["time", "q_lateral"]]  # reorder cols to maintain parity
-        t_df += time.perf_counter() - t0
 
         if data_source_arg == "forcings":
             cat_id = jcatch.split("-")[1]
@@ -600,11 +783,25 @@ def write_data_df(
                         flush=True,
                     )
             kwargs = (
-                {"s3": s3_client, "bucket": bucket, "key_prefix": key_prefix}
+                {"client": s3_client, "bucket": bucket, "key_prefix": key_prefix}
                 if storage_type == "s3"
                 else {"local_path": out_path}
             )
-            write_df(df, filename, storage_type, data_source_arg, **kwargs)
+            if df is None:
+                jbytes = jcsv
+            else:
+                jbytes = encode_df(df, filename, data_source_arg)
+            write_bytes(
+                jbytes,
+                filename,
+                storage_type,
+                append=stream == "append" and df is None,
+                **kwargs,
+            )
+
+            # account for exactly what was written
+            file_sizes.append(len(jbytes))
+            file_zipped_sizes.append(compressed_size(jbytes, *compression))
         else:
             if data_source_arg == "forcings":
                 filename = f"./cat-{cat_id}.csv"
@@ -613,53 +810,40 @@ def write_data_df(
 
         filenames.append(str(Path(filename).name))
 
-        if "tar" in output_file_type:
-            buf = BytesIO()
-            df.to_csv(buf, index=False)
-            buf.seek(0)
+        if "tar" in output_file_type and shared is None:
+            if data_source_arg == "forcings":
+                buf = BytesIO(jcsv)
+            else:
+                buf = BytesIO()
+                df.to_csv(buf, index=False)
+                buf.seek(0)
             tar_buffs.append(buf)
 
-        if j == 0:
-            if not os.path.exists(filename):
-                if data_source_arg == "forcings":
-                    filename = f"./cat-{cat_id}.csv"
-                else:
-                    filename = f"./{nex_id}.csv"
-                df.to_csv(filename, index=False)
-                file_size_MB = os.path.getsize(filename) / B2MB
-                os.remove(filename)
-            else:
-                file_size_MB = os.path.getsize(filename) / B2MB
-
-            pattern = r"\.\w+$"
-            filename_zip = re.sub(pattern, ".zip", filename)
-            with gzip.GzipFile(filename_zip, mode="w") as zipped_file:
-                df.to_csv(TextIOWrapper(zipped_file, "utf8"), index=False)
-            file_zipped_size_MB = os.path.getsize(filename_zip) / B2MB
-            os.remove(filename_zip)
-
-        if ii_print and ii_verbose:
-            if (j + 1) % write_int == 0 or j == nfiles - 1:
-                t_accum = time.perf_counter() - t00
-                rate = (j + 1) * ntasked / t_accum
-                bytes2bits = 8
-                bandwidth_Mbps = rate * file_size_MB * ntasked * bytes2bits
-                estimate_total_time = nfiles * ntasked / rate
-                report_usage()
-                msg = f"\n{(j + 1) * ntasked} dataframes converted out of {nfiles * ntasked}\n"
-                msg += f"rate             {rate:.2f} files/s\n"
-                msg += f"df conversion    {t_df:.2f}s\n"
-                msg += f"estimated total write time {estimate_total_time:.2f}s\n"
-                msg += f"progress                   {(j + 1) / nfiles * 100:.2f}%\n"
-                msg += f"Bandwidth (all processs)   {bandwidth_Mbps:.2f} Mbps"
-                print(msg, flush=True)
-
-    return forcing_cat_ids, filenames, [file_size_MB], [file_zipped_size_MB], tar_buffs
-
-
-def write_tar(tar_buffs, jcatchunk, catchments, filenames, storage_type, forcing_path):
+    if shared:
+        data = df = csv_bytes = None
+        shared.close()
+
+    file_size_MB = [x / B2MB for x in file_sizes]
+    file_zipped_size_MB = [x / B2MB for x in file_zipped_sizes]
+    return forcing_cat_ids, filenames, file_size_MB, file_zipped_size_MB, tar_buffs
+
+
+def write_tar(
+    tar_buffs,
+    jcatchunk,
+    catchments,
+    filenames,
+    storage_type,
+    forcing_path,
+    data=None,
+    t_ax=None,
+    part_MB=64,
+    compression=("gzip", None, 1),
+):
     """
-    Write DataFrames to a tar archive and upload to S3 or save locally as a compressed tar file.
+    Write DataFrames to a tar archive and upload to S3 or save locally as a compressed tar file
+    (.tar.gz or .tar.zst). Members are streamed into the archive as they are formatted, S3 archives are sent in
+    multipart parts as the compressed stream fills them.
 
     Args:
         tar_buffs: List of BytesIO buffer objects of data. This is precalculated for performance.
@@ -668,39 +852,48 @@ def write_tar(tar_buffs, jcatchunk, catchments, filenames, storage_type, forcing
         filenames: List of filenames corresponding to the DataFrames.
         storage_type: string s3 or local
         forcing_path: string s3 uri or local path
+        data: forcings for these catchments as made by catchment_slice, the csv
+            members are formatted from it when given instead of taken from tar_buffs
+        t_ax: time axis of data
+        part_MB: size of the S3 multipart parts in MB
+        compression: (compression, level, threads), see write_tools.open_compressed
 
     Returns:
-        None
+        tar_size_MB (float): compressed size of the archive in MB
     """
-    print(f"Writing {jcatchunk} tar")
-    if storage_type == "s3":
-        tar_name = f"{jcatchunk}_forcings.tar.gz"
-        buffer = BytesIO()
-        with tarfile.open(fileobj=buffer, mode="w:gz") as jtar:
-            for j, jcat in enumerate(catchments):
-                jbuff = tar_buffs[j]
-                jfilename = filenames[j]
-                info = tarfile.TarInfo(name=jfilename)
-                info.size = len(jbuff.getbuffer())
-                jtar.addfile(info, jbuff)
-
-        print(f"Uploading {jcatchunk} tar to s3")
-        buffer.seek(0)
-        bucket, key = convert_url2key(forcing_path, storage_type)
-        s3 = boto3.client("s3")
-        s3.put_object(Bucket=bucket, Key=key + "/" + tar_name, Body=buffer.getvalue())
-    else:
-        tar_name = Path(forcing_path, f"{jcatchunk}_forcings.tar.gz")
-        with tarfile.open(tar_name, "w:gz") as jtar:
-            for j, jcat in enumerate(catchments):
-                jbuff = tar_buffs[j]
-                jfilename = filenames[j]
-                info = tarfile.TarInfo(name=jfilename)
-                info.size = len(jbuff.getbuffer())
-                jtar.addfile(info, jbuff)
-
-
-def multiprocess_write_tar(catchments, filenames, tar_buffs):
+    shared = None
+    if data is not None:
+        data, shared = attach_catchment_slice(data)
+        encoder = ForcingCSVEncoder(t_ax, ngen_variables)
+        tar_buffs = (BytesIO(x) for x in encoder.encode(data))
+    try:
+        print(f"Writing {jcatchunk} tar")
+        tar_name = f"{jcatchunk}_forcings.tar{COMPRESSION_EXTENSIONS[compression[0]]}"
+        if storage_type == "s3":
+            bucket, key = convert_url2key(forcing_path, storage_type)
+            s3 = boto3.client("s3")
+            out_file = S3MultipartWriter(
+                s3, bucket, key + "/" + tar_name, part_size=part_MB * B2MB
+            )
+        else:
+            out_file = open(Path(forcing_path, tar_name), "wb")
+        with out_file:
+            counter = CountingWriter(out_file)
+            with open_compressed(counter, *compression) as compressed:
+                with tarfile.open(fileobj=compressed, mode="w|") as jtar:
+                    for j, jbuff in enumerate(tar_buffs):
+                        jfilename = filenames[j]
+                        info = tarfile.TarInfo(name=jfilename)
+                        info.size = len(jbuff.getbuffer())
+                        jtar.addfile(info, jbuff)
+    finally:
+        if shared:
+            del data, tar_buffs
+            shared.close()
+    return counter.nbytes / B2MB
+
+
+def multiprocess_write_tar(catchments, filenames, tar_buffs, data=None, t_ax=None):
     """
     Write DataFrames to tar archives using multiprocessing.
 
@@ -708,13 +901,17 @@ def multiprocess_write_tar(catchments, filenames, tar_buffs):
         catchments: Dictionary containing catchment chunks.
         filenames: List of filenames corresponding to the DataFrames.
         tar_buffs: List of BytesIO buffer objects of data. This is precalculated for performance.
+        data: (numpy.ndarray or SharedArray) forcings to format the tar members
+            from instead of tar_buffs, None to use tar_buffs
+        t_ax: time axis of data
 
     Returns:
-        None
+        tar_file_sizes_MB (list): compressed size of each tar archive in MB
     """
     i = 0
     k = 0
     tar_buffs_list = []
+    data_list = []
     jcatchunk_list = []
     catchments_list = []
     filenames_list = []
@@ -722,24 +919,28 @@ def multiprocess_write_tar(catchments, filenames, tar_buffs):
         ncatchments = len(catchments[jchunk])
         k += ncatchments
         tar_buffs_list.append(tar_buffs[i:k])
+        data_list.append(None if data is None else catchment_slice(data, i, k))
         jcatchunk_list.append(jchunk)
         catchments_list.append(catchments[jchunk])
         filenames_list.append(filenames[i:k])
         i = k
 
-    njobs = len(catchments)
-
-    with cf.ProcessPoolExecutor(max_workers=min(len(catchments), nprocs)) as pool:
-        for results in pool.map(
-            write_tar,
-            tar_buffs_list,
-            jcatchunk_list,
-            catchments_list,
-            filenames_list,
-            [storage_type for x in range(njobs)],
-            [forcing_path for x in range(njobs)],
-        ):
-            pass
+    jobs = [
+        (
+            tar_buffs_list[j],
+            jcatchunk_list[j],
+            catchments_list[j],
+            filenames_list[j],
+            storage_type,
+            forcing_path,
+            data_list[j],
+            t_ax,
+            s3_part_MB,
+            compression,
+        )
+        for j in range(len(catchments))
+    ]
+    return run_jobs(write_tar, jobs, nprocs, "Tar")
 
 
 def write_netcdf(
@@ -749,18 +950,23 @@ def write_netcdf(
     prefix: str,
     filename: str,
     storage_type: str,
+    stream: str = None,
 ):
     """
     Write 3D array data to a NetCDF file.
 
     Parameters:
-        data (numpy.ndarray): 3D array with dimensions (time, forcing_variable, catchment-id).
+        data (numpy.ndarray): 3D array with dimensions (time, forcing_variable, catchment-id),
+            or a shared slice made by catchment_slice.
         t_ax (list): list representing time axis.
         catchments (list): list containing catchment IDs.
         filename (str): string for the filename
+        stream (str): None to write the whole run, "create" to start a file with an
+            unlimited time dimension or "append" to add time steps to it (local storage)
     Returns:
         None
     """
+    data, shared = attach_catchment_slice(data)
     if storage_type == "s3":
         s3_client = boto3.session.Session().client("s3")
         nc_filename = prefix + "/" + filename
@@ -782,23 +988,32 @@ def write_netcdf(
             tmpfile.seek(0)
             print(f"Uploading netcdf forcings to S3: bucket={bucket}, key={key}")
             s3_client.upload_file(tmpfile.name, bucket, key)
+    elif stream == "append":
+        append_forcing_netcdf(nc_filename, t_utc, data)
+        netcdf_cat_file_size = os.path.getsize(nc_filename) / B2MB
     else:
-        make_forcing_netcdf(nc_filename, catchments, t_utc, data)
+        make_forcing_netcdf(
+            nc_filename, catchments, t_utc, data, unlimited=stream == "create"
+        )
         print(f"netcdf has been written to {nc_filename}")
         netcdf_cat_file_size = os.path.getsize(nc_filename) / B2MB
+    if shared:
+        del data
+        shared.close()
     return netcdf_cat_file_size
 
 
 def multiprocess_write_netcdf(
-    data: np.ndarray, jcatchment_dict: dict, t_ax: np.ndarray
+    data: np.ndarray, jcatchment_dict: dict, t_ax: np.ndarray, stream: str = None
 ):
     """
     Write DataFrames to tar archives using multiprocessing.
 
     Parameters:
-        data (numpy.ndarray): 3D array with dimensions (catchment-id, time, forcing variable).
+        data (numpy.ndarray or SharedArray): 3D array with dimensions (time, forcing variable, catchment-id).
         jcatchment_dict (dict): Dictionary containing catchment chunks.
         t_ax (numpy.ndarray): Array representing time axis.
+        stream (str): None, "create" or "append", see write_netcdf
 
     Returns:
         None
@@ -812,7 +1027,7 @@ def multiprocess_write_netcdf(
     for j, jvpu in enumerate(jcatchment_dict):
         ncatchments = len(jcatchment_dict[jvpu])
         k += ncatchments
-        data_list.append(data[:, :, i:k])
+        data_list.append(catchment_slice(data, i, k))
         vpu_list.append(jvpu)
         catchments_list.append(jcatchment_dict[jvpu])
         if FCST_CYCLE is None:
@@ -823,26 +1038,218 @@ def multiprocess_write_netcdf(
             )
         i = k
 
-    njobs = len(jcatchment_dict)
-    netcdf_cat_file_sizes = []
-    with cf.ProcessPoolExecutor(max_workers=min(njobs, nprocs)) as pool:
-        for results in pool.map(
-            write_netcdf,
-            data_list,
-            [t_ax for x in range(njobs)],
-            catchments_list,
-            [forcing_path for x in range(njobs)],
-            filenames,
-            [storage_type for x in range(njobs)],
-        ):
-            netcdf_cat_file_sizes.append(results)
+    jobs = [
+        (
+            data_list[j],
+            t_ax,
+            catchments_list[j],
+            forcing_path,
+            filenames[j],
+            storage_type,
+            stream,
+        )
+        for j in range(len(jcatchment_dict))
+    ]
+    return run_jobs(write_netcdf, jobs, nprocs, "NetCDF")
 
-    return netcdf_cat_file_sizes
 
+def finish_streamed_files(
+    catchments: list,
+    out_path: str,
+    file_type: str,
+    part_dirs: list,
+    compression=("gzip", None, 1),
+):
+    """
+    Finish the per-catchment files of a time streamed run and measure them.
+    Parquet can not be appended to, so each window is written whole into its own
+    directory of part_dirs and the parts are concatenated once here. Csv files
+    already hold every window and are only measured.
 
-def calculate_vpu_precip_stats(data_array, catchment_ids, jcatchment_dict):
+    Args:
+        catchments: List of catchment identifiers
+        out_path: Local directory of the per-catchment files
+        file_type: csv or parquet
+        part_dirs: Directories of the parquet windows in time order, empty for csv
+        compression: (compression, level, threads) used to report compressed file sizes
+
+    Returns:
+        file_size_MB: List containing the size of each finished file in MB
+        file_zipped_size_MB: List containing the size of each file once compressed in MB
     """
-    Calculate compact precipitation statistics for each VPU.
+    file_sizes = []
+    file_zipped_sizes = []
+    for jcatch in catchments:
+        filename = f"cat-{jcatch.split('-')[1]}.{file_type}"
+        if part_dirs:
+            df = pd.concat(
+                [pd.read_parquet(Path(x, filename)) for x in part_dirs],
+                ignore_index=True,
+            )
+            jbytes = encode_df(df, filename, "forcings")
+            write_bytes(jbytes, filename, "local", local_path=out_path)
+        else:
+            jbytes = Path(out_path, filename).read_bytes()
+        file_sizes.append(len(jbytes))
+        file_zipped_sizes.append(compressed_size(jbytes, *compression))
+
+    file_size_MB = [x / B2MB for x in file_sizes]
+    file_zipped_size_MB = [x / B2MB for x in file_zipped_sizes]
+    return file_size_MB, file_zipped_size_MB
+
+
+def multiprocess_finish_streamed_files(
+    catchments: list, nprocs: int, out_path: str, file_type: str, part_dirs: list
+):
+    """
+    Sets up the process pool for finish_streamed_files.
+
+    Returns:
+        file_sizes_MB (numpy.ndarray): size of each per-catchment file
+        file_sizes_zipped_MB (numpy.ndarray): compressed size of each per-catchment file
+    """
+    catchments = list(catchments)
+    blocks = job_blocks(
+        len(catchments), min(job_catchments, -(-len(catchments) // max(nprocs, 1)))
+    )
+    jobs = [
+        (catchments[start:end], out_path, file_type, part_dirs, compression)
+        for start, end in blocks
+    ]
+    file_sizes_MB = []
+    file_sizes_zipped_MB = []
+    for results in run_jobs(finish_streamed_files, jobs, nprocs, "Finish"):
+        file_sizes_MB.extend(results[0])
+        file_sizes_zipped_MB.extend(results[1])
+    return np.array(file_sizes_MB), np.array(file_sizes_zipped_MB)
+
+
+def stream_forcings(
+    nwm_files: list,
+    time_window: int,
+    weights_op: WeightsOperator,
+    fs,
+    jcatchment_dict: dict,
+    ii_collect_stats: bool,
+):
+    """
+    Extract and write forcings `time_window` NWM files at a time, appending each
+    window to the outputs. Memory is bounded by the window instead of the whole run,
+    and the files match those of a single run over all of nwm_files. Parquet windows
+    are written as parts and concatenated once after the last window, file sizes
+    are measured on the finished files.
+
+    Returns:
+        t_ax (list): time axis of the whole run
+        nwm_file_sizes_MB (list): size of each NWM file
+        netcdf_cat_file_sizes_MB (list): size of each netcdf file
+        forcing_cat_ids (list): catchment ids
+        filenames (list): per-catchment file names
+        file_sizes_MB (numpy.ndarray): size of each per-catchment file
+        file_sizes_zipped_MB (numpy.ndarray): compressed size of each per-catchment file
+        precip_partials (dict): per VPU precipitation stats, see accumulate_vpu_precip_stats
+        t_extract (float): seconds spent extracting
+        write_time (float): seconds spent writing
+    """
+    t_ax = []
+    nwm_file_sizes_MB = []
+    netcdf_cat_file_sizes_MB = []
+    forcing_cat_ids = []
+    filenames = []
+    file_sizes_MB = []
+    file_sizes_zipped_MB = []
+    precip_partials = {}
+    t_extract = 0
+    write_time = 0
+    df_types = [x for x in output_file_type if x in ["csv", "parquet"]]
+    part_dirs = []
+    nwindows = -(-len(nwm_files) // time_window)
+    try:
+        for jwindow in range(nwindows):
+            jfiles = nwm_files[jwindow * time_window : (jwindow + 1) * time_window]
+            stream = "create" if jwindow == 0 else "append"
+            df_path, df_stream = forcing_path, stream
+            if df_types[:1] == ["parquet"]:
+                # parquet can not be appended to, write the window as parts
+                df_path = Path(forcing_path, f"parquet_window_{jwindow}")
+                df_path.mkdir()
+                part_dirs.append(df_path)
+                df_stream = None
+
+            t0 = time.perf_counter()
+            data_array, jt_ax, _, jsizes, data_shared = multiprocess_data_extract(
+                jfiles, nprocs, weights_op, fs
+            )
+            t_extract += time.perf_counter() - t0
+            try:
+                # "%Y-%m-%d %H:%M:%S" strings sort in time order
+                jseq = t_ax[-1:] + jt_ax
+                if any(a >= b for a, b in zip(jseq, jseq[1:])):
+                    raise ValueError(
+                        "time_window needs the NWM files listed forward in time"
+                    )
+                if ii_collect_stats:
+                    accumulate_vpu_precip_stats(
+                        data_array,
+                        weights_op.catchments,
+                        jcatchment_dict,
+                        precip_partials,
+                    )
+                data_array = None
+
+                t0 = time.perf_counter()
+                if "netcdf" in output_file_type:
+                    netcdf_cat_file_sizes_MB = multiprocess_write_netcdf(
+                        data_shared, jcatchment_dict, jt_ax, stream
+                    )
+                if df_types:
+                    forcing_cat_ids, filenames, _, _, _ = multiprocess_write_df(
+                        data_shared,
+                        jt_ax,
+                        weights_op.catchments,
+                        nprocs,
+                        df_path,
+                        "forcings",
+                        df_stream,
+                    )
+                write_time += time.perf_counter() - t0
+            finally:
+                data_array = None
+                data_shared.unlink()
+
+            t_ax.extend(jt_ax)
+            nwm_file_sizes_MB.extend(jsizes)
+            if ii_verbose:
+                print(f"\nTime window {jwindow + 1} of {nwindows} written", flush=True)
+            report_usage()
+
+        if df_types:
+            t0 = time.perf_counter()
+            file_sizes_MB, file_sizes_zipped_MB = multiprocess_finish_streamed_files(
+                weights_op.catchments, nprocs, forcing_path, df_types[0], part_dirs
+            )
+            write_time += time.perf_counter() - t0
+    finally:
+        for jdir in part_dirs:
+            shutil.rmtree(jdir, ignore_errors=True)
+
+    return (
+        t_ax,
+        nwm_file_sizes_MB,
+        netcdf_cat_file_sizes_MB,
+        forcing_cat_ids,
+        filenames,
+        file_sizes_MB,
+        file_sizes_zipped_MB,
+        precip_partials,
+        t_extract,
+        write_time,
+    )
+
+
+def accumulate_vpu_precip_stats(data_array, catchment_ids, jcatchment_dict, partials=None):
+    """
+    Accumulate the precipitation statistics of each VPU over a block of time steps.
 
     Parameters
     ----------
@@ -852,19 +1259,21 @@ def calculate_vpu_precip_stats(data_array, catchment_ids, jcatchment_dict):
         Catchment IDs corresponding to the catchment axis of data_array.
     jcatchment_dict : dict
         Mapping of VPU IDs to catchment IDs.
+    partials : dict, optional
+        Result of a previous call to add these time steps to.
 
     Returns
     -------
-    pd.DataFrame
-        One row per VPU containing precipitation summary statistics.
+    dict
+        VPU id to [min, max, sum, nonzero count, size] of its precipitation.
     """
+    if partials is None:
+        partials = {}
     precip_idx = ngen_variables.index("precip_rate")
     catchment_index = {
         str(catchment_id): i for i, catchment_id in enumerate(catchment_ids)
     }
 
-    rows = []
-
     for vpu_id, vpu_catchments in jcatchment_dict.items():
         indices = [
             catchment_index[str(catchment_id)]
@@ -876,22 +1285,128 @@ def calculate_vpu_precip_stats(data_array, catchment_ids, jcatchment_dict):
             continue
 
         precip = data_array[:, precip_idx, indices]
+        jstats = [
+            float(np.min(precip)),
+            float(np.max(precip)),
+            float(np.sum(precip, dtype=np.float64)),
+            np.count_nonzero(precip),
+            precip.size,
+        ]
+        if vpu_id in partials:
+            prev = partials[vpu_id]
+            jstats = [
+                min(prev[0], jstats[0]),
+                max(prev[1], jstats[1]),
+                prev[2] + jstats[2],
+                prev[3] + jstats[3],
+                prev[4] + jstats[4],
+            ]
+        partials[vpu_id] = jstats
 
+    return partials
+
+
+def vpu_precip_stats_df(partials):
+    """
+    One row per VPU containing precipitation summary statistics, from
+    accumulate_vpu_precip_stats.
+    """
+    rows = []
+    for vpu_id, (pmin, pmax, psum, nonzero, size) in partials.items():
         rows.append(
             {
                 "vpu_id": vpu_id,
-                "precip_min": float(np.min(precip)),
-                "precip_max": float(np.max(precip)),
-                "precip_mean": float(np.mean(precip)),
-                "precip_sum": float(np.sum(precip)),
-                "precip_nonzero_fraction": float(
-                    np.count_nonzero(precip) / precip.size
-                ),
+                "precip_min": pmin,
+                "precip_max": pmax,
+                "precip_mean": psum / size,
+                "precip_sum": psum,
+                "precip_nonzero_fraction": float(nonzero / size),
             }
         )
 
     return pd.DataFrame(rows)
 
+
+def calculate_vpu_precip_stats(data_array, catchment_ids, jcatchment_dict):
+    """
+    Calculate compact precipitation statistics for each VPU.
+
+    Parameters
+    ----------
+    data_array : np.ndarray
+        Forcing data with dimensions (time, variable, catchment).
+    catchment_ids : list
+        Catchment IDs corresponding to the catchment axis of data_array.
+    jcatchment_dict : dict
+        Mapping of VPU IDs to catchment IDs.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per VPU containing precipitation summary statistics.
+    """
+    return vpu_precip_stats_df(
+        accumulate_vpu_precip_stats(data_array, catchment_ids, jcatchment_dict)
+    )
+
+
+def write_bytes(
+    data: bytes,
+    filename: str,
+    storage_type: str,
+    client: boto3.client = None,
+    bucket: str = None,
+    key_prefix: str = None,
+    local_path: str = None,
+    append: bool = False,
+):
+    """
+    Write already encoded file contents to S3 or local storage.
+
+    Args:
+        data (bytes): file contents.
+        filename (str): Name of the file.
+        storage_type (str): 's3' or 'local'.
+        client (boto3.client, optional): S3 client if using S3.
+        bucket (str, optional): S3 bucket name.
+        key_prefix (str, optional): S3 key prefix (folder path).
+        local_path (str, optional): Local directory path.
+        append (bool, optional): Append to an existing local file.
+    """
+    if storage_type == "s3":
+        client.put_object(Bucket=bucket, Key=f"{key_prefix}/{filename}", Body=data)
+    else:
+        with open(Path(local_path, filename), "ab" if append else "wb") as f:
+            f.write(data)
+
+
+def encode_df(df: pd.DataFrame, filename: str, data_source_arg: str) -> bytes:
+    """
+    Encode a DataFrame as the contents of a CSV or Parquet file.
+    The file type is inferred from the filename extension.
+
+    Args:
+        df (pd.DataFrame): DataFrame to encode.
+        filename (str): Name of the file (e.g., 'metadata.csv' or 'metadata.parquet').
+        data_source_arg (str): 'channel_routing' or 'forcings'.
+
+    Returns:
+        bytes: the file contents
+    """
+    ext = Path(filename).suffix.lower()
+    buf = BytesIO()
+    if ext == ".csv":
+        if data_source_arg == "channel_routing":
+            df.to_csv(buf, header=False)  # t-route input format
+        else:
+            df.to_csv(buf, index=False)
+    elif ext == ".parquet":
+        df.to_parquet(buf)
+    else:
+        raise ValueError("Only CSV and Parquet output is supported by write_df")
+    return buf.getvalue()
+
+
 def write_df(
     df: pd.DataFrame,
     filename: str,
@@ -916,36 +1431,15 @@ def write_df(
         key_prefix (str, optional): S3 key prefix (folder path).
         local_path (str, optional): Local directory path.
     """
-    ext = Path(filename).suffix.lower()
-    if ext == ".csv":
-        if storage_type == "s3":
-            buf = BytesIO()
-            if data_source_arg == "channel_routing":
-                df.to_csv(buf, header=False)  # t-route input format
-            else:
-                df.to_csv(buf, index=False)
-
-            key_name = f"{key_prefix}/{filename}"
-            client.put_object(Bucket=bucket, Key=key_name, Body=buf.getvalue())
-            buf.close()
-        else:
-            out_path = Path(local_path, filename)
-            if data_source_arg == "channel_routing":
-                df.to_csv(out_path, header=False)
-            else:
-                df.to_csv(out_path, index=False)
-    elif ext == ".parquet":
-        if storage_type == "s3":
-            buf = BytesIO()
-            df.to_parquet(buf)
-            key_name = f"{key_prefix}/{filename}"
-            client.put_object(Bucket=bucket, Key=key_name, Body=buf.getvalue())
-            buf.close()
-        else:
-            out_path = Path(local_path, filename)
-            df.to_parquet(out_path)
-    else:
-        raise ValueError("Only CSV and Parquet output is supported by write_df")
+    write_bytes(
+        encode_df(df, filename, data_source_arg),
+        filename,
+        storage_type,
+        client=client,
+        bucket=bucket,
+        key_prefix=key_prefix,
+        local_path=local_path,
+    )
 
 
 def prep_ngen_data(conf):
@@ -1046,10 +1540,72 @@ def prep_ngen_data(conf):
     output_path = conf["storage"].get("output_path", "")
     output_file_type = conf["storage"].get("output_file_type", "csv")
 
+    global compression
+    compression = (
+        conf["storage"].get("compression", "gzip"),
+        conf["storage"].get("compression_level", None),
+        conf["storage"].get("compression_threads", 1),
+    )
+    # fail before processing on an unknown backend or missing zstandard
+    open_compressed(BytesIO(), *compression).close()
+
     global ii_verbose, nprocs
     ii_verbose = conf["run"].get("verbose", False)
     ii_collect_stats = conf["run"].get("collect_stats", True)
     nprocs = conf["run"].get("nprocs", int(os.cpu_count() * 0.5))
+    weights_cache_dir = conf["run"].get("weights_cache_dir", None)
+
+    global prefetch_depth, prefetch_MB
+    prefetch_depth = conf["run"].get("prefetch_depth", 2)
+    prefetch_MB = conf["run"].get("prefetch_MB", 1024)
+
+    # work is queued in units of job_files NWM files or job_catchments
+    # catchments, idle workers take the next unit
+    global job_files, job_catchments
+    job_files = conf["run"].get("job_files", 0)
+    job_catchments = conf["run"].get("job_catchments", 2000)
+
+    global multi_window
+    multi_window = conf["run"].get("multi_window", True)
+
+    configure_http(
+        pool_size=conf["run"].get("http_pool_size"),
+        timeout=conf["run"].get("http_timeout"),
+        retries=conf["run"].get("http_retries"),
+        backoff=conf["run"].get("http_backoff"),
+    )
+
+    global nwm_cache, nwm_cache_counts
+    nwm_cache = None
+    nwm_cache_counts = [0, 0]
+    if conf["run"].get("nwm_cache_dir"):
+        nwm_cache = NWMFileCache(
+            conf["run"]["nwm_cache_dir"],
+            conf["run"].get("nwm_cache_MB", 20480) * B2MB,
+        )
+
+    global nwm_reader, range_reads
+    range_reads = conf["run"].get("range_reads", False)
+    nwm_reader = conf["run"].get("nwm_reader", "xarray")
+    if nwm_reader not in NWM_READERS:
+        raise ValueError(
+            f"Unsupported nwm_reader {nwm_reader}, options are {list(NWM_READERS)}"
+        )
+
+    global shared_array_dir
+    shared_array_dir = conf["run"].get("shared_array_dir", None)
+
+    global s3_part_MB
+    s3_part_MB = conf["run"].get("s3_part_MB", 64)
+
+    time_window = conf["run"].get("time_window", 0)
+    ii_stream = time_window > 0
+
+    precision = conf["run"].get("precision", "float64")
+    if precision not in ("float64", "float32"):
+        raise ValueError(
+            f"Unsupported precision {precision}, options are float64 and float32"
+        )
 
     global ii_plot, nts_plot, ngen_vars_plot
     ii_plot = conf.get("plot", False)
@@ -1074,6 +1630,18 @@ def prep_ngen_data(conf):
         nts_plot = 0
         ngen_vars_plot = []
 
+    # the plots need the raw NWM grids, so regridded files are not reused then
+    global regrid_cache, regrid_cache_counts, weights_op_hash
+    regrid_cache = None
+    regrid_cache_counts = [0, 0]
+    weights_op_hash = None
+    if conf["run"].get("regrid_cache_dir") and not ii_plot:
+        regrid_cache = NWMFileCache(
+            conf["run"]["regrid_cache_dir"],
+            conf["run"].get("regrid_cache_MB", 20480) * B2MB,
+            suffix=".npz",
+        )
+
     if ii_verbose:
         msg = f"\nForcingProcessor has awoken. Let's do this."
         for x in msg:
@@ -1101,20 +1669,45 @@ def prep_ngen_data(conf):
     else:
         storage_type = "local"
 
+    if ii_stream:
+        if data_source != "forcings":
+            raise ValueError("time_window is only supported for forcings")
+        if storage_type != "local":
+            raise ValueError("time_window appends to its outputs, it needs local storage")
+        if "tar" in output_file_type or ii_plot:
+            raise ValueError("time_window does not support tar output or plotting")
+
     nwm_forcing_files = []
     with open(nwm_file, "r") as fp:
         for jline in fp.readlines():
             nwm_forcing_files.append(jline.strip())
     nfiles = len(nwm_forcing_files)
 
+    # Determine the file system type based on the first NWM forcing file
+    global fs_type
+    if "s3://" in nwm_forcing_files[0] in nwm_forcing_files[0]:
+        fs = s3fs.S3FileSystem(anon=True, client_kwargs={"region_name": "us-east-1"})
+        fs_type = "s3"
+    elif (
+        "google" in nwm_forcing_files[0]
+        or "gs://" in nwm_forcing_files[0]
+        or "gcs://" in nwm_forcing_files[0]
+    ):
+        fs = "google"
+        fs_type = "google"
+    else:
+        fs = None
+        fs_type = None
+
     log_time("CONFIGURATION_END", log_file)
 
+    weights_key = None
     if data_source == "forcings":
         log_time("READWEIGHTS_START", log_file)
         tw = time.perf_counter()
         if ii_verbose:
             print(f"Obtaining weights\n", flush=True)
-        global weights_df
+        global weights
 
         if weights_files:
             # Explicit precomputed weights were supplied in the config file, so read them in
@@ -1139,10 +1732,33 @@ def prep_ngen_data(conf):
             raise RuntimeError(
                 "No weights or geopackage file specified in config file. Cannot proceed."
             )
-        
-        weights_df, jcatchment_dict = multiprocess_hf2ds(
-            weight_inputs, nwm_forcing_files[0], nprocs
+
+        weights_op = None
+        weights = None
+        # cell ids are flat indices on the grid of the forcing files
+        nx, ny = nwm_grid_shape(
+            nwm_forcing_files[0],
+            gcsfs.GCSFileSystem() if fs_type == "google" else fs,
+            fs_type,
         )
+        if weights_cache_dir or keep_resident:
+            weights_key = weights_cache_key(weight_inputs, nx, ny)
+        if weights_key in resident_weights:
+            weights_op, jcatchment_dict, weights = resident_weights[weights_key]
+            if ii_verbose:
+                print(f"Using resident weights for key {weights_key}\n", flush=True)
+        elif weights_cache_dir and weights_key:
+            weights_op, jcatchment_dict = load_weights_operator(
+                weights_cache_dir, weights_key
+            )
+            if ii_verbose:
+                status = "hit" if weights_op else "miss"
+                print(f"Weights cache {status} for key {weights_key}\n", flush=True)
+
+        if weights_op is None:
+            weights, jcatchment_dict = multiprocess_hf2ds(
+                weight_inputs, nwm_forcing_files[0], nprocs
+            )
 
         log_time("READWEIGHTS_END", log_file)
 
@@ -1155,14 +1771,58 @@ def prep_ngen_data(conf):
         # jcatchment_dict = x
 
         log_time("CALC_WINDOW_START", log_file)
-        ncatchments = len(weights_df)
         global window
-        x_min, x_max, y_min, y_max = get_window(weights_df)
+        if weights_op is None:
+            x_min, x_max, y_min, y_max = get_window(weights, nx, ny)
+            weights_op = WeightsOperator.from_weights(
+                weights, (x_min, x_max, y_min, y_max), nx, ny
+            )
+            if weights_cache_dir and weights_key:
+                save_weights_operator(
+                    weights_cache_dir,
+                    weights_key,
+                    weights_op,
+                    jcatchment_dict,
+                    weights,
+                    (nx, ny),
+                )
+        else:
+            x_min, x_max, y_min, y_max = weights_op.window
+        if keep_resident and weights_key and weights_key not in resident_weights:
+            if weights is None:
+                weights = load_cached_weights(weights_cache_dir, weights_key)
+            if len(resident_weights) >= RESIDENT_WEIGHTS_MAX:
+                resident_weights.pop(next(iter(resident_weights)))
+            resident_weights[weights_key] = (weights_op, jcatchment_dict, weights)
         window = [x_max, x_min, y_max, y_min]
+        if multi_window and len(jcatchment_dict) > 1 and not ii_plot:
+            # VPUs far apart are read through windows of their own instead
+            # of the window spanning all of them
+            if weights is None:
+                weights = load_cached_weights(weights_cache_dir, weights_key)
+            windows, members = get_windows(weights, jcatchment_dict, nx=nx)
+            if len(windows) > 1:
+                starts = np.cumsum([0] + [len(x) for x in jcatchment_dict.values()])
+                group_rows = {
+                    jgroup: np.arange(starts[j], starts[j + 1])
+                    for j, jgroup in enumerate(jcatchment_dict)
+                }
+                rows = [np.concatenate([group_rows[x] for x in y]) for y in members]
+                weights_op = WindowedOperator.split(weights_op, windows, rows)
+                if ii_verbose:
+                    hull = (x_max - x_min + 1) * (y_max - y_min + 1)
+                    cells = sum(window_cells(x) for x in windows)
+                    print(
+                        f"Reading {len(windows)} windows of {cells} cells instead of one of {hull}: {members}\n",
+                        flush=True,
+                    )
+        weights_op = weights_op.astype(precision)
+        if regrid_cache or keep_resident:
+            weights_op_hash = weights_operator_hash(weights_op, ngen_variables)
+        ncatchments = len(weights_op)
         weight_time = time.perf_counter() - tw
         log_time("CALC_WINDOW_END", log_file)
 
-
     elif data_source == "channel_routing":
         log_time("READMAP_START", log_file)
         tw = time.perf_counter()
@@ -1208,7 +1868,9 @@ def prep_ngen_data(conf):
         cp_cmd = f"cp {nwm_file} {metaf_path}"
         os.system(cp_cmd)
         if data_source == "forcings":
-            weights_df.to_parquet(os.path.join(metaf_path, "weights.parquet"))
+            if weights is None:
+                weights = load_cached_weights(weights_cache_dir, weights_key)
+            weights.to_parquet(os.path.join(metaf_path, "weights.parquet"))
 
     elif storage_type == "s3":
         bucket_path = output_path
@@ -1222,9 +1884,11 @@ def prep_ngen_data(conf):
         s3.put_object(Body=json.dumps(conf, indent=4), Bucket=bucket, Key=conf_path)
         s3.upload_file(nwm_file, bucket, filenamelist_path)
         if data_source == "forcings":
+            if weights is None:
+                weights = load_cached_weights(weights_cache_dir, weights_key)
             buf = BytesIO()
             filename = metaf_path + f"/weights.parquet"
-            weights_df.to_parquet(buf, index=False)
+            weights.to_parquet(buf)
             buf.seek(0)
             s3.put_object(
                 Bucket=bucket,
@@ -1273,27 +1937,37 @@ def prep_ngen_data(conf):
         else:
             print("Could not extract restart date and time")
 
-    # Determine the file system type based on the first NWM forcing file
-    global fs_type
-    if "s3://" in nwm_forcing_files[0] in nwm_forcing_files[0]:
-        fs = s3fs.S3FileSystem(anon=True, client_kwargs={"region_name": "us-east-1"})
-        fs_type = "s3"
-    elif (
-        "google" in nwm_forcing_files[0]
-        or "gs://" in nwm_forcing_files[0]
-        or "gcs://" in nwm_forcing_files[0]
-    ):
-        fs = "google"
-        fs_type = "google"
-    else:
-        fs = None
-        fs_type = None
 
     if ii_verbose:
         print(f"NWM file names:")
         for jfile in nwm_forcing_files:
             print(f"{jfile}")
 
+    global worker_pool, worker_pool_key, pool_stages, pool_startup
+    pool_reused = False
+    if data_source != "troute_restarts":
+        # the workers hold the operator this run regrids with, which also
+        # depends on multi_window and plotting, not only on the weights
+        pool_key = (nprocs, data_source, weights_op_hash)
+        if worker_pool and worker_pool_key != pool_key:
+            shutdown_worker_pool()
+        if worker_pool:
+            pool_reused = True
+            if ii_verbose:
+                print(f"Reusing {nprocs} resident worker processes", flush=True)
+        else:
+            worker_pool, pool_startup = start_worker_pool(
+                nprocs,
+                {"weights_op": weights_op if data_source == "forcings" else None},
+            )
+            worker_pool_key = pool_key
+            if ii_verbose:
+                print(
+                    f"Started {nprocs} worker processes in {pool_startup:.2f}s",
+                    flush=True,
+                )
+        pool_stages = 0
+
     log_time("PROCESSING_START", log_file)
     t0 = time.perf_counter()
     if ii_verbose:
@@ -1302,305 +1976,396 @@ def prep_ngen_data(conf):
     # data_array=data_array[0][None,:]
     # t_ax = t_ax
     # nwm_data=nwm_data[0][None,:]
-    if data_source == "forcings" or data_source == "channel_routing":
-        if data_source == "forcings":
-            data_array, t_ax, nwm_data, nwm_file_sizes_MB = multiprocess_data_extract(
-                nwm_forcing_files, nprocs, weights_df, fs
-            )
-        else:
-            data_array, t_ax, nwm_file_sizes_MB = multiprocess_chrt_extract(
-                nwm_forcing_files, nprocs, nwm_ngen_map, fs
-            )
-
-        if datetime.strptime(t_ax[0], "%Y-%m-%d %H:%M:%S") > datetime.strptime(
-            t_ax[-1], "%Y-%m-%d %H:%M:%S"
-        ):
-            # Hack to ensure data is always written out with time moving forward.
-            t_ax = list(reversed(t_ax))
-            data_array = np.flip(data_array, axis=0)
-            tmp = LEAD_START
-            LEAD_START = LEAD_END
-            LEAD_END = tmp
-
-        t_extract = time.perf_counter() - t0
-        complexity = (nfiles * ncatchments) / 10000
-        score = complexity / t_extract
-        if ii_verbose:
-            print(
-                f"Data extract processs: {nprocs:.2f}\nExtract time: {t_extract:.2f}\nComplexity: {complexity:.2f}\nScore: {score:.2f}\n",
-                end=None,
-                flush=True,
-            )
-
-    else:
-        nwm_file = nwm_forcing_files[0]
-        nwm_file_sizes_MB = []
-        if fs_type == "google":
-            fs_arg = gcsfs.GCSFileSystem()
-        elif fs_type == "s3":
-            fs_arg = s3fs.S3FileSystem(anon=True)
-        else:
-            fs_arg = None
-        if fs_arg:
-            if nwm_file.find("https://") >= 0:
-                _, bucket_key = convert_url2key(nwm_file, fs_type)
-            else:
-                bucket_key = nwm_file
-            file_obj = fs_arg.open(bucket_key, mode="rb")
-            nwm_file_sizes_MB.append(file_obj.details["size"])
-        elif "https://" in nwm_file:
-            response = requests.get(nwm_file, timeout=10)
-
-            if response.status_code == 200:
-                file_obj = BytesIO(response.content)
-            else:
-                raise RuntimeError(f"{nwm_file} does not exist")
-            nwm_file_sizes_MB.append(len(response.content) / B2MB)
-        else:
-            file_obj = nwm_file
-            nwm_file_sizes_MB.append(os.path.getsize(nwm_file) / B2MB)
-
-        nwm_ds = xr.open_dataset(file_obj).load()
-        data_array = create_restart(cat_map, crosswalk_ds, nwm_ds, routelink_ds)
-
-    log_time("PROCESSING_END", log_file)
-
-    log_time("FILEWRITING_START", log_file)
-    t0 = time.perf_counter()
-    if "netcdf" in output_file_type:
-        if data_source == "forcings":
-            netcdf_cat_file_sizes_MB = multiprocess_write_netcdf(
-                data_array, jcatchment_dict, t_ax
-            )
-        elif data_source == "channel_routing":
-            if FCST_CYCLE is None:
-                filename = "qlaterals.nc"
-            else:
-                filename = f"ngen.{FCST_CYCLE}z.{URLBASE}.channel_routing.{LEAD_START}_{LEAD_END}.nc"
-            netcdf_cat_file_sizes_MB = write_netcdf_chrt(
-                storage_type, forcing_path, data_array, t_ax, filename
-            )
-        else:
-            filename = (
-                "channel_restart_" + restart_date + "_" + restart_hour + "0000.nc"
-            )
-            netcdf_cat_file_sizes_MB = write_netcdf_restart(
-                storage_type, forcing_path, data_array, filename
-            )
-        # write_netcdf(data_array,"1", t_ax, jcatchment_dict['1'])
-    if ii_verbose:
-        print(f"Writing catchment forcings to {output_path}!", end=None, flush=True)
-    if (
-        ii_plot
-        or ii_collect_stats
-        or any(x in output_file_type for x in ["csv", "parquet", "tar"])
-    ):
-        if data_source == "forcings":
+    # the shared forcing array of a forcings run, freed whatever the stages
+    # after extraction do
+    data_shared = None
+    try:
+        if ii_stream:
             (
-                forcing_cat_ids,
-                filenames,
-                individual_cat_file_sizes_MB,
-                individual_cat_file_sizes_MB_zipped,
-                tar_buffs,
-            ) = multiprocess_write_df(
-                data_array,
                 t_ax,
-                list(weights_df.index),
-                nprocs,
-                forcing_path,
-                data_source,
-            )
-        elif data_source == "channel_routing":
-            (
+                nwm_file_sizes_MB,
+                netcdf_cat_file_sizes_MB,
                 forcing_cat_ids,
                 filenames,
                 individual_cat_file_sizes_MB,
                 individual_cat_file_sizes_MB_zipped,
-                tar_buffs,
-            ) = multiprocess_write_df(
-                data_array,
-                t_ax,
-                list(nwm_ngen_map.keys()),
-                nprocs,
-                forcing_path,
-                data_source,
+                precip_partials,
+                t_extract,
+                write_time,
+            ) = stream_forcings(
+                nwm_forcing_files,
+                time_window,
+                weights_op,
+                fs,
+                jcatchment_dict,
+                ii_collect_stats,
             )
+            data_array = None
+
+        elif data_source == "forcings" or data_source == "channel_routing":
+            if data_source == "forcings":
+                (
+                    data_array,
+                    t_ax,
+                    nwm_data,
+                    nwm_file_sizes_MB,
+                    data_shared,
+                ) = multiprocess_data_extract(nwm_forcing_files, nprocs, weights_op, fs)
+            else:
+                data_array, t_ax, nwm_file_sizes_MB = multiprocess_chrt_extract(
+                    nwm_forcing_files, nprocs, nwm_ngen_map, fs
+                )
+
+            if datetime.strptime(t_ax[0], "%Y-%m-%d %H:%M:%S") > datetime.strptime(
+                t_ax[-1], "%Y-%m-%d %H:%M:%S"
+            ):
+                # Hack to ensure data is always written out with time moving forward.
+                t_ax = list(reversed(t_ax))
+                if data_source == "forcings":
+                    # flip in place, writers read the shared array
+                    nt = len(t_ax)
+                    for j in range(nt // 2):
+                        data_array[[j, nt - 1 - j]] = data_array[[nt - 1 - j, j]]
+                else:
+                    data_array = np.flip(data_array, axis=0)
+                tmp = LEAD_START
+                LEAD_START = LEAD_END
+                LEAD_END = tmp
+
+            t_extract = time.perf_counter() - t0
+            complexity = (nfiles * ncatchments) / 10000
+            score = complexity / t_extract
+            if ii_verbose:
+                print(
+                    f"Data extract processs: {nprocs:.2f}\nExtract time: {t_extract:.2f}\nComplexity: {complexity:.2f}\nScore: {score:.2f}\n",
+                    end=None,
+                    flush=True,
+                )
+
         else:
-            print("Dataframes don't get written for t-route restarts")
+            nwm_file = nwm_forcing_files[0]
+            nwm_file_sizes_MB = []
+            if fs_type == "google":
+                fs_arg = gcsfs.GCSFileSystem()
+            elif fs_type == "s3":
+                fs_arg = s3fs.S3FileSystem(anon=True)
+            else:
+                fs_arg = None
+            if fs_arg:
+                if nwm_file.find("https://") >= 0:
+                    _, bucket_key = convert_url2key(nwm_file, fs_type)
+                else:
+                    bucket_key = nwm_file
+                file_obj = fs_arg.open(bucket_key, mode="rb")
+                nwm_file_sizes_MB.append(file_obj.details["size"])
+            elif "https://" in nwm_file:
+                response = http_get(nwm_file)
+
+                if response.status_code == 200:
+                    file_obj = BytesIO(response.content)
+                else:
+                    raise RuntimeError(f"{nwm_file} does not exist")
+                nwm_file_sizes_MB.append(len(response.content) / B2MB)
+            else:
+                file_obj = nwm_file
+                nwm_file_sizes_MB.append(os.path.getsize(nwm_file) / B2MB)
 
-    write_time += time.perf_counter() - t0
-    write_rate = ncatchments / write_time
-    if ii_verbose:
-        print(
-            f"\n\nWrite processs: {nprocs}\nWrite time: {write_time:.2f}\nWrite rate {write_rate:.2f} files/second\n",
-            end=None,
-            flush=True,
-        )
-    log_time("FILEWRITING_END", log_file)
+            nwm_ds = xr.open_dataset(file_obj).load()
+            data_array = create_restart(cat_map, crosswalk_ds, nwm_ds, routelink_ds)
 
-    runtime = time.perf_counter() - t_start
+        log_time("PROCESSING_END", log_file)
 
-    if ii_plot:
-        if len(gpkg_files) > 1:
-            raise Warning(f"Plotting only the first geopackage {gpkg_files[0]}")
-
-        cat_ids = ["cat-" + x for x in forcing_cat_ids]
-        jplot_vars = np.array(
-            [
-                x
-                for x in range(len(ngen_variables))
-                if ngen_variables[x] in ngen_vars_plot
-            ]
-        )
-        if storage_type == "s3":
-            gif_out = "./GIFs"
-        else:
-            gif_out = Path(meta_path, "GIFs")
-        plot_ngen_forcings(
-            nwm_data,
-            data_array[:, jplot_vars, :],
-            gpkg_files[0],
-            t_ax,
-            cat_ids,
-            ngen_vars_plot,
-            gif_out,
-        )
-        if storage_type == "s3":
-            sync_cmd = f"aws s3 sync ./GIFs {meta_path}/GIFs"
-            os.system(sync_cmd)
+        log_time("FILEWRITING_START", log_file)
+        t0 = time.perf_counter()
+        if "netcdf" in output_file_type and not ii_stream:
+            if data_source == "forcings":
+                netcdf_cat_file_sizes_MB = multiprocess_write_netcdf(
+                    data_shared, jcatchment_dict, t_ax
+                )
+            elif data_source == "channel_routing":
+                if FCST_CYCLE is None:
+                    filename = "qlaterals.nc"
+                else:
+                    filename = f"ngen.{FCST_CYCLE}z.{URLBASE}.channel_routing.{LEAD_START}_{LEAD_END}.nc"
+                netcdf_cat_file_sizes_MB = write_netcdf_chrt(
+                    storage_type, forcing_path, data_array, t_ax, filename
+                )
+            else:
+                filename = (
+                    "channel_restart_" + restart_date + "_" + restart_hour + "0000.nc"
+                )
+                netcdf_cat_file_sizes_MB = write_netcdf_restart(
+                    storage_type, forcing_path, data_array, filename
+                )
+            # write_netcdf(data_array,"1", t_ax, jcatchment_dict['1'])
+        if ii_verbose:
+            print(f"Writing catchment forcings to {output_path}!", end=None, flush=True)
+        if not ii_stream and (
+            ii_plot
+            or ii_collect_stats
+            or any(x in output_file_type for x in ["csv", "parquet", "tar"])
+        ):
+            if data_source == "forcings":
+                (
+                    forcing_cat_ids,
+                    filenames,
+                    individual_cat_file_sizes_MB,
+                    individual_cat_file_sizes_MB_zipped,
+                    tar_buffs,
+                ) = multiprocess_write_df(
+                    data_shared,
+                    t_ax,
+                    weights_op.catchments,
+                    nprocs,
+                    forcing_path,
+                    data_source,
+                )
+            elif data_source == "channel_routing":
+                (
+                    forcing_cat_ids,
+                    filenames,
+                    individual_cat_file_sizes_MB,
+                    individual_cat_file_sizes_MB_zipped,
+                    tar_buffs,
+                ) = multiprocess_write_df(
+                    data_array,
+                    t_ax,
+                    list(nwm_ngen_map.keys()),
+                    nprocs,
+                    forcing_path,
+                    data_source,
+                )
+            else:
+                print("Dataframes don't get written for t-route restarts")
 
-    # Metadata
-    if ii_collect_stats:
-        log_time("METADATA_START", log_file)
-        t000 = time.perf_counter()
+        write_time += time.perf_counter() - t0
+        write_rate = ncatchments / write_time
         if ii_verbose:
-            print(f"Data processing, now calculating metadata...", flush=True)
-
-        nwm_file_size_avg = np.average(nwm_file_sizes_MB)
-        nwm_file_size_med = np.median(nwm_file_sizes_MB)
-        nwm_file_size_std = np.std(nwm_file_sizes_MB)
-
-        individual_catch_file_size_avg = 0
-        individual_catch_file_size_med = 0
-        individual_catch_file_size_std = 0
-        individual_catch_file_zip_size_avg = 0
-        individual_catch_file_zip_size_med = 0
-        individual_catch_file_zip_size_std = 0
-        if "csv" in output_file_type or "parquet" in output_file_type:
-            individual_catch_file_size_avg = np.average(
-                np.fromiter(individual_cat_file_sizes_MB, dtype=float)
+            print(
+                f"\n\nWrite processs: {nprocs}\nWrite time: {write_time:.2f}\nWrite rate {write_rate:.2f} files/second\n",
+                end=None,
+                flush=True,
             )
-            individual_catch_file_size_med = np.median(individual_cat_file_sizes_MB)
-            individual_catch_file_size_std = np.std(individual_cat_file_sizes_MB)
+        log_time("FILEWRITING_END", log_file)
 
-            individual_catch_file_zip_size_avg = np.average(
-                individual_cat_file_sizes_MB_zipped
-            )
-            individual_catch_file_zip_size_med = np.median(
-                individual_cat_file_sizes_MB_zipped
-            )
-            individual_catch_file_zip_size_std = np.std(
-                individual_cat_file_sizes_MB_zipped
-            )
+        runtime = time.perf_counter() - t_start
 
-        netcdf_catch_file_size_avg = 0
-        netcdf_catch_file_size_med = 0
-        netcdf_catch_file_size_std = 0
-        if "netcdf" in output_file_type:
-            netcdf_catch_file_size_avg = np.average(
-                np.fromiter(netcdf_cat_file_sizes_MB, dtype=float)
+        if ii_plot:
+            if len(gpkg_files) > 1:
+                raise Warning(f"Plotting only the first geopackage {gpkg_files[0]}")
+
+            cat_ids = ["cat-" + x for x in forcing_cat_ids]
+            jplot_vars = np.array(
+                [
+                    x
+                    for x in range(len(ngen_variables))
+                    if ngen_variables[x] in ngen_vars_plot
+                ]
             )
-            netcdf_catch_file_size_med = np.median(netcdf_cat_file_sizes_MB)
-            netcdf_catch_file_size_std = np.std(netcdf_cat_file_sizes_MB)
+            if storage_type == "s3":
+                gif_out = "./GIFs"
+            else:
+                gif_out = Path(meta_path, "GIFs")
+            plot_ngen_forcings(
+                nwm_data,
+                data_array[:, jplot_vars, :],
+                gpkg_files[0],
+                t_ax,
+                cat_ids,
+                ngen_vars_plot,
+                gif_out,
+            )
+            if storage_type == "s3":
+                sync_cmd = f"aws s3 sync ./GIFs {meta_path}/GIFs"
+                os.system(sync_cmd)
 
-        if data_source == "forcings":
-            metadata = {
-                "runtime_s": [round(runtime, 2)],
-                "nvars_intput": [len(nwm_variables)],
-                "nwmfiles_input": [len(nwm_forcing_files)],
-                "nwm_file_size_avg_MB": [nwm_file_size_avg],
-                "nwm_file_size_med_MB": [nwm_file_size_med],
-                "nwm_file_size_std_MB": [nwm_file_size_std],
-                "catch_files_output": [nfiles],
-                "nvars_output": [len(ngen_variables)],
-                "individual_catch_file_size_avg_MB": [individual_catch_file_size_avg],
-                "individual_catch_file_size_med_MB": [individual_catch_file_size_med],
-                "individual_catch_file_size_std_MB": [individual_catch_file_size_std],
-                "individual_catch_file_zip_size_avg_MB": [
-                    individual_catch_file_zip_size_avg
-                ],
-                "individual_catch_file_zip_size_med_MB": [
-                    individual_catch_file_zip_size_med
-                ],
-                "individual_catch_file_zip_size_std_MB": [
-                    individual_catch_file_zip_size_std
-                ],
-                "netcdf_catch_file_size_avg_MB": [netcdf_catch_file_size_avg],
-                "netcdf_catch_file_size_med_MB": [netcdf_catch_file_size_med],
-                "netcdf_catch_file_size_std_MB": [netcdf_catch_file_size_std],
-            }
-        elif data_source == "channel_routing":
-            metadata = {
-                "runtime_s": [round(runtime, 2)],
-                "nvars_intput": [1],
-                "nwmfiles_input": [len(nwm_forcing_files)],
-                "nwm_file_size_avg_MB": [nwm_file_size_avg],
-                "nwm_file_size_med_MB": [nwm_file_size_med],
-                "nwm_file_size_std_MB": [nwm_file_size_std],
-                "catch_files_output": [nfiles],
-                "nvars_output": [1],
-                "individual_catch_file_size_avg_MB": [individual_catch_file_size_avg],
-                "individual_catch_file_size_med_MB": [individual_catch_file_size_med],
-                "individual_catch_file_size_std_MB": [individual_catch_file_size_std],
-                "individual_catch_file_zip_size_avg_MB": [
-                    individual_catch_file_zip_size_avg
-                ],
-                "individual_catch_file_zip_size_med_MB": [
-                    individual_catch_file_zip_size_med
-                ],
-                "individual_catch_file_zip_size_std_MB": [
-                    individual_catch_file_zip_size_std
-                ],
-                "netcdf_catch_file_size_avg_MB": [netcdf_catch_file_size_avg],
-                "netcdf_catch_file_size_med_MB": [netcdf_catch_file_size_med],
-                "netcdf_catch_file_size_std_MB": [netcdf_catch_file_size_std],
-            }
-        else:
-            # metadata for troute restart gen
-            metadata = {
-                "runtime_s": [round(runtime, 2)],
-                "nwmfiles_input": [len(nwm_forcing_files)],
-                "nwm_file_size": [nwm_file_size_avg],
-                "netcdf_catch_file_size_MB": [netcdf_catch_file_size_avg],
-            }
+        if "tar" in output_file_type:
+            log_time("TAR_START", log_file)
+            if ii_verbose:
+                print(f"\nWriting tarball...", flush=True)
+            t0000 = time.perf_counter()
+            if data_source == "channel_routing":
+                jcatchment_dict = {
+                    1: list(nwm_ngen_map.keys())
+                }  # not really the most efficient way to
+                # do this tbh
+            if data_source == "forcings":
+                tar_file_sizes_MB = multiprocess_write_tar(
+                    jcatchment_dict, filenames, tar_buffs, data_shared, t_ax
+                )
+            else:
+                tar_file_sizes_MB = multiprocess_write_tar(
+                    jcatchment_dict, filenames, tar_buffs
+                )
+            tar_time = time.perf_counter() - t0000
+            log_time("TAR_END", log_file)
 
-        if data_source == "forcings":
+        # Metadata
+        if ii_collect_stats:
+            log_time("METADATA_START", log_file)
+            t000 = time.perf_counter()
+            if ii_verbose:
+                print(f"Data processing, now calculating metadata...", flush=True)
+
+            nwm_file_size_avg = np.average(nwm_file_sizes_MB)
+            nwm_file_size_med = np.median(nwm_file_sizes_MB)
+            nwm_file_size_std = np.std(nwm_file_sizes_MB)
+
+            individual_catch_file_size_avg = 0
+            individual_catch_file_size_med = 0
+            individual_catch_file_size_std = 0
+            individual_catch_file_zip_size_avg = 0
+            individual_catch_file_zip_size_med = 0
+            individual_catch_file_zip_size_std = 0
+            if "csv" in output_file_type or "parquet" in output_file_type:
+                individual_catch_file_size_avg = np.average(
+                    np.fromiter(individual_cat_file_sizes_MB, dtype=float)
+                )
+                individual_catch_file_size_med = np.median(individual_cat_file_sizes_MB)
+                individual_catch_file_size_std = np.std(individual_cat_file_sizes_MB)
 
-            vpu_precip_df = calculate_vpu_precip_stats(
-                data_array,
-                list(weights_df.index),
-                jcatchment_dict,
-            )
+                individual_catch_file_zip_size_avg = np.average(
+                    individual_cat_file_sizes_MB_zipped
+                )
+                individual_catch_file_zip_size_med = np.median(
+                    individual_cat_file_sizes_MB_zipped
+                )
+                individual_catch_file_zip_size_std = np.std(
+                    individual_cat_file_sizes_MB_zipped
+                )
 
-        del data_array
+            tar_file_size_avg = 0
+            tar_file_size_med = 0
+            tar_file_size_std = 0
+            if "tar" in output_file_type:
+                tar_file_size_avg = np.average(tar_file_sizes_MB)
+                tar_file_size_med = np.median(tar_file_sizes_MB)
+                tar_file_size_std = np.std(tar_file_sizes_MB)
+
+            netcdf_catch_file_size_avg = 0
+            netcdf_catch_file_size_med = 0
+            netcdf_catch_file_size_std = 0
+            if "netcdf" in output_file_type:
+                netcdf_catch_file_size_avg = np.average(
+                    np.fromiter(netcdf_cat_file_sizes_MB, dtype=float)
+                )
+                netcdf_catch_file_size_med = np.median(netcdf_cat_file_sizes_MB)
+                netcdf_catch_file_size_std = np.std(netcdf_cat_file_sizes_MB)
+
+            if data_source == "forcings":
+                metadata = {
+                    "runtime_s": [round(runtime, 2)],
+                    "nvars_intput": [len(variable_plan(ngen_variables)[0])],
+                    "nwmfiles_input": [len(nwm_forcing_files)],
+                    "nwm_file_size_avg_MB": [nwm_file_size_avg],
+                    "nwm_file_size_med_MB": [nwm_file_size_med],
+                    "nwm_file_size_std_MB": [nwm_file_size_std],
+                    "catch_files_output": [nfiles],
+                    "nvars_output": [len(ngen_variables)],
+                    "individual_catch_file_size_avg_MB": [individual_catch_file_size_avg],
+                    "individual_catch_file_size_med_MB": [individual_catch_file_size_med],
+                    "individual_catch_file_size_std_MB": [individual_catch_file_size_std],
+                    "individual_catch_file_zip_size_avg_MB": [
+                        individual_catch_file_zip_size_avg
+                    ],
+                    "individual_catch_file_zip_size_med_MB": [
+                        individual_catch_file_zip_size_med
+                    ],
+                    "individual_catch_file_zip_size_std_MB": [
+                        individual_catch_file_zip_size_std
+                    ],
+                    "netcdf_catch_file_size_avg_MB": [netcdf_catch_file_size_avg],
+                    "netcdf_catch_file_size_med_MB": [netcdf_catch_file_size_med],
+                    "netcdf_catch_file_size_std_MB": [netcdf_catch_file_size_std],
+                    "tar_file_size_avg_MB": [tar_file_size_avg],
+                    "tar_file_size_med_MB": [tar_file_size_med],
+                    "tar_file_size_std_MB": [tar_file_size_std],
+                }
+            elif data_source == "channel_routing":
+                metadata = {
+                    "runtime_s": [round(runtime, 2)],
+                    "nvars_intput": [1],
+                    "nwmfiles_input": [len(nwm_forcing_files)],
+                    "nwm_file_size_avg_MB": [nwm_file_size_avg],
+                    "nwm_file_size_med_MB": [nwm_file_size_med],
+                    "nwm_file_size_std_MB": [nwm_file_size_std],
+                    "catch_files_output": [nfiles],
+                    "nvars_output": [1],
+                    "individual_catch_file_size_avg_MB": [individual_catch_file_size_avg],
+                    "individual_catch_file_size_med_MB": [individual_catch_file_size_med],
+                    "individual_catch_file_size_std_MB": [individual_catch_file_size_std],
+                    "individual_catch_file_zip_size_avg_MB": [
+                        individual_catch_file_zip_size_avg
+                    ],
+                    "individual_catch_file_zip_size_med_MB": [
+                        individual_catch_file_zip_size_med
+                    ],
+                    "individual_catch_file_zip_size_std_MB": [
+                        individual_catch_file_zip_size_std
+                    ],
+                    "netcdf_catch_file_size_avg_MB": [netcdf_catch_file_size_avg],
+                    "netcdf_catch_file_size_med_MB": [netcdf_catch_file_size_med],
+                    "netcdf_catch_file_size_std_MB": [netcdf_catch_file_size_std],
+                    "tar_file_size_avg_MB": [tar_file_size_avg],
+                    "tar_file_size_med_MB": [tar_file_size_med],
+                    "tar_file_size_std_MB": [tar_file_size_std],
+                }
+            else:
+                # metadata for troute restart gen
+                metadata = {
+                    "runtime_s": [round(runtime, 2)],
+                    "nwmfiles_input": [len(nwm_forcing_files)],
+                    "nwm_file_size": [nwm_file_size_avg],
+                    "netcdf_catch_file_size_MB": [netcdf_catch_file_size_avg],
+                }
+
+            if nwm_cache:
+                metadata["nwm_cache_hits"] = [nwm_cache_counts[0]]
+                metadata["nwm_cache_misses"] = [nwm_cache_counts[1]]
+            if regrid_cache:
+                metadata["regrid_cache_hits"] = [regrid_cache_counts[0]]
+                metadata["regrid_cache_misses"] = [regrid_cache_counts[1]]
+
+            if ii_stream:
+                vpu_precip_df = vpu_precip_stats_df(precip_partials)
+            elif data_source == "forcings":
+
+                vpu_precip_df = calculate_vpu_precip_stats(
+                    data_array,
+                    weights_op.catchments,
+                    jcatchment_dict,
+                )
 
-        metadata_df = pd.DataFrame.from_dict(metadata)
-        meta_key = None
-        meta_bucket = None
-        local_metapath = None
-        if storage_type == "s3":
-            bucket, key = convert_url2key(output_path, storage_type)
-            meta_path = f"{key}/metadata/forcings_metadata/"
-            meta_key = meta_path
-            meta_bucket = bucket
-        else:
-            local_metapath = metaf_path
+            del data_array
+
+            metadata_df = pd.DataFrame.from_dict(metadata)
+            meta_key = None
+            meta_bucket = None
+            local_metapath = None
+            if storage_type == "s3":
+                bucket, key = convert_url2key(output_path, storage_type)
+                meta_path = f"{key}/metadata/forcings_metadata/"
+                meta_key = meta_path
+                meta_bucket = bucket
+            else:
+                local_metapath = metaf_path
+
+            if data_source == "forcings":
+                # Issue 9: write compact VPU-level precipitation statistics.
+                write_df(
+                    vpu_precip_df,
+                    "metadata_by_vpu.csv",
+                    storage_type,
+                    data_source_arg="na",
+                    local_path=local_metapath,
+                    key_prefix=meta_key,
+                    bucket=meta_bucket,
+                    client=s3,
+                )
 
-        if data_source == "forcings":
-            # Issue 9: write compact VPU-level precipitation statistics.
             write_df(
-                vpu_precip_df,
-                "metadata_by_vpu.csv",
+                metadata_df,
+                "metadata.csv",
                 storage_type,
                 data_source_arg="na",
                 local_path=local_metapath,
@@ -1609,33 +2374,16 @@ def prep_ngen_data(conf):
                 client=s3,
             )
 
-        write_df(
-            metadata_df,
-            "metadata.csv",
-            storage_type,
-            data_source_arg="na",
-            local_path=local_metapath,
-            key_prefix=meta_key,
-            bucket=meta_bucket,
-            client=s3,
-        )
-
-        meta_time = time.perf_counter() - t000
-        log_time("METADATA_END", log_file)
-
-    if "tar" in output_file_type:
-        log_time("TAR_START", log_file)
-        if ii_verbose:
-            print(f"\nWriting tarball...", flush=True)
-        t0000 = time.perf_counter()
-        if data_source == "channel_routing":
-            jcatchment_dict = {
-                1: list(nwm_ngen_map.keys())
-            }  # not really the most efficient way to
-            # do this tbh
-        multiprocess_write_tar(jcatchment_dict, filenames, tar_buffs)
-        tar_time = time.perf_counter() - t0000
-        log_time("TAR_END", log_file)
+            meta_time = time.perf_counter() - t000
+            log_time("METADATA_END", log_file)
+    except BaseException:
+        if not keep_resident:
+            shutdown_worker_pool()
+        raise
+    finally:
+        if data_shared is not None:
+            data_array = None
+            data_shared.unlink()
 
     if ii_verbose:
         print(f"\n\n--------SUMMARY-------")
@@ -1651,7 +2399,22 @@ def prep_ngen_data(conf):
             runtime += tar_time
             msg += f"\nWrite tar     : {tar_time:.2f}s"
         msg += f"\nRuntime       : {runtime:.2f}s\n"
+        http_summary = format_http_stats()
+        if http_summary:
+            msg += f"\nHTTP connections (primary process)\n{http_summary}\n"
         print(msg)
+    if worker_pool:
+        # every stage but the first would otherwise have started its own
+        # pool, and none of them when a resident pool was reused
+        nsaved = pool_stages if pool_reused else max(pool_stages - 1, 0)
+        with open(log_file, "a") as f:
+            f.write(
+                f"WORKER_POOL: startup {pool_startup:.2f}s, "
+                f"{'resident, ' if pool_reused else ''}{pool_stages} stages, "
+                f"{nsaved * pool_startup:.2f}s startup saved\n"
+            )
+        if not keep_resident:
+            shutdown_worker_pool()
     log_time("FORCINGPROCESSOR_END", log_file)
 
     if storage_type == "s3":
@@ -0,0 +1,659 @@
+"""Tools to regrid windowed NWM forcing grids onto NextGen catchments with a
+precompiled sparse weights operator."""
+
+import hashlib
+import json
+import os
+import tempfile
+import zipfile
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import scipy.sparse as sp
+from forcingprocessor.io_tools import remote_version
+
+NX = 4608
+NY = 3840
+WEIGHTS_CACHE_VERSION = 2
+# weights reduced at a time by WeightsOperator.apply, for each variable
+REGRID_BLOCK_ENTRIES = 1 << 18
+
+
+def _indptr(counts) -> np.ndarray:
+    indptr = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    return indptr
+
+
+def _row_groups(indptr: np.ndarray, block: int) -> list:
+    """
+    Rows of a CSR layout grouped by their number of entries, in blocks of
+    about `block` entries. Each group is (rows, pos), pos[i] holding the
+    positions of the entries of rows[i], so the entries of a group gather into
+    a C-contiguous (rows, n) array.
+    """
+    counts = np.diff(indptr)
+    order = np.argsort(counts, kind="stable")
+    groups = []
+    for rows in np.split(order, np.flatnonzero(np.diff(counts[order])) + 1):
+        if len(rows) == 0:
+            continue
+        n = int(counts[rows[0]])
+        step = max(1, block // max(n, 1))
+        for start in range(0, len(rows), step):
+            jrows = rows[start : start + step]
+            groups.append((jrows, indptr[jrows][:, None] + np.arange(n)))
+    return groups
+
+
+def _concatenate(arrays: list, dtype) -> np.ndarray:
+    if len(arrays) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.concatenate(arrays).astype(dtype, copy=False)
+
+
+class WeightsTable:
+    """
+    Datastream weights in flat arrays, laid out like a CSR matrix: the cells
+    of catchment j are cell_id[indptr[j] : indptr[j + 1]], with the coverage
+    at the same positions.
+
+    As parquet these are a divide_id column and list columns of cell_id and
+    coverage, whose offsets and values are indptr, cell_id and coverage
+    themselves, so reading or writing a table does no per-catchment work.
+
+    Attributes:
+        catchments (np.ndarray): catchment ids, in row order
+        indptr (np.ndarray): int64 offsets of each catchment's cells, len(catchments) + 1
+        cell_id (np.ndarray): int64 cell ids on the full NWM grid
+        coverage (np.ndarray): float64 coverage fraction of each cell
+        geometry_hash (np.ndarray): hash of each catchment's geometry, None if unknown
+    """
+
+    def __init__(self, catchments, indptr, cell_id, coverage, geometry_hash=None):
+        self.catchments = np.asarray(catchments, dtype=object)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.cell_id = np.asarray(cell_id, dtype=np.int64)
+        self.coverage = np.asarray(coverage, dtype=np.float64)
+        self.geometry_hash = (
+            None if geometry_hash is None else np.asarray(geometry_hash, dtype=object)
+        )
+
+    def __len__(self):
+        return len(self.catchments)
+
+    @property
+    def counts(self) -> np.ndarray:
+        """Number of cells of each catchment"""
+        return np.diff(self.indptr)
+
+    @classmethod
+    def from_lists(cls, catchments, cell_id, coverage, geometry_hash=None):
+        """
+        Table from per-catchment sequences of cell ids and coverage, as held by
+        weights json files and exactextract output.
+        """
+        cell_id = [np.asarray(x, dtype=np.int64) for x in cell_id]
+        coverage = [np.asarray(x, dtype=np.float64) for x in coverage]
+        counts = np.fromiter((len(x) for x in cell_id), dtype=np.int64, count=len(cell_id))
+        return cls(
+            list(catchments),
+            _indptr(counts),
+            _concatenate(cell_id, np.int64),
+            _concatenate(coverage, np.float64),
+            geometry_hash,
+        )
+
+    @classmethod
+    def from_dataframe(cls, weights_df: pd.DataFrame):
+        """
+        Table from a weights dataframe indexed by catchment id, with columns of
+        cell_id and coverage lists.
+        """
+        return cls.from_lists(
+            weights_df.index,
+            weights_df["cell_id"],
+            weights_df["coverage"],
+            weights_df["geometry_hash"] if "geometry_hash" in weights_df else None,
+        )
+
+    @classmethod
+    def from_long(cls, divide_id, cell, coverage):
+        """
+        Table from a long table with one row per catchment and cell, as in the
+        hydrofabric forcing-weights layer. Catchments are sorted by id and
+        keep the order of their cells.
+        """
+        inverse, catchments = pd.factorize(np.asarray(divide_id), sort=True)
+        order = np.argsort(inverse, kind="stable")
+        counts = np.bincount(inverse, minlength=len(catchments))
+        return cls(
+            catchments,
+            _indptr(counts),
+            np.asarray(cell)[order].astype(np.int64),
+            np.asarray(coverage)[order].astype(np.float64),
+        )
+
+    @classmethod
+    def from_arrow(cls, table: pa.Table):
+        """
+        Table from an arrow table with divide_id (or a pandas index) and cell_id
+        and coverage list columns. The list offsets and values are used as they are, only cast
+        when their type differs.
+        """
+        id_column = "divide_id"
+        if id_column not in table.column_names:
+            # weights dataframes written by pandas with an unnamed index
+            index_columns = (table.schema.pandas_metadata or {}).get("index_columns", [])
+            if len(index_columns) != 1 or not isinstance(index_columns[0], str):
+                raise ValueError("Weights table has no divide_id column")
+            id_column = index_columns[0]
+        flat = {}
+        for jcol in ("cell_id", "coverage"):
+            array = table.column(jcol).combine_chunks()
+            offsets = array.offsets.to_numpy()
+            values = array.values.to_numpy(zero_copy_only=False)
+            flat[jcol] = (offsets - offsets[0], values[offsets[0] : offsets[-1]])
+        indptr, cell_id = flat["cell_id"]
+        if not np.array_equal(indptr, flat["coverage"][0]):
+            raise ValueError("cell_id and coverage differ in length")
+        geometry_hash = None
+        if "geometry_hash" in table.column_names:
+            geometry_hash = table.column("geometry_hash").to_numpy(zero_copy_only=False)
+        return cls(
+            table.column(id_column).to_numpy(zero_copy_only=False),
+            indptr,
+            cell_id,
+            flat["coverage"][1],
+            geometry_hash,
+        )
+
+    @classmethod
+    def read_parquet(cls, source):
+        """
+        Table from a weights parquet, in the list layout written by
+        to_parquet or the long layout of the hydrofabric forcing-weights.
+        """
+        table = pq.read_table(source)
+        if "cell" in table.column_names:
+            return cls.from_long(
+                table.column("divide_id").to_numpy(zero_copy_only=False),
+                table.column("cell").to_numpy(),
+                table.column("coverage_fraction").to_numpy(),
+            )
+        return cls.from_arrow(table)
+
+    def to_arrow(self) -> pa.Table:
+        if self.indptr[-1] < np.iinfo(np.int32).max:
+            offsets = pa.array(self.indptr.astype(np.int32))
+            list_array = pa.ListArray
+        else:
+            offsets = pa.array(self.indptr)
+            list_array = pa.LargeListArray
+        columns = {
+            "divide_id": pa.array(self.catchments, type=pa.string()),
+            "cell_id": list_array.from_arrays(offsets, pa.array(self.cell_id)),
+            "coverage": list_array.from_arrays(offsets, pa.array(self.coverage)),
+        }
+        if self.geometry_hash is not None:
+            columns["geometry_hash"] = pa.array(self.geometry_hash, type=pa.string())
+        table = pa.table(columns)
+        return table.replace_schema_metadata({b"pandas": _pandas_metadata(table)})
+
+    def to_parquet(self, where):
+        pq.write_table(self.to_arrow(), where)
+
+    def rows(self, catchments) -> np.ndarray:
+        """Row of each of the catchments, -1 for those not in the table"""
+        return pd.Index(self.catchments).get_indexer(catchments)
+
+    def take(self, rows):
+        """Table of the catchments at rows, in that order"""
+        rows = np.asarray(rows, dtype=np.int64)
+        counts = self.counts[rows]
+        indptr = _indptr(counts)
+        cells = np.repeat(self.indptr[rows] - indptr[:-1], counts) + np.arange(
+            indptr[-1]
+        )
+        return WeightsTable(
+            self.catchments[rows],
+            indptr,
+            self.cell_id[cells],
+            self.coverage[cells],
+            None if self.geometry_hash is None else self.geometry_hash[rows],
+        )
+
+    @classmethod
+    def concat(cls, tables: list):
+        """Tables one after another"""
+        geometry_hash = None
+        if all(x.geometry_hash is not None for x in tables):
+            geometry_hash = _concatenate([x.geometry_hash for x in tables], object)
+        return cls(
+            _concatenate([x.catchments for x in tables], object),
+            _indptr(_concatenate([x.counts for x in tables], np.int64)),
+            _concatenate([x.cell_id for x in tables], np.int64),
+            _concatenate([x.coverage for x in tables], np.float64),
+            geometry_hash,
+        )
+
+
+class WeightsOperator:
+    """
+    Sparse regridding operator built once from datastream weights.
+
+    Each row of ``matrix`` is a catchment (in weights order) and each column
+    is a cell of the flattened NWM window, laid out exactly like
+    ``data_allvars.reshape(nvar, dx * dy)`` in forcing_grid2catchment. The
+    matrix holds the raw coverage and each row is divided by the catchment's
+    total coverage after the weighted sum, like the per-catchment loop
+    ``np.sum(coverage * x) / np.sum(coverage)`` did.
+
+    Attributes:
+        matrix (scipy.sparse.csr_array): (ncatchment x dx * dy) coverage
+        weight_sum (np.ndarray): total coverage of each catchment
+        catchments (list): catchment ids, in row order
+        window (tuple): x_min, x_max, y_min, y_max of the NWM grid window
+    """
+
+    def __init__(
+        self,
+        matrix: sp.csr_array,
+        catchments: list,
+        window: tuple,
+        weight_sum: np.ndarray = None,
+    ):
+        self.matrix = matrix
+        self.catchments = catchments
+        self.window = tuple(int(x) for x in window)
+        if weight_sum is None:
+            weight_sum = np.zeros(matrix.shape[0], dtype=matrix.dtype)
+            for rows, pos in _row_groups(matrix.indptr, REGRID_BLOCK_ENTRIES):
+                weight_sum[rows] = matrix.data[pos].sum(axis=1)
+        self.weight_sum = np.asarray(weight_sum, dtype=matrix.dtype)
+        self._groups = None
+
+    @property
+    def dx(self) -> int:
+        return self.window[1] - self.window[0] + 1
+
+    @property
+    def dy(self) -> int:
+        return self.window[3] - self.window[2] + 1
+
+    @property
+    def ncatchments(self) -> int:
+        return self.matrix.shape[0]
+
+    def __len__(self):
+        return self.ncatchments
+
+    @classmethod
+    def from_weights(
+        cls,
+        weights: WeightsTable,
+        window: tuple,
+        nx: int = NX,
+        ny: int = NY,
+    ):
+        """
+        Build the operator from datastream weights.
+
+        Parameters:
+            weights (WeightsTable): cells and coverage of each catchment
+            window (tuple): x_min, x_max, y_min, y_max as returned by get_window
+            nx (int): number of cells in the west_east direction of the full NWM grid
+            ny (int): number of cells in the south_north direction of the full NWM grid
+
+        Returns:
+            WeightsOperator
+        """
+        x_min, x_max, y_min, y_max = window
+        dx = x_max - x_min + 1
+        dy = y_max - y_min + 1
+
+        weights_dx, weights_dy = np.unravel_index(weights.cell_id, (nx, ny), order="F")
+        indices = np.ravel_multi_index(
+            (weights_dx - x_min, weights_dy - y_min), (dx, dy), order="F"
+        )
+
+        matrix = sp.csr_array(
+            (weights.coverage, indices, weights.indptr), shape=(len(weights), dx * dy)
+        )
+        return cls(matrix, list(weights.catchments), (x_min, x_max, y_min, y_max))
+
+    @classmethod
+    def from_weights_df(
+        cls,
+        weights_df: pd.DataFrame,
+        window: tuple,
+        nx: int = NX,
+        ny: int = NY,
+    ):
+        """
+        Build the operator from a weights dataframe, index is catchment ids,
+        columns are cell_id and coverage lists.
+        """
+        return cls.from_weights(WeightsTable.from_dataframe(weights_df), window, nx, ny)
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.matrix.dtype
+
+    def astype(self, dtype):
+        """
+        Operator with its weights cast to dtype. Applied to a grid of the same
+        dtype, the regridding accumulates in that precision.
+        """
+        if np.dtype(dtype) == self.dtype:
+            return self
+        return WeightsOperator(
+            self.matrix.astype(dtype),
+            self.catchments,
+            self.window,
+            self.weight_sum.astype(dtype),
+        )
+
+    def subset(self, rows, window: tuple):
+        """
+        Operator for the catchments at rows, on a window of the NWM grid that
+        holds all of their cells. Weights and their order within each row are
+        kept, only the columns move to the new window's layout, so the
+        catchment values are the same bit for bit.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        matrix = self.matrix[rows]
+        x_min, x_max, y_min, y_max = (int(x) for x in window)
+        indices = matrix.indices.astype(np.int64)
+        x = indices % self.dx + self.window[0] - x_min
+        y = indices // self.dx + self.window[2] - y_min
+        dx = x_max - x_min + 1
+        dy = y_max - y_min + 1
+        sub = sp.csr_array(
+            (matrix.data, x + dx * y, matrix.indptr), shape=(len(rows), dx * dy)
+        )
+        return WeightsOperator(
+            sub,
+            [self.catchments[x] for x in rows],
+            (x_min, x_max, y_min, y_max),
+            self.weight_sum[rows],
+        )
+
+    def apply(self, data_allvars: np.ndarray) -> np.ndarray:
+        """
+        Regrid every variable of a windowed grid onto the catchments.
+
+        Parameters:
+            data_allvars (np.ndarray): (nvar, dy, dx) or (nvar, dx * dy) windowed grid
+
+        Returns:
+            np.ndarray: (nvar, ncatchment) catchment averaged values, in the
+            common dtype of the grid and the weights
+
+        Catchments with the same number of cells are reduced together with
+        np.sum over contiguous rows, the summation order of the per-catchment
+        loop, so float64 values are the same bit for bit.
+        """
+        nvar = data_allvars.shape[0]
+        grid = data_allvars.reshape(nvar, -1)
+        dtype = np.result_type(grid.dtype, self.dtype)
+        if self._groups is None:
+            self._groups = [
+                (rows, self.matrix.indices[pos], self.matrix.data[pos].astype(dtype))
+                for rows, pos in _row_groups(self.matrix.indptr, REGRID_BLOCK_ENTRIES)
+            ]
+        out = np.empty((nvar, len(self)), dtype=dtype)
+        for rows, indices, coverage in self._groups:
+            values = np.take(grid, indices, axis=1).astype(dtype, copy=False)
+            values *= coverage
+            out[:, rows] = values.sum(axis=2)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            out /= self.weight_sum
+        return out
+
+
+class WindowedOperator:
+    """
+    Regridding operator split over several windows of the NWM grid, for
+    catchment groups (VPUs) far apart on it. Each part regrids its own window
+    onto its rows of the output, so the grid between the groups is never read.
+
+    Attributes:
+        parts (list): (WeightsOperator, rows) of each window, rows index the output
+        catchments (list): catchment ids, in output order
+    """
+
+    def __init__(self, parts: list, catchments: list):
+        self.parts = parts
+        self.catchments = catchments
+
+    @classmethod
+    def split(cls, weights_op: WeightsOperator, windows: list, rows: list):
+        """
+        Split an operator into one part per window.
+
+        Parameters:
+            weights_op (WeightsOperator): operator over the hull of the windows
+            windows (list): x_min, x_max, y_min, y_max of each window
+            rows (list): rows of weights_op regridded from each window
+        """
+        parts = [
+            (weights_op.subset(jrows, jwindow), np.asarray(jrows, dtype=np.int64))
+            for jwindow, jrows in zip(windows, rows)
+        ]
+        return cls(parts, weights_op.catchments)
+
+    @property
+    def windows(self) -> list:
+        return [x.window for x, _ in self.parts]
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.parts[0][0].dtype
+
+    @property
+    def ncatchments(self) -> int:
+        return len(self.catchments)
+
+    def __len__(self):
+        return self.ncatchments
+
+    def astype(self, dtype):
+        if np.dtype(dtype) == self.dtype:
+            return self
+        return WindowedOperator(
+            [(x.astype(dtype), rows) for x, rows in self.parts], self.catchments
+        )
+
+
+def _pandas_metadata(table: pa.Table) -> bytes:
+    """
+    Pandas metadata of a weights table, divide_id as the index, so
+    ``pd.read_parquet`` gives the divide_id indexed frame weights parquets
+    always held.
+    """
+    columns = []
+    for field in table.schema:
+        if pa.types.is_list(field.type) or pa.types.is_large_list(field.type):
+            pandas_type = f"list[{field.type.value_type.to_pandas_dtype().__name__}]"
+        else:
+            pandas_type = "unicode"
+        columns.append(
+            {
+                "name": field.name,
+                "field_name": field.name,
+                "pandas_type": pandas_type,
+                "numpy_type": "object",
+                "metadata": None,
+            }
+        )
+    metadata = {
+        "index_columns": ["divide_id"],
+        "column_indexes": [],
+        "columns": columns,
+        "creator": {"library": "pyarrow", "version": pa.__version__},
+        "pandas_version": pd.__version__,
+    }
+    return json.dumps(metadata).encode()
+
+
+def weights_cache_key(weight_inputs: list, nx: int = NX, ny: int = NY):
+    """
+    Key for a prepared weights operator.
+
+    Local weights inputs (gpkg, parquet or json) are keyed by path, size and
+    modification time, remote inputs by their uri and ETag or Last-Modified,
+    so computing the key reads no weights. The NWM grid shape and the cache
+    format version are part of the key, so a new grid or layout never reuses
+    a stale operator.
+
+    Parameters:
+        weight_inputs (list): weights files or geopackages, in processing order
+        nx (int): number of cells in the west_east direction of the NWM grid
+        ny (int): number of cells in the south_north direction of the NWM grid
+
+    Returns:
+        str: hex digest, None when a remote input reports no version
+    """
+    h = hashlib.sha256()
+    h.update(f"v{WEIGHTS_CACHE_VERSION}/{nx}x{ny}".encode())
+    for jinput in weight_inputs:
+        jinput = str(jinput)
+        h.update(b"\0")
+        if os.path.isfile(jinput):
+            stat = os.stat(jinput)
+            h.update(f"{os.path.abspath(jinput)}/{stat.st_size}/{stat.st_mtime_ns}".encode())
+        else:
+            version = remote_version(jinput)
+            if version is None:
+                return None
+            h.update(f"{jinput}/{version}".encode())
+    return h.hexdigest()
+
+
+def weights_operator_hash(weights_op, variables: list = ()) -> str:
+    """
+    Hash of everything a regridded file depends on besides the file itself:
+    the operator's weights, window, catchments and precision and the variables.
+
+    Returns:
+        str: hex digest
+    """
+    h = hashlib.sha256()
+    if isinstance(weights_op, WindowedOperator):
+        for jop, jrows in weights_op.parts:
+            h.update(weights_operator_hash(jop, variables).encode())
+            h.update(jrows.view(np.uint8))
+        return h.hexdigest()
+    matrix = weights_op.matrix
+    h.update(f"{weights_op.window}/{matrix.dtype}/{matrix.shape}/{list(variables)}".encode())
+    for array in (matrix.indptr, matrix.indices, matrix.data, weights_op.weight_sum):
+        h.update(np.ascontiguousarray(array).view(np.uint8))
+    h.update("\0".join(str(x) for x in weights_op.catchments).encode())
+    return h.hexdigest()
+
+
+def save_weights_operator(
+    cache_dir: str,
+    key: str,
+    weights_op: WeightsOperator,
+    jcatchment_dict: dict,
+    weights: WeightsTable,
+    grid: tuple = (NX, NY),
+) -> Path:
+    """
+    Persist a prepared operator as ``<cache_dir>/<key>.npz``.
+
+    The window-shifted flat indices, coverage and total coverage of each
+    catchment are stored as is, so loading needs no regridding setup and the
+    weights table can be rebuilt exactly for the metadata.
+
+    grid is the nx, ny shape of the NWM grid the weights' cell ids refer to.
+
+    Returns:
+        Path: the cache file
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    cache_file = cache_dir / f"{key}.npz"
+    extra = {}
+    if weights.geometry_hash is not None:
+        extra["geometry_hash"] = np.array(weights.geometry_hash, dtype=str)
+    vpu_ids = list(jcatchment_dict.keys())
+    vpu_counts = [len(jcatchment_dict[x]) for x in vpu_ids]
+    matrix = weights_op.matrix
+    with tempfile.NamedTemporaryFile(dir=cache_dir, suffix=".npz", delete=False) as f:
+        np.savez(
+            f,
+            indptr=matrix.indptr,
+            indices=matrix.indices,
+            data=matrix.data,
+            weight_sum=weights_op.weight_sum,
+            window=np.array(weights_op.window, dtype=np.int64),
+            grid=np.array(grid, dtype=np.int64),
+            catchments=np.array(weights_op.catchments, dtype=str),
+            vpu_ids=np.array(vpu_ids, dtype=str),
+            vpu_counts=np.array(vpu_counts, dtype=np.int64),
+            **extra,
+        )
+    os.replace(f.name, cache_file)
+    return cache_file
+
+
+def load_weights_operator(cache_dir: str, key: str):
+    """
+    Load a prepared operator saved by save_weights_operator.
+
+    Returns:
+        weights_op (WeightsOperator): the operator, None on a cache miss
+        jcatchment_dict (dict): VPU ids to catchment ids, None on a cache miss
+    """
+    cache_file = Path(cache_dir, f"{key}.npz")
+    if not cache_file.exists():
+        return None, None
+    try:
+        with np.load(cache_file, allow_pickle=False) as cache:
+            window = tuple(cache["window"])
+            catchments = cache["catchments"].tolist()
+            dx = window[1] - window[0] + 1
+            dy = window[3] - window[2] + 1
+            matrix = sp.csr_array(
+                (cache["data"], cache["indices"], cache["indptr"]),
+                shape=(len(catchments), dx * dy),
+            )
+            jcatchment_dict = {}
+            start = 0
+            for jvpu, count in zip(cache["vpu_ids"].tolist(), cache["vpu_counts"]):
+                jcatchment_dict[jvpu] = catchments[start : start + count]
+                start += count
+            weights_op = WeightsOperator(matrix, catchments, window, cache["weight_sum"])
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+        # truncated or corrupt entry, rebuilt by the caller
+        cache_file.unlink(missing_ok=True)
+        return None, None
+    return weights_op, jcatchment_dict
+
+
+def load_cached_weights(cache_dir: str, key: str) -> WeightsTable:
+    """
+    Rebuild the datastream weights (global cell_id and raw coverage of each
+    divide_id) from a cached operator.
+    """
+    with np.load(Path(cache_dir, f"{key}.npz"), allow_pickle=False) as cache:
+        x_min, x_max, y_min, _ = cache["window"]
+        nx, ny = cache["grid"]
+        dx = x_max - x_min + 1
+        indices = cache["indices"].astype(np.int64)
+        cell_id = np.ravel_multi_index(
+            (indices % dx + x_min, indices // dx + y_min), (nx, ny), order="F"
+        )
+        weights = WeightsTable(
+            cache["catchments"].tolist(),
+            cache["indptr"],
+            cell_id,
+            cache["data"],
+            cache["geometry_hash"] if "geometry_hash" in cache.files else None,
+        )
+    return weights
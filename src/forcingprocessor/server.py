@@ -0,0 +1,215 @@
+"""
+Long running forcingprocessor service.
+
+Runs submitted conf.json payloads one after another in a single process, so
+the prepared weights operators and the worker pool stay in memory between
+forecast cycles instead of being rebuilt by every invocation. The workers are
+started by a forkserver, forking a process that runs the server's threads
+could deadlock them.
+
+    forcingprocessor-server --host 127.0.0.1 --port 8787 --max-jobs 1000
+
+    POST /jobs          conf.json as the body, returns the job id
+    GET  /jobs          every job
+    GET  /jobs/<id>     status and timing of a job
+    GET  /health        queue length and resident weights
+"""
+
+import argparse
+import json
+import queue
+import threading
+import time
+import traceback
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from forcingprocessor import processor
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+
+class JobQueue:
+    """
+    Jobs run in submission order by a single thread. Each job records when it
+    was submitted, started and finished, and how long it queued and ran. Only
+    the last max_jobs jobs are kept, the oldest finished ones are dropped.
+
+    Parameters:
+        run: function called with each job's conf, prep_ngen_data by default
+        max_jobs (int): number of jobs to keep
+    """
+
+    def __init__(self, run=None, max_jobs: int = 1000):
+        self.run = run or processor.prep_ngen_data
+        self.max_jobs = max_jobs
+        self.jobs = {}
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._thread.start()
+
+    def submit(self, conf: dict) -> str:
+        job_id = uuid.uuid4().hex[:12]
+        with self._lock:
+            self.jobs[job_id] = {
+                "id": job_id,
+                "status": "queued",
+                "submitted": _now(),
+                "started": None,
+                "finished": None,
+                "queued_s": None,
+                "runtime_s": None,
+                "error": None,
+            }
+        self._queue.put((job_id, conf, time.perf_counter()))
+        return job_id
+
+    def get(self, job_id: str) -> dict:
+        with self._lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def list(self) -> list:
+        with self._lock:
+            return [dict(x) for x in self.jobs.values()]
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def join(self):
+        """Wait for every submitted job to finish"""
+        self._queue.join()
+
+    def _update(self, job_id: str, **fields):
+        with self._lock:
+            self.jobs[job_id].update(fields)
+
+    def _prune(self):
+        with self._lock:
+            finished = [
+                x for x, job in self.jobs.items() if job["status"] in ["done", "failed"]
+            ]
+            for job_id in finished[: max(len(self.jobs) - self.max_jobs, 0)]:
+                del self.jobs[job_id]
+
+    def _work(self):
+        while True:
+            job_id, conf, t_submit = self._queue.get()
+            t0 = time.perf_counter()
+            self._update(
+                job_id,
+                status="running",
+                started=_now(),
+                queued_s=round(t0 - t_submit, 3),
+            )
+            try:
+                self.run(conf)
+                status, error = "done", None
+            except Exception:
+                status, error = "failed", traceback.format_exc()
+            self._update(
+                job_id,
+                status=status,
+                finished=_now(),
+                runtime_s=round(time.perf_counter() - t0, 3),
+                error=error,
+            )
+            self._prune()
+            self._queue.task_done()
+
+
+def make_handler(jobs: JobQueue):
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, code: int, body):
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            path = self.path.rstrip("/")
+            if path == "/health":
+                self._reply(
+                    200,
+                    {
+                        "pending": jobs.pending(),
+                        "resident_weights": len(processor.resident_weights),
+                        "worker_pool": processor.worker_pool is not None,
+                    },
+                )
+            elif path == "/jobs":
+                self._reply(200, jobs.list())
+            elif path.startswith("/jobs/"):
+                job = jobs.get(path.split("/")[-1])
+                if job:
+                    self._reply(200, job)
+                else:
+                    self._reply(404, {"error": "no such job"})
+            else:
+                self._reply(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path.rstrip("/") != "/jobs":
+                self._reply(404, {"error": "not found"})
+                return
+            length = int(self.headers.get("Content-Length", 0))
+            try:
+                conf = json.loads(self.rfile.read(length))
+                if not isinstance(conf, dict) or "run" not in conf:
+                    raise ValueError("conf must be a conf.json object")
+            except ValueError as e:
+                self._reply(400, {"error": str(e)})
+                return
+            job_id = jobs.submit(conf)
+            self._reply(202, jobs.get(job_id))
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(host: str = "127.0.0.1", port: int = 8787, run=None, max_jobs: int = 1000):
+    """
+    Create the server, call serve_forever on it to handle requests.
+
+    Returns:
+        server (ThreadingHTTPServer): the server, server.jobs is its JobQueue
+    """
+    processor.keep_resident = True
+    processor.pool_start_method = "forkserver"
+    jobs = JobQueue(run, max_jobs)
+    server = ThreadingHTTPServer((host, port), make_handler(jobs))
+    server.jobs = jobs
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run forcingprocessor as a service that keeps weights and workers warm"
+    )
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8787)
+    parser.add_argument(
+        "--max-jobs", type=int, default=1000, help="finished jobs kept for GET /jobs"
+    )
+    args = parser.parse_args()
+
+    server = serve(args.host, args.port, max_jobs=args.max_jobs)
+    print(f"forcingprocessor server listening on {args.host}:{args.port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        processor.shutdown_worker_pool()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,21 +3,14 @@ import numpy as np
 from datetime import timezone
 import psutil
 import re
+import os
+import time
+import uuid
+import concurrent.futures as cf
+from multiprocessing import shared_memory
 from pathlib import Path
 
 
-nwm_variables = [
-    "U2D",
-    "V2D",
-    "LWDOWN",
-    "RAINRATE",
-    "RAINRATE",
-    "T2D",
-    "Q2D",
-    "PSFC",
-    "SWDOWN",
-]
-
 ngen_variables = [
     "UGRD_10maboveground",
     "VGRD_10maboveground",
@@ -30,6 +23,22 @@ ngen_variables = [
     "DSWRF_surface",
 ]
 
+# ngen variable -> (nwm source variable, function applied to the regridded source or None)
+# Several ngen variables may share a source, which is then read and regridded only once.
+ngen_variable_sources = {
+    "UGRD_10maboveground": ("U2D", None),
+    "VGRD_10maboveground": ("V2D", None),
+    "DLWRF_surface": ("LWDOWN", None),
+    "APCP_surface": ("RAINRATE", None),
+    "precip_rate": ("RAINRATE", None),
+    "TMP_2maboveground": ("T2D", None),
+    "SPFH_2maboveground": ("Q2D", None),
+    "PRES_surface": ("PSFC", None),
+    "DSWRF_surface": ("SWDOWN", None),
+}
+
+nwm_variables = [ngen_variable_sources[x][0] for x in ngen_variables]
+
 vpus = [
     "01",
     "02",
@@ -55,38 +64,110 @@ vpus = [
 ]
 
 
-def get_window(weights_df):
-    """
-    Providing window on weights for which number of catchments is over 50,000
-
-    weights_df : datastream weights df where the indicies are catchment ids and the columns are cell-id and coverage
-    """
-    nx = 4608
-    ny = 3840
-    if len(weights_df) < 50000:
-        x_min_list = []
-        x_max_list = []
-        y_min_list = []
-        y_max_list = []
-        idx_2d = []
-        for row in weights_df.itertuples():
-            indices = row.cell_id
-            idx_2d = np.unravel_index(indices, (1, nx, ny), order="F")
-            x_min_list.append(np.min(idx_2d[1]))
-            x_max_list.append(np.max(idx_2d[1]))
-            y_min_list.append(np.min(idx_2d[2]))
-            y_max_list.append(np.max(idx_2d[2]))
-        x_min = np.min(x_min_list)
-        x_max = np.max(x_max_list)
-        y_min = np.min(y_min_list)
-        y_max = np.max(y_max_list)
-    else:
-        x_min = 0
-        x_max = nx - 1
-        y_min = 0
-        y_max = ny - 1
-
-    return x_min, x_max, y_min, y_max
+def variable_plan(ngen_vars: list = ngen_variables):
+    """
+    Plan which NWM variables to read for a list of ngen variables.
+
+    Each unique NWM source variable is read and regridded once and then fanned
+    out to every ngen variable that needs it. Derived ngen variables (e.g. unit
+    conversions) are computed from the regridded source.
+
+    Returns:
+        source_vars (list): unique NWM variables to read, in order of first use
+        source_index (np.ndarray): row in source_vars for each ngen variable
+        derived (dict): ngen variable index -> function of the regridded source
+    """
+    source_vars = []
+    source_index = []
+    derived = {}
+    for j, jvar in enumerate(ngen_vars):
+        source, func = ngen_variable_sources[jvar]
+        if source not in source_vars:
+            source_vars.append(source)
+        source_index.append(source_vars.index(source))
+        if func is not None:
+            derived[j] = func
+    return source_vars, np.array(source_index, dtype=int), derived
+
+
+def _cell_window(cell_id, nx):
+    x = cell_id % nx
+    y = cell_id // nx
+    return int(x.min()), int(x.max()), int(y.min()), int(y.max())
+
+
+def get_window(weights, nx: int = 4608, ny: int = 3840):
+    """
+    Smallest window of the NWM grid holding every cell of the weights.
+
+    weights : datastream weights (WeightsTable)
+
+    Returns:
+        x_min, x_max, y_min, y_max of the window, the full grid for empty weights
+    """
+    if len(weights.cell_id) == 0:
+        return 0, nx - 1, 0, ny - 1
+    return _cell_window(weights.cell_id, nx)
+
+
+def window_cells(window) -> int:
+    x_min, x_max, y_min, y_max = window
+    return (x_max - x_min + 1) * (y_max - y_min + 1)
+
+
+def _window_hull(a, b):
+    return min(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), max(a[3], b[3])
+
+
+def get_windows(weights, jcatchment_dict: dict, min_fill: float = 0.5, nx: int = 4608):
+    """
+    Windows of the NWM grid covering each group of catchments, for groups far
+    apart on the grid (Northeast and Pacific Northwest VPUs) that one window
+    would join across the whole continent.
+
+    Each group starts with its own bounding box. Two windows are merged into
+    their hull while their cells fill at least min_fill of it, so nearby or
+    overlapping groups share a window and distant ones keep their own.
+
+    Parameters:
+        weights (WeightsTable): datastream weights, rows grouped in
+            jcatchment_dict order as multiprocess_hf2ds returns them
+        jcatchment_dict (dict): group (VPU) ids to catchment ids
+        min_fill (float): fraction of a merged window the merged windows must cover
+        nx (int): number of cells in the west_east direction of the NWM grid
+
+    Returns:
+        windows (list): x_min, x_max, y_min, y_max of each window
+        members (list): the group ids read from each window
+    """
+    cell_id = weights.cell_id
+    # first and last cell of each group in cell_id
+    row_ends = np.cumsum([0] + [len(x) for x in jcatchment_dict.values()])
+    ends = weights.indptr[row_ends]
+
+    windows = []
+    members = []
+    for j, jgroup in enumerate(jcatchment_dict):
+        if ends[j + 1] > ends[j]:
+            windows.append(_cell_window(cell_id[ends[j] : ends[j + 1]], nx))
+            members.append([jgroup])
+
+    merged = True
+    while merged:
+        merged = False
+        for a in range(len(windows)):
+            for b in range(a + 1, len(windows)):
+                hull = _window_hull(windows[a], windows[b])
+                covered = window_cells(windows[a]) + window_cells(windows[b])
+                if covered >= min_fill * window_cells(hull):
+                    windows[a] = hull
+                    members[a] += members.pop(b)
+                    windows.pop(b)
+                    merged = True
+                    break
+            if merged:
+                break
+    return windows, members
 
 
 def log_time(label, log_file):
@@ -123,7 +204,11 @@ def convert_url2key(nwm_file, fs_type):
 
 
 def make_forcing_netcdf(
-    out_path: str, catchments: np.ndarray, t_ax: np.ndarray, input_array: np.ndarray
+    out_path: str,
+    catchments: np.ndarray,
+    t_ax: np.ndarray,
+    input_array: np.ndarray,
+    unlimited: bool = False,
 ) -> None:
     """
     Create a netcdf file with the forcing data.
@@ -133,24 +218,54 @@ def make_forcing_netcdf(
     catchments (np.ndarray): Array of catchment IDs.
     t_ax (np.ndarray): Time axis array with shape (nt,).
     input_array (np.ndarray): Forcing data array with shape (ncat, nt, forcing variables).
+        float32 data is stored as f4 variables, anything else as f8.
+    unlimited (bool): Make time an unlimited dimension so append_forcing_netcdf can extend it.
     """
     import netCDF4 as nc
 
     with nc.Dataset(out_path, "w", format="NETCDF4") as ds:
         ds.createDimension("catchment-id", len(catchments))
-        ds.createDimension("time", len(t_ax))
+        ds.createDimension("time", None if unlimited else len(t_ax))
+        kwargs = {}
+        if unlimited:
+            # the default chunk of 1 along an unlimited dimension makes every
+            # catchment's time series its own tiny chunk
+            kwargs["chunksizes"] = (min(len(catchments), 1024), max(len(t_ax), 1))
 
         ids_var = ds.createVariable("ids", str, ("catchment-id",))
         ids_var[:] = catchments
 
-        time_var = ds.createVariable("Time", "f8", ("catchment-id", "time"))
-        time_var[:] = t_ax
+        time_var = ds.createVariable("Time", "f8", ("catchment-id", "time"), **kwargs)
+        time_var[:] = np.broadcast_to(t_ax, (len(catchments), len(t_ax)))
 
+        var_type = "f4" if input_array.dtype == np.float32 else "f8"
         for i, var_name in enumerate(ngen_variables):
-            var = ds.createVariable(var_name, "f8", ("catchment-id", "time"))
+            var = ds.createVariable(var_name, var_type, ("catchment-id", "time"), **kwargs)
             var[:] = input_array[:, :, i]
 
 
+def append_forcing_netcdf(
+    out_path: str, t_ax: np.ndarray, input_array: np.ndarray
+) -> None:
+    """
+    Append time steps to a netcdf made by make_forcing_netcdf with unlimited=True.
+
+    Parameters:
+    out_path (str): Path of the netcdf file.
+    t_ax (np.ndarray): Time axis array of the new steps with shape (nt,).
+    input_array (np.ndarray): Forcing data array with shape (ncat, nt, forcing variables).
+    """
+    import netCDF4 as nc
+
+    with nc.Dataset(out_path, "a") as ds:
+        start = len(ds.dimensions["time"])
+        end = start + len(t_ax)
+        ncatchments = len(ds.dimensions["catchment-id"])
+        ds["Time"][:, start:end] = np.broadcast_to(t_ax, (ncatchments, len(t_ax)))
+        for i, var_name in enumerate(ngen_variables):
+            ds[var_name][:, start:end] = input_array[:, :, i]
+
+
 def normalize_vpu_id(value):
     """
     Normalize a VPU identifier to the standard VPU_XX format.
@@ -170,3 +285,145 @@ def normalize_vpu_id(value):
         return f"VPU_{name.upper()}"
 
     return name
+
+
+class SharedArray:
+    """
+    A numpy array that several processes can attach to by name.
+
+    Backed by POSIX shared memory by default, or by a memory mapped file in
+    `scratch_dir` when one is given (useful where /dev/shm is small, as in
+    containers). Only `spec` needs to be sent to other processes.
+    """
+
+    def __init__(self, spec: tuple, create: bool = False):
+        self.spec = spec
+        self.unlinked = False
+        kind, name, shape, dtype = spec
+        nbytes = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+        if kind == "shm":
+            # attaching processes are children of the creator and share its
+            # resource tracker, so the segment is tracked exactly once
+            self._shm = shared_memory.SharedMemory(name=name, create=create, size=nbytes)
+            self.array = np.ndarray(shape, dtype=dtype, buffer=self._shm.buf)
+        else:
+            self._shm = None
+            mode = "w+" if create else "r+"
+            self.array = np.memmap(name, dtype=dtype, mode=mode, shape=shape)
+
+    @classmethod
+    def create(cls, shape: tuple, dtype=np.float64, scratch_dir: str = None):
+        """Allocate a new shared array, zero filled"""
+        shape = tuple(int(x) for x in shape)
+        dtype = np.dtype(dtype).str
+        if scratch_dir:
+            os.makedirs(scratch_dir, exist_ok=True)
+            name = os.path.join(scratch_dir, f"fp_{uuid.uuid4().hex}.dat")
+            return cls(("file", name, shape, dtype), create=True)
+        return cls(("shm", f"fp_{uuid.uuid4().hex[:16]}", shape, dtype), create=True)
+
+    @classmethod
+    def attach(cls, spec: tuple):
+        """Attach to a shared array created by another process"""
+        return cls(spec)
+
+    def close(self):
+        """Detach this process from the array"""
+        self.array = None
+        if self._shm is not None:
+            try:
+                self._shm.close()
+            except BufferError:
+                # views of the array are still alive, the mapping goes with them
+                pass
+
+    def unlink(self):
+        """Detach and free the array for every process, from the creator"""
+        kind, name, _, _ = self.spec
+        self.close()
+        if kind == "shm":
+            if not self.unlinked:
+                self._shm.unlink()
+        elif os.path.exists(name):
+            os.remove(name)
+        self.unlinked = True
+
+
+def job_blocks(nitems: int, size: int) -> list:
+    """(start, end) of consecutive blocks of at most size items covering nitems"""
+    size = max(int(size), 1)
+    return [(x, min(x + size, nitems)) for x in range(0, nitems, size)]
+
+
+def _timed_job(func, args):
+    t0 = time.perf_counter()
+    result = func(*args)
+    return os.getpid(), time.perf_counter() - t0, result
+
+
+def schedule_jobs(
+    func,
+    jobs: list,
+    nprocs: int,
+    label: str = "",
+    verbose: bool = False,
+    pool=None,
+    progress=None,
+) -> list:
+    """
+    Run func(*args) for each args in jobs on up to nprocs worker processes.
+
+    Jobs wait in the pool's queue and each worker takes the next one as soon as
+    it is idle, so a slow job (a throttled remote file, a large VPU) holds up
+    only its own worker. Each result is put back at its job's index, so the
+    output is in job order whatever order the jobs finish in.
+
+    Parameters:
+        func: function to run on the workers, must be picklable
+        jobs (list): argument tuple of each job, in output order
+        nprocs (int): maximum number of worker processes
+        label (str): name of the stage in the utilization report
+        verbose (bool): print the time each worker spent busy
+        pool (cf.ProcessPoolExecutor): long-lived pool to run the jobs on, None
+            to start one for these jobs
+        progress: called in this process with each result as its job finishes,
+            to report progress over all workers
+
+    Returns:
+        list: the result of each job
+    """
+    results = [None] * len(jobs)
+    if not jobs:
+        return results
+    busy = {}
+    t0 = time.perf_counter()
+    own_pool = pool is None
+    if own_pool:
+        pool = cf.ProcessPoolExecutor(max_workers=max(min(nprocs, len(jobs)), 1))
+    futures = {}
+    try:
+        for j, args in enumerate(jobs):
+            futures[pool.submit(_timed_job, func, args)] = j
+        for future in cf.as_completed(futures):
+            pid, busy_time, results[futures[future]] = future.result()
+            if progress:
+                progress(results[futures[future]])
+            njobs, total = busy.get(pid, (0, 0.0))
+            busy[pid] = (njobs + 1, total + busy_time)
+    except BaseException:
+        # drop the jobs still queued, a shared pool moves on to the next stage
+        for future in futures:
+            future.cancel()
+        raise
+    finally:
+        if own_pool:
+            pool.shutdown(cancel_futures=True)
+    wall = time.perf_counter() - t0
+    if verbose:
+        print(f"{label} worker utilization over {wall:.2f} s", flush=True)
+        for pid, (njobs, total) in sorted(busy.items()):
+            print(
+                f"  process {pid}: {njobs} jobs, busy {total:.2f} s ({100 * total / wall:.0f}%)",
+                flush=True,
+            )
+    return results
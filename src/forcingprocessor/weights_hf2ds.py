@@ -1,38 +1,95 @@
-import json, argparse, time, requests, os
+import json, argparse, time, os, hashlib
 from io import BytesIO
 import geopandas as gpd
+import shapely
 import concurrent.futures as cf
-import pandas as pd
 import xarray as xr
 import numpy as np
 import multiprocessing as mp
 from forcingprocessor.utils import normalize_vpu_id
+from forcingprocessor.io_tools import http_get
+from forcingprocessor.regrid_tools import WeightsTable
 gpd.options.io_engine = "pyogrio"
 
 
 
-def rastersourceNexactextract(raster_data, geo_data):
+# catchments per exactextract process before another one is worth starting
+WEIGHTS_ROWS_PER_PROC = 9000
+# spatial tiles per process, idle processes take the next tile
+WEIGHTS_TILES_PER_PROC = 4
+
+
+def raster_grid(raster_data) -> tuple:
+    """
+    Geometry of the raster template, all exactextract needs to find cells:
+    (xmin, xmax, ymin, ymax, nx, ny), with the extent taken from the first and
+    last cell coordinates as the weights have always been computed with.
+    """
+    return (
+        float(raster_data.x[0]),
+        float(raster_data.x[-1]),
+        float(raster_data.y[0]),
+        float(raster_data.y[-1]),
+        int(raster_data.sizes["x"]),
+        int(raster_data.sizes["y"]),
+    )
+
+
+def spatial_tiles(geo_data: gpd.GeoDataFrame, ntiles: int) -> list:
+    """
+    Partition catchments into ntiles spatially compact groups of about equal
+    cost, the number of polygon vertices exactextract has to walk.
+
+    The costliest group is split in two at the cost median along its longer
+    side until there are ntiles groups.
+
+    Returns:
+        list: row positions of each tile, in row order
+    """
+    bounds = geo_data.geometry.bounds.to_numpy()
+    x = (bounds[:, 0] + bounds[:, 2]) / 2
+    y = (bounds[:, 1] + bounds[:, 3]) / 2
+    cost = shapely.get_num_coordinates(geo_data.geometry.values).astype(np.float64)
+    tiles = [np.arange(len(geo_data))]
+    while len(tiles) < ntiles:
+        j = max(range(len(tiles)), key=lambda k: cost[tiles[k]].sum())
+        rows = tiles[j]
+        if len(rows) < 2:
+            break
+        axis = x if np.ptp(x[rows]) >= np.ptp(y[rows]) else y
+        rows = rows[np.argsort(axis[rows], kind="stable")]
+        csum = np.cumsum(cost[rows])
+        split = min(max(int(np.searchsorted(csum, csum[-1] / 2)) + 1, 1), len(rows) - 1)
+        tiles[j : j + 1] = [np.sort(rows[:split]), np.sort(rows[split:])]
+    return tiles
+
+
+def tile_weights(grid: tuple, geo_data: gpd.GeoDataFrame):
+    """
+    exactextract weights of a tile of catchments. Cell ids and coverage depend
+    only on the grid geometry, so the raster source is a zero-copy view of a
+    single value. It spans the whole grid rather than the tile, exactextract
+    only visits the cells under each polygon and the coverage stays bit for bit
+    independent of how catchments were tiled.
+
+    Returns:
+        weights (WeightsTable): cell_id and coverage of each catchment
+        pid (int): the process that computed it
+        seconds (float): time spent
+    """
     from exactextract import exact_extract
     from exactextract.raster import NumPyRasterSource
 
-    ncatch_proc = len(geo_data)
-
-    print(f"Finding weights for geodataframe of size {ncatch_proc}", flush=True)
-    xmin = raster_data.x[0]
-    xmax = raster_data.x[-1]
-    ymin = raster_data.y[0]
-    ymax = raster_data.y[-1]
-    # print(f"window {xmin.value} {xmax.value} {ymin.value} {ymax.value}")
     t0 = time.perf_counter()
+    xmin, xmax, ymin, ymax, nx, ny = grid
     rastersource = NumPyRasterSource(
-        np.squeeze(raster_data["T2D"]),
+        np.broadcast_to(np.float32(0), (ny, nx)),
         srs_wkt=geo_data.crs.to_wkt(),
         xmin=xmin,
         xmax=xmax,
         ymin=ymin,
         ymax=ymax,
     )
-    print(f"raster calculated, executing exactextract", flush=True)
     output = exact_extract(
         rastersource,
         geo_data,
@@ -40,20 +97,17 @@ def rastersourceNexactextract(raster_data, geo_data):
         include_cols=["divide_id"],
         output="pandas",
     )
-    tf = time.perf_counter() - t0
-    assert ncatch_proc == len(output)
-    print(
-        f"single thread -> {ncatch_proc} weights calculated in {tf:.1f}s for a rate of {ncatch_proc / tf:.1f}catch/s",
-        flush=True,
+    assert len(output) == len(geo_data)
+    weights = WeightsTable.from_lists(
+        output["divide_id"], output["cell_id"], output["coverage"]
     )
-
-    return output
+    return weights, os.getpid(), time.perf_counter() - t0
 
 
 def get_projection(raster_file):
     if "https://" in raster_file:
         print(f"Downloading file...")
-        response = requests.get(raster_file)
+        response = http_get(raster_file)
 
         if response.status_code == 200:
             raster_file = BytesIO(response.content)
@@ -76,44 +130,106 @@ def get_projection(raster_file):
     return projection, raster_data
 
 
-def calc_weights_from_gdf(gdf: gpd.GeoDataFrame, raster_file: str, nf: str) -> dict:
-    # Create a dict of weights from the "divides" layer geodataframe
-    # keys are divide_ids, values are a 2 element list
-    # with the first element being a list of cell_id's
-    # and the second element being the corresponding coverage fraction's
+def calc_weights_from_gdf(
+    gdf: gpd.GeoDataFrame, raster_file: str, nf: str
+) -> WeightsTable:
+    # Calculate the weights of every divide in the "divides" layer geodataframe,
+    # the cell_id's of the raster each divide covers
+    # and the corresponding coverage fraction's
     projection, raster_data = get_projection(raster_file)
-    geo_data = gdf.to_crs(projection)
+    grid = raster_grid(raster_data)
+    geo_data = gdf[["divide_id", "geometry"]].to_crs(projection)
     nrows = len(gdf)
 
-    nprocs = max(min(nrows // 9000, (os.cpu_count() - 1) // nf), 1)
-    geo_df_list = []
-    nper = nrows // nprocs
-    nleft = nrows - (nper * nprocs)
-    i = 0
-    k = nper
-    for j in range(nprocs):
-        if j < nleft:
-            k += 1
-        print(f"{i} {k} {k - i}")
-        geo_df_list.append(geo_data[i:k])
-        i = k
-        k = nper + i
+    nprocs = max(min(nrows // WEIGHTS_ROWS_PER_PROC, (os.cpu_count() - 1) // nf), 1)
+    tiles = spatial_tiles(geo_data, nprocs * WEIGHTS_TILES_PER_PROC)
 
-    print(f"Performing multiprocess exactextract", flush=True)
-    output_list = []
-    raster_list = [raster_data for x in range(nprocs)]
+    print(
+        f"Performing exactextract on {len(tiles)} spatial tiles with {nprocs} processes",
+        flush=True,
+    )
+    weights_list = []
+    busy = {}
     with cf.ProcessPoolExecutor(
         max_workers=nprocs,
         mp_context=mp.get_context("spawn"),
     ) as pool:
-        for results in pool.map(rastersourceNexactextract, raster_list, geo_df_list):
-            output_list.append(results)
+        for results, rows in zip(
+            pool.map(
+                tile_weights,
+                [grid for x in tiles],
+                [geo_data.iloc[x] for x in tiles],
+            ),
+            tiles,
+        ):
+            weights, pid, seconds = results
+            weights_list.append(weights)
+            ncatch, total = busy.get(pid, (0, 0.0))
+            busy[pid] = (ncatch + len(rows), total + seconds)
+    for pid, (ncatch, total) in sorted(busy.items()):
+        print(
+            f"process {pid} -> {ncatch} weights calculated in {total:.1f}s for a rate of {ncatch / total:.1f}catch/s",
+            flush=True,
+        )
     print(f"Concatenating results", flush=True)
-    output = pd.concat(output_list, ignore_index=True)
-    weights = output.set_index("divide_id")
+    # back to the order of the geodataframe
+    order = np.argsort(np.concatenate(tiles), kind="stable")
+    weights = WeightsTable.concat(weights_list).take(order)
+    weights.geometry_hash = geometry_hashes(gdf)
     return weights
 
 
+def geometry_hashes(gdf: gpd.GeoDataFrame) -> np.ndarray:
+    """
+    Hash of each divide's geometry (WKB) and crs, as read from the geopackage.
+    Stored next to the weights so a later hydrofabric version can be
+    diffed against them.
+    """
+    crs = hashlib.blake2b(str(gdf.crs).encode(), digest_size=16)
+    hashes = []
+    for jwkb in shapely.to_wkb(gdf.geometry.values):
+        jhash = crs.copy()
+        jhash.update(jwkb)
+        hashes.append(jhash.hexdigest())
+    return np.array(hashes)
+
+
+def incremental_weights_from_gdf(
+    gdf: gpd.GeoDataFrame, previous: WeightsTable, raster_file: str, nf: int
+) -> WeightsTable:
+    """
+    Weights of the divides in gdf, reusing the previous weights of every
+    divide whose geometry hash is unchanged. Only new and changed divides go
+    through exactextract, divides no longer in gdf are dropped. The previous
+    weights must have been calculated on the same raster grid.
+
+    Returns:
+        weights (WeightsTable): same as calc_weights_from_gdf on the whole gdf
+    """
+    if previous.geometry_hash is None:
+        raise ValueError(
+            "Previous weights have no geometry_hash column, calculate them in full once"
+        )
+    ids = gdf["divide_id"].to_numpy()
+    hashes = geometry_hashes(gdf)
+    previous_rows = previous.rows(ids)
+    reuse = previous_rows >= 0
+    reuse[reuse] = previous.geometry_hash[previous_rows[reuse]] == hashes[reuse]
+    nremoved = len(previous) - int((previous_rows >= 0).sum())
+    print(
+        f"{len(ids) - reuse.sum()} new or changed divides, {reuse.sum()} unchanged, {nremoved} removed",
+        flush=True,
+    )
+    weights_list = [previous.take(previous_rows[reuse])]
+    if not reuse.all():
+        weights_list.append(calc_weights_from_gdf(gdf[~reuse], raster_file, nf))
+    # back to the order of the geodataframe
+    order = np.argsort(
+        np.concatenate([np.flatnonzero(reuse), np.flatnonzero(~reuse)]), kind="stable"
+    )
+    return WeightsTable.concat(weights_list).take(order)
+
+
 def multiprocess_hf2ds(files: list, raster_template: str, max_procs: int):
 
     nprocs = min(len(files), max_procs)
@@ -130,7 +246,7 @@ def multiprocess_hf2ds(files: list, raster_template: str, max_procs: int):
         i = k
         k = nper + i
 
-    weight_dfs = []
+    weights_list = []
     jcatchment_dicts = []
     with cf.ProcessPoolExecutor(
         max_workers=nprocs,
@@ -142,10 +258,10 @@ def multiprocess_hf2ds(files: list, raster_template: str, max_procs: int):
             [raster_template for x in range(len(files_list))],
             [nf for x in range(len(files_list))],
         ):
-            weight_dfs.append(results[0])
+            weights_list.append(results[0])
             jcatchment_dicts.append(results[1])
 
-    weights_df = pd.concat(weight_dfs)
+    weights = WeightsTable.concat(weights_list)
 
     print("Processes have returned", flush=True)
 
@@ -162,49 +278,54 @@ def multiprocess_hf2ds(files: list, raster_template: str, max_procs: int):
 
             jcatchment_dict[unique_key] = catchments
 
-    return weights_df, jcatchment_dict
+    return weights, jcatchment_dict
 
 
-def hf2ds(files: list, raster: str, nf):
+def hf2ds(files: list, raster: str, nf, previous_weights: str = None):
     """
     Extracts the weights from a list of files
 
     input : files
     gpkg_files : list of geopackage or parquet files
 
-    returns : weights_df, jcatchment_dict
-    weights_df : a dataframe where index is catchment ids and the columns are the corresponding cell and coverage
+    returns : weights, jcatchment_dict
+    weights : WeightsTable with the cell_id's and coverage of each catchment
     jcatchment_dict : A dictionary where the keys are the geopackage name and the values are a list of catchment id's
+    previous_weights : optional weights parquet to reuse for divides whose geometry has not changed
 
     """
     jcatchment_dict = {}
     count = 0
-    weights_dfs = []
+    weights_list = []
     for jgpkg in files:
         jname = normalize_vpu_id(jgpkg)
         if jname in jcatchment_dict:
             count += 1
             jname = f"{jname}_{count}"
 
-        jweights_df = hydrofabric2datastream_weights(jgpkg, raster, nf)
-        weights_dfs.append(jweights_df)
-        jcatchment_dict[jname] = list(jweights_df.index)
+        jweights = hydrofabric2datastream_weights(
+            jgpkg, raster, nf, previous_weights
+        )
+        weights_list.append(jweights)
+        jcatchment_dict[jname] = list(jweights.catchments)
 
-    weights_df = pd.concat(weights_dfs)
+    weights = WeightsTable.concat(weights_list)
 
-    return weights_df, jcatchment_dict
+    return weights, jcatchment_dict
 
 
 def hydrofabric2datastream_weights(
-    weights_file: str, raster_template: str, nf: int
-) -> dict:
+    weights_file: str, raster_template: str, nf: int, previous_weights: str = None
+) -> WeightsTable:
     """
-    Converts tabular weights to a dictionary where keys are catchment ids and the values are a list of weights
+    Reads or calculates the weights of every catchment in a weights file
 
-    input gpkg or path to weights parquet
+    input gpkg, path to weights parquet or weights json
     gpkg : gpd.Dataframe
+    previous_weights : weights parquet of an earlier hydrofabric version, only divides
+    whose geometry changed are calculated when weights are calculated from scratch
 
-    returns weights_json : a dictionary where keys are catchment ids and the values are a list of weights
+    returns weights : WeightsTable with the cell_id's and coverage of each catchment
 
     """
     # This function looks a bit wild bc weights may be provided
@@ -216,48 +337,48 @@ def hydrofabric2datastream_weights(
     weights_file = str(weights_file)
 
     if weights_file.endswith(".json"):
+        # keys are catchment ids, values are [cell_id's, coverage's]
         with open(weights_file, "r") as fp:
             weights_json = json.load(fp)
-        ncatchment = len(weights_json)
-        weights_df = pd.DataFrame.from_dict(
-            weights_json, orient="index", columns=["cell_id", "coverage"]
+        weights = WeightsTable.from_lists(
+            weights_json.keys(),
+            [x[0] for x in weights_json.values()],
+            [x[1] for x in weights_json.values()],
         )
-    else:
-        if weights_file.endswith(".gpkg"):
+    elif weights_file.endswith(".gpkg"):
+        layers = gpd.list_layers(weights_file)
+        if "forcing-weights" in list(layers.name):
+            print(
+                f"Weights table found in geopackage as 'forcing-weights'. Converting to arrays for processing.",
+                flush=True,
+            )
+            weights_table = gpd.read_file(weights_file, layer="forcing-weights")
+            weights = WeightsTable.from_long(
+                weights_table["divide_id"],
+                weights_table["cell"],
+                weights_table["coverage_fraction"],
+            )
+        else:
+            print(
+                f"Weights table not found in geopackage. Calculating from scratch with raster {raster_template}.",
+                flush=True,
+            )
             catchments = gpd.read_file(weights_file, layer="divides")
-            layers = gpd.list_layers(weights_file)
-            if "forcing-weights" in list(layers.name):
-                print(
-                    f"Weights table found in geopackage as 'forcing-weights'. Converting to dict for processing.",
-                    flush=True,
+            if previous_weights:
+                weights = incremental_weights_from_gdf(
+                    catchments,
+                    WeightsTable.read_parquet(previous_weights),
+                    raster_template,
+                    nf,
                 )
-                weights_df = gpd.read_file(weights_file, layer="forcing-weights")
             else:
-                print(
-                    f"Weights table not found in geopackage. Calculating from scratch with raster {raster_template}.",
-                    flush=True,
-                )
-                weights_df = calc_weights_from_gdf(catchments, raster_template, nf)
-                ncatchment = len(weights_df)
-        elif weights_file.endswith("parquet"):
-            weights_df = pd.read_parquet(weights_file)
-            ncatchment = len(weights_df)
-        else:
-            raise Exception(f"Dont know how to deal with {weights_file}")
-
-        if "cell" in weights_df.columns:
-            weights_table_unqiue_ids = (
-                weights_df.groupby("divide_id").agg(tuple).map(list).reset_index()
-            )
-            weights_table_unqiue_ids = weights_table_unqiue_ids.set_index("divide_id")
-            weights_df = weights_table_unqiue_ids.rename(columns={"cell": "cell_id"})
-            weights_df["cell_id"] = weights_df["cell_id"].apply(
-                lambda x: [int(i) for i in x]
-            )
-            weights_df = weights_df.rename(columns={"coverage_fraction": "coverage"})
-            ncatchment = len(weights_df)
+                weights = calc_weights_from_gdf(catchments, raster_template, nf)
+    elif weights_file.endswith("parquet"):
+        weights = WeightsTable.read_parquet(weights_file)
+    else:
+        raise Exception(f"Dont know how to deal with {weights_file}")
 
-    ncatchment = len(weights_df)
+    ncatchment = len(weights)
     tf = time.perf_counter()
     dt = tf - t0
     rate = ncatchment / dt if dt > 0 else float("inf")
@@ -265,7 +386,7 @@ def hydrofabric2datastream_weights(
         f"{weights_file} {ncatchment} catchment weights obtained {dt:.2f} seconds total, {rate:.2f} catchments/second",
         flush=True,
     )
-    return weights_df
+    return weights
 
 
 if __name__ == "__main__":
@@ -283,10 +404,19 @@ if __name__ == "__main__":
         type=str,
         help="Filename for the datastream weights file",
     )
+    parser.add_argument(
+        "--previous_weights",
+        dest="previous_weights",
+        type=str,
+        help="Weights parquet of an earlier hydrofabric version, only divides whose geometry changed are recalculated",
+        default=None,
+    )
     args = parser.parse_args()
 
     global raster_template
     raster_template = "https://noaa-nwm-pds.s3.amazonaws.com/nwm.20250105/forcing_short_range/nwm.t00z.short_range.forcing.f001.conus.nc"
 
-    weights, jcatchments = hf2ds([args.input_file], raster_template, 1)
+    weights, jcatchments = hf2ds(
+        [args.input_file], raster_template, 1, args.previous_weights
+    )
     weights.to_parquet(args.outname)
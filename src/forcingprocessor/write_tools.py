@@ -0,0 +1,315 @@
+"""Tools to encode per-catchment forcing files and stream them to storage."""
+
+import csv
+import gzip
+import os
+from collections import deque
+import concurrent.futures as cf
+from io import BytesIO, StringIO
+import numpy as np
+
+# formatted cells held in memory at once by ForcingCSVEncoder
+CSV_BLOCK_CELLS = 1 << 18
+# S3 rejects multipart parts smaller than this, except the last one
+S3_MIN_PART_SIZE = 5 * 1048576
+# uncompressed bytes per gzip member written by ParallelGzipWriter
+GZIP_BLOCK_SIZE = 1048576
+# file extension and default level of each compression backend
+COMPRESSION_EXTENSIONS = {"gzip": ".gz", "zstd": ".zst"}
+COMPRESSION_LEVELS = {"gzip": 9, "zstd": 3}
+
+
+def _csv_row(fields: list) -> str:
+    buf = StringIO()
+    csv.writer(buf, lineterminator=os.linesep).writerow(fields)
+    return buf.getvalue()
+
+
+class ForcingCSVEncoder:
+    """
+    Encode catchment forcings as csv bytes, identical to
+
+        df = pd.DataFrame(data[:, :, j], columns=columns)
+        df.insert(0, "time", t_ax)
+        df.to_csv(buf, index=False)
+
+    The header and time column are formatted once into a template with one
+    placeholder per value. Values are filled in for a block of catchments at
+    a time, formatted with the same shortest round trip repr pandas writes,
+    and missing values are written as empty fields.
+
+    Parameters:
+        t_ax (list): time axis, one entry per row
+        columns (list): variable names, in data order
+        header (bool): start with the header row, False to encode rows to append
+    """
+
+    def __init__(self, t_ax: list, columns: list, header: bool = True):
+        self.nt = len(t_ax)
+        self.nvar = len(columns)
+        placeholders = ["%s"] * self.nvar
+        template = []
+        if header:
+            template.append(_csv_row(["time"] + list(columns)).replace("%", "%%"))
+        for jt in t_ax:
+            template.append(
+                _csv_row([str(jt).replace("%", "%%")] + placeholders)
+            )
+        self._template = "".join(template)
+
+    def encode(self, data: np.ndarray):
+        """
+        Yield the csv bytes of each catchment of data in order.
+
+        Parameters:
+            data (np.ndarray): (time, variable, catchment) forcings
+        """
+        ncatchments = data.shape[2]
+        block = max(1, CSV_BLOCK_CELLS // max(self.nt * self.nvar, 1))
+        for start in range(0, ncatchments, block):
+            jdata = data[:, :, start : start + block]
+            missing = np.isnan(jdata)
+            if jdata.dtype == np.float64 and not missing.any():
+                # str of a python float is the same shortest repr, and faster
+                cells = jdata
+            else:
+                cells = jdata.astype(str)
+                cells[missing] = ""
+            cells = np.moveaxis(cells, 2, 0).reshape(jdata.shape[2], -1)
+            for row in cells.tolist():
+                yield (self._template % tuple(row)).encode()
+
+
+class S3MultipartWriter:
+    """
+    Write-only file object that uploads to S3 while it is written to.
+
+    Data is buffered until a part is full, then sent with upload_part, so
+    memory stays bounded by part_size however large the object gets. An object
+    smaller than one part is sent with a single put_object. Used as a context
+    manager, the upload is completed on exit, or aborted if an exception was
+    raised.
+
+    Parameters:
+        client (boto3.client): S3 client
+        bucket (str): bucket name
+        key (str): object key
+        part_size (int): bytes per part, raised to the S3 minimum of 5 MB
+    """
+
+    def __init__(self, client, bucket: str, key: str, part_size: int = 64 * 1048576):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(int(part_size), S3_MIN_PART_SIZE)
+        self.nbytes = 0
+        self.closed = False
+        self._buf = bytearray()
+        self._parts = []
+        self._upload_id = None
+
+    def write(self, data) -> int:
+        self._buf += data
+        self.nbytes += len(data)
+        while len(self._buf) >= self.part_size:
+            self._upload_part(bytes(self._buf[: self.part_size]))
+            del self._buf[: self.part_size]
+        return len(data)
+
+    def _upload_part(self, body: bytes):
+        if self._upload_id is None:
+            response = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key
+            )
+            self._upload_id = response["UploadId"]
+        part_number = len(self._parts) + 1
+        response = self.client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self._upload_id,
+            PartNumber=part_number,
+            Body=body,
+        )
+        self._parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+
+    def close(self):
+        """Send what is left and complete the upload"""
+        if self.closed:
+            return
+        self.closed = True
+        if self._upload_id is None:
+            self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buf))
+        else:
+            if self._buf:
+                self._upload_part(bytes(self._buf))
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self._upload_id,
+                MultipartUpload={"Parts": self._parts},
+            )
+        self._buf = bytearray()
+
+    def abort(self):
+        """Drop the upload, S3 discards the parts already sent"""
+        self.closed = True
+        self._buf = bytearray()
+        if self._upload_id is not None:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self._upload_id
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class CountingWriter:
+    """
+    Write-only file object that passes data on to fileobj and counts the
+    bytes. With fileobj None the data is only counted.
+    """
+
+    def __init__(self, fileobj=None):
+        self.fileobj = fileobj
+        self.nbytes = 0
+
+    def write(self, data) -> int:
+        if self.fileobj is not None:
+            self.fileobj.write(data)
+        self.nbytes += len(data)
+        return len(data)
+
+    def flush(self):
+        if self.fileobj is not None and hasattr(self.fileobj, "flush"):
+            self.fileobj.flush()
+
+
+class ParallelGzipWriter:
+    """
+    Write-only file object that gzips blocks of its input on several threads,
+    like pigz.
+
+    Each block becomes its own gzip member and members are written to fileobj
+    in order. Concatenated members are a standard gzip file that gunzip,
+    gzip.open and tarfile read as a single stream. zlib releases the GIL, so
+    the threads compress in parallel.
+
+    Parameters:
+        fileobj: binary file object to write to, left open on close
+        level (int): gzip compression level
+        threads (int): number of compression threads
+        block_size (int): uncompressed bytes per member
+    """
+
+    def __init__(self, fileobj, level: int = 9, threads: int = 2, block_size: int = GZIP_BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.level = level
+        self.threads = max(int(threads), 1)
+        self.block_size = block_size
+        self.closed = False
+        self._buf = bytearray()
+        self._pending = deque()
+        self._nblocks = 0
+        self._pool = cf.ThreadPoolExecutor(max_workers=self.threads)
+
+    def write(self, data) -> int:
+        self._buf += data
+        while len(self._buf) >= self.block_size:
+            self._submit(bytes(self._buf[: self.block_size]))
+            del self._buf[: self.block_size]
+        return len(data)
+
+    def _submit(self, block: bytes):
+        self._pending.append(
+            self._pool.submit(gzip.compress, block, self.level, mtime=0)
+        )
+        self._nblocks += 1
+        # keep a bounded number of blocks in flight
+        while len(self._pending) > 2 * self.threads:
+            self.fileobj.write(self._pending.popleft().result())
+
+    def close(self):
+        """Compress what is left and write all remaining members"""
+        if self.closed:
+            return
+        self.closed = True
+        if self._buf or self._nblocks == 0:
+            self._submit(bytes(self._buf))
+        self._buf = bytearray()
+        try:
+            while self._pending:
+                self.fileobj.write(self._pending.popleft().result())
+        finally:
+            self._pool.shutdown(cancel_futures=True)
+
+    def abort(self):
+        """Stop the compression threads without writing what is left"""
+        self.closed = True
+        self._buf = bytearray()
+        self._pending.clear()
+        self._pool.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def open_compressed(fileobj, compression: str = "gzip", level: int = None, threads: int = 1):
+    """
+    Open a write-only compressed stream on top of fileobj.
+
+    Parameters:
+        fileobj: binary file object to write the compressed stream to, left open on close
+        compression (str): gzip or zstd, zstd needs the zstandard package
+        level (int): compression level, None for the backend default in COMPRESSION_LEVELS
+        threads (int): compression threads, gzip with more than one thread writes
+            block-parallel gzip members
+
+    Returns:
+        file object to write to, close it (or use it as a context manager) to finish the stream
+    """
+    if compression not in COMPRESSION_EXTENSIONS:
+        raise ValueError(
+            f"Unsupported compression {compression}, options are {list(COMPRESSION_EXTENSIONS)}"
+        )
+    if level is None:
+        level = COMPRESSION_LEVELS[compression]
+    if compression == "gzip":
+        if threads > 1:
+            return ParallelGzipWriter(fileobj, level=level, threads=threads)
+        return gzip.GzipFile(fileobj=fileobj, mode="wb", compresslevel=level)
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError(
+            "zstd compression needs the zstandard package, pip install forcingprocessor[zstd]"
+        ) from e
+    compressor = zstandard.ZstdCompressor(level=level, threads=threads if threads > 1 else 0)
+    return compressor.stream_writer(fileobj, closefd=False)
+
+
+def compress_bytes(data: bytes, compression: str = "gzip", level: int = None, threads: int = 1) -> bytes:
+    """Compress data in memory the way open_compressed streams would"""
+    buf = BytesIO()
+    with open_compressed(buf, compression, level, threads) as writer:
+        writer.write(data)
+    return buf.getvalue()
+
+
+def compressed_size(data: bytes, compression: str = "gzip", level: int = None, threads: int = 1) -> int:
+    """Bytes data compresses to with open_compressed, counted without keeping them"""
+    counter = CountingWriter()
+    with open_compressed(counter, compression, level, threads) as writer:
+        writer.write(data)
+    return counter.nbytes
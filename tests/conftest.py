@@ -1,6 +1,8 @@
-import pytest, os, shutil
+import pytest, os, shutil, json
 from pathlib import Path
-from forcingprocessor.utils import vpus
+import numpy as np
+import netCDF4 as nc
+from forcingprocessor.utils import vpus, nwm_variables
 
 test_dir = Path(__file__).parent
 data_dir = (test_dir / "data").resolve()
@@ -84,3 +86,56 @@ def download_weights():
         if not os.path.exists(local_file):
             os.system(f"wget {wf} -P {data_dir}")
     yield
+
+
+@pytest.fixture(scope="session")
+def synthetic_forcings(tmp_path_factory):
+    """
+    Offline stand in for NWM short range forcing files: three hourly files on
+    the full 4608 x 3840 grid, zero but for two blocks far apart, and json
+    weights of a VPU over each block.
+    """
+    out = tmp_path_factory.mktemp("synthetic_forcings")
+    nx, ny = 4608, 3840
+    # x_min, x_max, y_min, y_max of each VPU, y counted from the south
+    boxes = {"VPU_01": (4000, 4060, 3000, 3050), "VPU_17": (300, 380, 2500, 2560)}
+    rng = np.random.default_rng(0)
+    nwm_files = []
+    for j in range(3):
+        nwm_file = out / f"nwm.t00z.short_range.forcing.f00{j + 1}.conus.nc"
+        nwm_files.append(str(nwm_file))
+        with nc.Dataset(nwm_file, "w") as ds:
+            ds.createDimension("time", 1)
+            ds.createDimension("y", ny)
+            ds.createDimension("x", nx)
+            ds.model_output_valid_time = f"2024-07-10_0{j + 1}:00:00"
+            for jvar in dict.fromkeys(nwm_variables):
+                kwargs = dict(zlib=True, complevel=1, chunksizes=(1, 768, 922))
+                if jvar == "RAINRATE":
+                    var = ds.createVariable(jvar, "i4", ("time", "y", "x"), **kwargs, fill_value=-999900)
+                    var.scale_factor = 1e-6
+                    var.add_offset = 0.0
+                else:
+                    var = ds.createVariable(jvar, "f4", ("time", "y", "x"), **kwargs, fill_value=-999900.0)
+                grid = np.zeros((ny, nx), dtype=np.float32)
+                for x_min, x_max, y_min, y_max in boxes.values():
+                    # file rows run north to south
+                    grid[ny - 1 - y_max : ny - y_min, x_min : x_max + 1] = rng.random(
+                        (y_max - y_min + 1, x_max - x_min + 1)
+                    ) * (1e-3 if jvar == "RAINRATE" else 300)
+                var[0] = grid
+    nwm_file = out / "filenamelist.txt"
+    nwm_file.write_text("\n".join(nwm_files) + "\n")
+
+    weight_files = []
+    for jvpu, (x_min, x_max, y_min, y_max) in boxes.items():
+        weights = {}
+        for jcat in range(200):
+            x = rng.integers(x_min, x_max + 1, 12)
+            y = rng.integers(y_min, y_max + 1, 12)
+            cells = np.unique(x + nx * y)
+            weights[f"cat-{jvpu[4:]}{jcat:04d}"] = [cells.tolist(), rng.random(len(cells)).tolist()]
+        weight_file = out / f"{jvpu}_weights.json"
+        weight_file.write_text(json.dumps(weights))
+        weight_files.append(str(weight_file))
+    return {"nwm_file": str(nwm_file), "weight_files": weight_files}
@@ -1,3 +1,4 @@
+import gzip
 import os
 from pathlib import Path
 from datetime import datetime, timedelta, timezone
@@ -7,6 +8,8 @@ import pytest
 import re
 from unittest.mock import patch
 import pandas as pd
+import numpy as np
+import netCDF4 as nc
 
 HF_VERSION = "v2.2"
 date = datetime.now(timezone.utc)
@@ -458,3 +461,96 @@ def test_vpu_metadata_output(download_weight_file, clean_forcings_metadata_dirs)
     assert 0 <= vpu_row["precip_nonzero_fraction"] <= 1
     os.remove(netcdf_file)
     
+
+
+def _synthetic_conf(synthetic_forcings, output_path, output_file_type, **run):
+    return {
+        "forcing": {
+            "nwm_file": synthetic_forcings["nwm_file"],
+            "gpkg_file": synthetic_forcings["weight_files"],
+        },
+        "storage": {
+            "storage_type": "local",
+            "output_path": str(output_path),
+            "output_file_type": output_file_type,
+        },
+        "run": {"verbose": False, "collect_stats": False, "nprocs": 2, **run},
+    }
+
+
+def _shared_arrays():
+    return {x for x in os.listdir("/dev/shm") if x.startswith("fp_")}
+
+
+@pytest.mark.parametrize("run", ["single", "time_window", "shared_array_dir"])
+def test_shared_array_freed_when_write_fails(synthetic_forcings, tmp_path, run):
+    scratch = tmp_path / "scratch"
+    run_conf = {
+        "single": {},
+        "time_window": {"time_window": 2},
+        "shared_array_dir": {"shared_array_dir": str(scratch)},
+    }[run]
+    conf_fail = _synthetic_conf(synthetic_forcings, tmp_path / "out", ["netcdf"], **run_conf)
+    before = _shared_arrays()
+    with patch(
+        "forcingprocessor.processor.multiprocess_write_netcdf",
+        side_effect=RuntimeError("netcdf write failed"),
+    ):
+        with pytest.raises(RuntimeError, match="netcdf write failed"):
+            prep_ngen_data(conf_fail)
+    assert _shared_arrays() == before
+    assert not scratch.exists() or os.listdir(scratch) == []
+
+
+@pytest.mark.parametrize("df_type", ["csv", "parquet"])
+def test_time_window_matches_single_run(synthetic_forcings, tmp_path, df_type):
+    outputs = {}
+    for name, run_conf in [("single", {}), ("streamed", {"time_window": 2})]:
+        out = tmp_path / name
+        prep_ngen_data(
+            _synthetic_conf(
+                synthetic_forcings,
+                out,
+                [df_type, "netcdf"],
+                collect_stats=True,
+                **run_conf,
+            )
+        )
+        outputs[name] = out
+    single = outputs["single"] / "forcings"
+    streamed = outputs["streamed"] / "forcings"
+
+    names = sorted(os.listdir(single))
+    assert names == sorted(os.listdir(streamed))
+    assert any(x.endswith(f".{df_type}") for x in names)
+    for name in names:
+        if name.endswith(".nc"):
+            with nc.Dataset(single / name) as a, nc.Dataset(streamed / name) as b:
+                assert a.dimensions["time"].size == b.dimensions["time"].size == 3
+                for var in a.variables:
+                    np.testing.assert_array_equal(a[var][:], b[var][:])
+        else:
+            assert (single / name).read_bytes() == (streamed / name).read_bytes()
+
+    # sizes are measured on the finished files, not summed over the windows
+    meta = [
+        pd.read_csv(x / "metadata" / "forcings_metadata" / "metadata.csv")
+        for x in outputs.values()
+    ]
+    for col in [
+        "individual_catch_file_size_avg_MB",
+        "individual_catch_file_zip_size_avg_MB",
+    ]:
+        assert meta[0][col][0] == pytest.approx(meta[1][col][0])
+
+    # compressed sizes are measured on every file, not extrapolated
+    zipped = [
+        len(gzip.compress((single / x).read_bytes(), compresslevel=9)) / 1048576
+        for x in names
+        if x.endswith(f".{df_type}")
+    ]
+    for jmeta in meta:
+        for col, stat in [("avg", np.average), ("med", np.median), ("std", np.std)]:
+            assert jmeta[f"individual_catch_file_zip_size_{col}_MB"][0] == pytest.approx(
+                stat(zipped), rel=1e-6, abs=1e-12
+            )
@@ -1,6 +1,18 @@
-from forcingprocessor.weights_hf2ds import hf2ds, multiprocess_hf2ds
+from forcingprocessor.weights_hf2ds import (
+    hf2ds,
+    multiprocess_hf2ds,
+    calc_weights_from_gdf,
+    incremental_weights_from_gdf,
+    spatial_tiles,
+)
+from forcingprocessor.regrid_tools import WeightsTable
 from pathlib import Path
 import os
+import numpy as np
+import pandas as pd
+import xarray as xr
+import geopandas as gpd
+import shapely
 
 HF_VERSION = "v2.1.1"
 test_dir = Path(__file__).parent
@@ -76,3 +88,87 @@ def test_multiple_multiprocess_gpkg_v22():
         2,
     )
     assert len(weights) > 0
+
+
+def _synthetic_raster(path, nx=120, ny=90, dx=1000.0):
+    crs = gpd.GeoSeries([], crs="EPSG:5070").crs.to_wkt()
+    raster = xr.Dataset(
+        {"T2D": (("time", "y", "x"), np.random.rand(1, ny, nx))},
+        coords={"x": np.arange(nx) * dx, "y": np.arange(ny) * dx},
+    )
+    raster["crs"] = xr.DataArray(0, attrs={"esri_pe_string": crs})
+    raster.to_netcdf(path)
+    return raster
+
+
+def _synthetic_divides(n=300, seed=0):
+    rng = np.random.default_rng(seed)
+    points = shapely.points(rng.uniform(5e3, 110e3, n), rng.uniform(5e3, 80e3, n))
+    geometry = [
+        shapely.buffer(p, r, quad_segs=int(q))
+        for p, r, q in zip(points, rng.uniform(500, 4000, n), rng.integers(2, 16, n))
+    ]
+    return gpd.GeoDataFrame(
+        {"divide_id": [f"cat-{x}" for x in range(n)]}, geometry=geometry, crs="EPSG:5070"
+    )
+
+
+def test_spatial_tiles_balance():
+    divides = _synthetic_divides()
+    tiles = spatial_tiles(divides, 8)
+    assert len(tiles) == 8
+    assert np.array_equal(np.sort(np.concatenate(tiles)), np.arange(len(divides)))
+    cost = shapely.get_num_coordinates(divides.geometry.values)
+    tile_cost = [cost[x].sum() for x in tiles]
+    assert max(tile_cost) < 2 * cost.sum() / len(tiles)
+
+
+def test_tiled_weights_match_single_extract(tmp_path):
+    from exactextract import exact_extract
+    from exactextract.raster import NumPyRasterSource
+
+    raster_file = str(tmp_path / "raster.nc")
+    raster = _synthetic_raster(raster_file)
+    divides = _synthetic_divides()
+
+    weights = calc_weights_from_gdf(divides, raster_file, 1)
+
+    source = NumPyRasterSource(
+        np.squeeze(raster["T2D"]).values,
+        srs_wkt=divides.crs.to_wkt(),
+        xmin=raster.x[0],
+        xmax=raster.x[-1],
+        ymin=raster.y[0],
+        ymax=raster.y[-1],
+    )
+    expected = exact_extract(
+        source, divides, ["cell_id", "coverage"], include_cols=["divide_id"], output="pandas"
+    ).set_index("divide_id")
+    assert list(weights.catchments) == list(expected.index)
+    for jcol in ["cell_id", "coverage"]:
+        for a, b in zip(
+            np.split(getattr(weights, jcol), weights.indptr[1:-1]), expected[jcol]
+        ):
+            assert np.array_equal(a, b)
+
+
+def test_incremental_weights_match_full(tmp_path):
+    raster_file = str(tmp_path / "raster.nc")
+    _synthetic_raster(raster_file)
+    divides = _synthetic_divides()
+    previous_file = tmp_path / "previous.parquet"
+    calc_weights_from_gdf(divides, raster_file, 1).to_parquet(previous_file)
+
+    new_divides = divides.drop(index=[3, 40, 41])
+    new_divides.loc[10:14, "geometry"] = new_divides.geometry.loc[10:14].buffer(700)
+    added = _synthetic_divides(n=4, seed=1)
+    added["divide_id"] = [f"cat-new-{x}" for x in range(len(added))]
+    new_divides = pd.concat([added, new_divides], ignore_index=True)
+
+    full_file = tmp_path / "full.parquet"
+    incremental_file = tmp_path / "incremental.parquet"
+    calc_weights_from_gdf(new_divides, raster_file, 1).to_parquet(full_file)
+    incremental_weights_from_gdf(
+        new_divides, WeightsTable.read_parquet(previous_file), raster_file, 1
+    ).to_parquet(incremental_file)
+    assert full_file.read_bytes() == incremental_file.read_bytes()
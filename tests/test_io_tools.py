@@ -0,0 +1,421 @@
+"""
+Unit tests for NWM file fetching tools.
+"""
+
+import base64
+import hashlib
+import os
+import threading
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from forcingprocessor.io_tools import (
+    prefetch,
+    is_hdf5,
+    read_nwm_window,
+    read_nwm_windows,
+    fetch_nwm_file,
+    HTTPRangeFile,
+    configure_http,
+    http_get,
+    http_stats,
+    HTTP_CONFIG,
+    NWMFileCache,
+    nwm_grid_shape,
+    remote_version,
+)
+
+# ---------------------------------------------------------------------------
+# minimum viable examples
+# ---------------------------------------------------------------------------
+
+
+def make_nwm_file(path, dims=("time", "y", "x"), ny=12, nx=10, chunksizes=None):
+    """Small NWM-like forcing file with a float, a packed and a filled variable"""
+    import netCDF4 as nc
+
+    rng = np.random.default_rng(0)
+    kwargs = {"chunksizes": chunksizes, "zlib": True} if chunksizes else {}
+    with nc.Dataset(path, "w", format="NETCDF4") as ds:
+        ds.createDimension(dims[0], 1)
+        ds.createDimension(dims[1], ny)
+        ds.createDimension(dims[2], nx)
+        ds.model_output_valid_time = "2024-07-10_01:00:00"
+        u2d = ds.createVariable(
+            "U2D", "f4", dims, fill_value=np.float32(-999900.0), **kwargs
+        )
+        u2d[:] = rng.random((1, ny, nx)) * 20 - 10
+        rain = ds.createVariable(
+            "RAINRATE", "i4", dims, fill_value=np.int32(-999900), **kwargs
+        )
+        rain.scale_factor = 1e-6
+        rain.add_offset = 0.0
+        rain[:] = rng.random((1, ny, nx)) * 1e-3
+        t2d = ds.createVariable(
+            "T2D", "f4", dims, fill_value=np.float32(-999900.0), **kwargs
+        )
+        values = np.ma.masked_array(rng.random((1, ny, nx)) * 300, mask=False)
+        values.mask[0, 3:5, 2:6] = True
+        t2d[:] = values
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Static file server that honors single Range headers and sends the
+    Content-MD5 of whole files, like a bucket. Paths in `unavailable` get that
+    many 503s and paths in `corrupt` that many wrong checksums first.
+    """
+
+    protocol_version = "HTTP/1.1"
+    requests = []
+    unavailable = {}
+    corrupt = {}
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, "rb") as f:
+            content = f.read()
+        byte_range = self.headers.get("Range")
+        self.requests.append(byte_range)
+        if self.unavailable.get(self.path, 0) > 0:
+            self.unavailable[self.path] -= 1
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if byte_range is None:
+            self.send_response(200)
+            md5 = hashlib.md5(content).digest()
+            if self.corrupt.get(self.path, 0) > 0:
+                self.corrupt[self.path] -= 1
+                md5 = hashlib.md5(content + b"x").digest()
+            self.send_header("Content-MD5", base64.b64encode(md5).decode())
+        else:
+            start, end = byte_range.split("=")[1].split("-")
+            start, end = int(start), min(int(end), len(content) - 1)
+            if start >= len(content):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(content)}")
+            content = content[start : end + 1]
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_server(tmp_path):
+    RangeRequestHandler.requests = []
+    RangeRequestHandler.unavailable = {}
+    RangeRequestHandler.corrupt = {}
+    config = dict(HTTP_CONFIG)
+    configure_http(backoff=0.01)
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), partial(RangeRequestHandler, directory=str(tmp_path))
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+    configure_http(**config)
+
+
+# ---------------------------------------------------------------------------
+# unit tests
+# ---------------------------------------------------------------------------
+
+
+def test_prefetch_preserves_order():
+    def fetch(x):
+        time.sleep(0.01 * (5 - x))  # later items finish first
+        return x, 1
+
+    for depth in [0, 1, 3]:
+        out = [result[0] for result, _, _ in prefetch(range(5), fetch, depth=depth)]
+        assert out == list(range(5))
+
+
+def test_prefetch_overlaps_fetch_with_work():
+    def fetch(x):
+        time.sleep(0.05)
+        return x, 1
+
+    t0 = time.perf_counter()
+    fetch_time = 0
+    wait_time = 0
+    for _, jfetch, jwait in prefetch(range(6), fetch, depth=2):
+        fetch_time += jfetch
+        wait_time += jwait
+        time.sleep(0.05)  # the "regrid" step
+    assert wait_time < fetch_time / 2
+    assert time.perf_counter() - t0 < 6 * 0.1
+
+
+def test_prefetch_byte_budget():
+    lock = threading.Lock()
+    held = [0, 0]  # current, peak
+
+    def fetch(x):
+        with lock:
+            held[0] += 1
+            held[1] = max(held)
+        return x, 100
+
+    for _ in prefetch(range(10), fetch, depth=4, max_bytes=250):
+        time.sleep(0.01)
+        with lock:
+            held[0] -= 1
+    # at most two 100 byte files fit in the budget next to the one in use
+    assert held[1] <= 3
+
+
+@pytest.mark.parametrize("dims", [("time", "y", "x"), ("Time", "south_north", "west_east")])
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+def test_read_nwm_window_matches_xarray(tmp_path, dims, dtype):
+    path = str(tmp_path / "nwm.nc")
+    make_nwm_file(path, dims)
+    variables = ["U2D", "RAINRATE", "T2D"]
+    window = (1, 7, 2, 9)  # x_min, x_max, y_min, y_max
+    x_min, x_max, y_min, y_max = window
+
+    expected = np.zeros((3, y_max - y_min + 1, x_max - x_min + 1), dtype=dtype)
+    with xr.open_dataset(path) as ds:
+        ny = ds["U2D"].shape[1]
+        for j, jvar in enumerate(variables):
+            expected[j] = np.flip(
+                np.squeeze(
+                    ds[jvar]
+                    .isel(
+                        {
+                            dims[2]: slice(x_min, x_max + 1),
+                            dims[1]: slice(ny - (y_max + 1), ny - y_min),
+                        }
+                    )
+                    .values
+                ),
+                axis=0,
+            )
+    assert np.isnan(expected).any()
+
+    for file_obj in [path, BytesIO(open(path, "rb").read())]:
+        assert is_hdf5(file_obj)
+        out = np.zeros_like(expected)
+        attrs = read_nwm_window(file_obj, variables, window, out)
+        np.testing.assert_array_equal(out, expected)
+        assert attrs["model_output_valid_time"] == "2024-07-10_01:00:00"
+        assert set(dims) <= set(attrs["dims"])
+
+
+def test_read_nwm_windows_matches_single_reads(tmp_path):
+    path = str(tmp_path / "nwm.nc")
+    make_nwm_file(path)
+    variables = ["U2D", "RAINRATE", "T2D"]
+    windows = [(0, 2, 0, 3), (6, 9, 8, 11)]
+    outs = [np.zeros((3, x[3] - x[2] + 1, x[1] - x[0] + 1)) for x in windows]
+    read_nwm_windows(path, variables, windows, outs)
+    for window, out in zip(windows, outs):
+        expected = np.zeros_like(out)
+        read_nwm_window(path, variables, window, expected)
+        np.testing.assert_array_equal(out, expected)
+
+
+def test_is_hdf5_keeps_position(tmp_path):
+    make_nwm_file(tmp_path / "nwm.nc")
+    for content, expected in [
+        (open(tmp_path / "nwm.nc", "rb").read(), True),
+        (b"CDF\x01" + bytes(100), False),  # netCDF3 classic
+    ]:
+        file_obj = BytesIO(content)
+        file_obj.seek(2)
+        assert is_hdf5(file_obj) == expected
+        assert file_obj.tell() == 2
+
+
+def test_nwm_grid_shape(tmp_path, http_server):
+    make_nwm_file(tmp_path / "nwm.nc", ny=12, nx=10)
+    assert nwm_grid_shape(str(tmp_path / "nwm.nc")) == (10, 12)
+    assert nwm_grid_shape(f"{http_server}/nwm.nc") == (10, 12)
+    xr.Dataset({"U2D": (("time", "y", "x"), np.zeros((1, 7, 5)))}).to_netcdf(
+        tmp_path / "nwm3.nc", format="NETCDF3_CLASSIC"
+    )
+    assert nwm_grid_shape(str(tmp_path / "nwm3.nc")) == (5, 7)
+
+
+def test_remote_version(tmp_path, http_server):
+    (tmp_path / "weights.parquet").write_bytes(b"x")
+    version = remote_version(f"{http_server}/weights.parquet")
+    assert version
+    os.utime(tmp_path / "weights.parquet", (0, 0))
+    assert remote_version(f"{http_server}/weights.parquet") != version
+    assert remote_version(f"{http_server}/missing.parquet") is None
+
+
+def test_http_range_file_reads(tmp_path, http_server):
+    content = np.random.default_rng(0).bytes(10000)
+    (tmp_path / "blob").write_bytes(content)
+
+    file_obj = HTTPRangeFile(f"{http_server}/blob", block_size=1024)
+    assert file_obj.size == len(content)
+    assert file_obj.read(10) == content[:10]
+    file_obj.seek(5000)
+    assert file_obj.read(3000) == content[5000:8000]
+    file_obj.seek(-100, os.SEEK_END)
+    assert file_obj.read() == content[-100:]
+    assert file_obj.read(10) == b""
+    # blocks 4 to 7 came in one request, nothing is fetched twice
+    nrequests = file_obj.nrequests
+    file_obj.seek(4500)
+    assert file_obj.read(2000) == content[4500:6500]
+    assert file_obj.nrequests == nrequests == 3
+
+    with pytest.raises(Exception, match="does not exist"):
+        HTTPRangeFile(f"{http_server}/missing")
+
+
+def test_fetch_nwm_file_range_reads(tmp_path, http_server):
+    make_nwm_file(tmp_path / "nwm.nc", ny=1000, nx=800, chunksizes=(1, 100, 100))
+    variables = ["U2D", "RAINRATE", "T2D"]
+    window = (120, 160, 210, 240)  # x_min, x_max, y_min, y_max
+    shape = (3, window[3] - window[2] + 1, window[1] - window[0] + 1)
+
+    expected = np.zeros(shape)
+    read_nwm_window(str(tmp_path / "nwm.nc"), variables, window, expected)
+
+    file_obj, file_size, nbytes = fetch_nwm_file(
+        f"{http_server}/nwm.nc", range_reads=True, variables=variables, window=window
+    )
+    assert file_size == os.path.getsize(tmp_path / "nwm.nc") / 1048576
+    assert nbytes == file_obj.nbytes
+    nrequests = file_obj.nrequests
+
+    out = np.zeros(shape)
+    read_nwm_window(file_obj, variables, window, out)
+    np.testing.assert_array_equal(out, expected)
+    # the window's chunks were all fetched up front, and only a part of the file
+    assert file_obj.nrequests == nrequests
+    assert file_obj.nbytes < os.path.getsize(tmp_path / "nwm.nc") / 2
+
+
+def test_http_get_retries_and_validates(tmp_path, http_server):
+    (tmp_path / "flaky").write_bytes(b"forcing" * 100)
+    RangeRequestHandler.unavailable["/flaky"] = 2
+    RangeRequestHandler.corrupt["/flaky"] = 1
+
+    response = http_get(f"{http_server}/flaky")
+    assert response.status_code == 200
+    assert response.content == b"forcing" * 100
+    assert len(RangeRequestHandler.requests) == 4
+
+    assert http_get(f"{http_server}/missing").status_code == 404
+
+    RangeRequestHandler.unavailable["/flaky"] = HTTP_CONFIG["retries"] + 1
+    assert http_get(f"{http_server}/flaky").status_code == 503
+
+    host = http_server.split("//")[1]
+    stats = http_stats()[host]
+    assert stats["requests"] == 3
+    assert stats["retries"] == 3 + HTTP_CONFIG["retries"]
+    assert stats["failures"] == 1
+    # every request after the first reused a kept-alive connection
+    assert stats["connections"] == 1
+
+
+def test_nwm_file_cache_lru(tmp_path):
+    cache = NWMFileCache(tmp_path / "cache", max_bytes=250)
+    keys = [cache.key(f"https://nwm/{x}.nc", 100) for x in range(3)]
+    assert len(set(keys)) == 3
+    assert cache.key("https://nwm/0.nc", 101) != keys[0]
+
+    assert cache.get(keys[0]) is None
+    cache.put(keys[0], bytes(100))
+    time.sleep(0.01)
+    cache.put(keys[1], bytes(100))
+    time.sleep(0.01)
+    assert open(cache.get(keys[0]), "rb").read() == bytes(100)  # now the most recent
+    time.sleep(0.01)
+    cache.put(keys[2], bytes(100))
+
+    # over the budget, the least recently used file went
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) and cache.get(keys[2])
+    assert (cache.hits, cache.misses) == (3, 2)
+    assert not list((tmp_path / "cache").glob("*.part"))
+
+
+def test_nwm_file_cache_scans_only_over_budget(tmp_path, monkeypatch):
+    cache = NWMFileCache(tmp_path / "cache", max_bytes=1000)
+    scans = []
+    scandir = os.scandir
+    monkeypatch.setattr(os, "scandir", lambda x: scans.append(x) or scandir(x))
+    for x in range(9):
+        cache.put(cache.key(f"https://nwm/{x}.nc", 1), bytes(100))
+    assert len(scans) == 1  # the first put learns the size of the cache
+    for x in range(9, 12):
+        cache.put(cache.key(f"https://nwm/{x}.nc", 1), bytes(100))
+    assert len(scans) == 3
+    assert sum(x.stat().st_size for x in (tmp_path / "cache").iterdir()) <= 1000
+
+
+def test_nwm_file_cache_cleans_part_files(tmp_path, monkeypatch):
+    cache = NWMFileCache(tmp_path / "cache", max_bytes=1000)
+
+    def fail(*args):
+        raise OSError("disk full")
+
+    with monkeypatch.context() as m:
+        m.setattr(os, "replace", fail)
+        with pytest.raises(OSError, match="disk full"):
+            cache.put(cache.key("https://nwm/0.nc", 1), bytes(100))
+    assert not list((tmp_path / "cache").iterdir())
+
+    # left by a process that died mid write
+    stale = tmp_path / "cache" / "tmpdead.part"
+    stale.write_bytes(bytes(100))
+    os.utime(stale, (0, 0))
+    fresh = tmp_path / "cache" / "tmpbusy.part"
+    fresh.write_bytes(bytes(100))
+    cache.evict()
+    assert not stale.exists() and fresh.exists()
+
+
+def test_fetch_nwm_file_cache(tmp_path, http_server):
+    import fsspec
+
+    (tmp_path / "nwm.nc").write_bytes(b"forcing" * 100)
+    url = f"{http_server}/nwm.nc"
+    cache = NWMFileCache(tmp_path / "cache", max_bytes=1 << 20)
+
+    file_obj, _, nbytes = fetch_nwm_file(url, cache=cache)
+    assert file_obj.read() == b"forcing" * 100 and nbytes == 700
+    file_obj, file_size, nbytes = fetch_nwm_file(url, cache=cache)
+    assert open(file_obj, "rb").read() == b"forcing" * 100 and nbytes == 0
+    assert file_size == 700 / 1048576
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # a new version upstream is a miss
+    (tmp_path / "nwm.nc").write_bytes(b"forcing" * 101)
+    file_obj, _, _ = fetch_nwm_file(url, cache=cache)
+    assert file_obj.read() == b"forcing" * 101
+    assert (cache.hits, cache.misses) == (1, 2)
+
+    # cloud storage objects are keyed by the filesystem's info
+    fs = fsspec.filesystem("file")
+    path = str(tmp_path / "nwm.nc")
+    file_obj, file_size, _ = fetch_nwm_file(path, fs=fs, cache=cache)
+    assert file_obj.read() == b"forcing" * 101 and file_size == 707
+    file_obj, file_size, _ = fetch_nwm_file(path, fs=fs, cache=cache)
+    assert open(file_obj, "rb").read() == b"forcing" * 101 and file_size == 707
+    assert (cache.hits, cache.misses) == (2, 3)
@@ -0,0 +1,312 @@
+"""
+Unit tests for the sparse regridding operator.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from forcingprocessor.regrid_tools import (
+    WeightsTable,
+    WeightsOperator,
+    WindowedOperator,
+    NX,
+    NY,
+    weights_cache_key,
+    save_weights_operator,
+    load_weights_operator,
+    load_cached_weights,
+    weights_operator_hash,
+)
+
+# ---------------------------------------------------------------------------
+# minimum viable examples
+# ---------------------------------------------------------------------------
+
+window = (100, 119, 200, 214)  # x_min, x_max, y_min, y_max
+dx = window[1] - window[0] + 1
+dy = window[3] - window[2] + 1
+
+
+def make_weights_df(ncatch=50, seed=0):
+    rng = np.random.default_rng(seed)
+    cell_ids = []
+    coverages = []
+    for _ in range(ncatch):
+        n = int(rng.integers(1, 30))
+        xs = rng.integers(window[0], window[1] + 1, n)
+        ys = rng.integers(window[2], window[3] + 1, n)
+        cell_ids.append([int(x) for x in xs + ys * NX])
+        coverages.append(list(rng.random(n)))
+    return pd.DataFrame(
+        {"cell_id": cell_ids, "coverage": coverages},
+        index=[f"cat-{x}" for x in range(ncatch)],
+    )
+
+
+def regrid_loop(weights_df, data_allvars):
+    """Per-catchment loop that forcing_grid2catchment used before the operator"""
+    nvar = data_allvars.shape[0]
+    data_allvars = data_allvars.reshape(nvar, dx * dy)
+    data_array = np.zeros((nvar, len(weights_df)))
+    for jcatch, row in enumerate(weights_df.itertuples()):
+        coverage = np.array(row.coverage)
+        coverage_mat = np.repeat(coverage[None, :], nvar, axis=0)
+        weights_dx, weights_dy = np.unravel_index(row.cell_id, (NX, NY), order="F")
+        weights_window = np.ravel_multi_index(
+            np.array([weights_dx - window[0], weights_dy - window[2]]),
+            (dx, dy),
+            order="F",
+        )
+        data_array[:, jcatch] = np.sum(
+            coverage_mat * data_allvars[:, weights_window], axis=1
+        ) / np.sum(coverage)
+    return data_array
+
+
+# ---------------------------------------------------------------------------
+# unit tests
+# ---------------------------------------------------------------------------
+
+
+def test_operator_matches_loop():
+    weights_df = make_weights_df()
+    data_allvars = np.random.default_rng(1).random((9, dy, dx)) * 300
+    op = WeightsOperator.from_weights_df(weights_df, window)
+
+    assert op.matrix.shape == (len(weights_df), dx * dy)
+    assert op.catchments == list(weights_df.index)
+
+    np.testing.assert_array_equal(
+        op.apply(data_allvars), regrid_loop(weights_df, data_allvars)
+    )
+
+
+def test_operator_weight_sum(monkeypatch):
+    import forcingprocessor.regrid_tools as regrid_tools
+
+    weights_df = make_weights_df()
+    op = WeightsOperator.from_weights_df(weights_df, window)
+    np.testing.assert_array_equal(
+        op.weight_sum, [np.sum(x) for x in weights_df["coverage"]]
+    )
+
+    # blocks smaller than a row still reduce each row whole
+    data_allvars = np.random.default_rng(1).random((9, dy, dx))
+    expected = op.apply(data_allvars)
+    monkeypatch.setattr(regrid_tools, "REGRID_BLOCK_ENTRIES", 1)
+    op = WeightsOperator.from_weights_df(weights_df, window)
+    np.testing.assert_array_equal(op.apply(data_allvars), expected)
+
+
+def test_operator_constant_field():
+    # an area weighted average of a constant field is that constant
+    op = WeightsOperator.from_weights_df(make_weights_df(), window)
+    out = op.apply(np.full((2, dy, dx), 7.5))
+    assert out.shape == (2, len(op))
+    assert out == pytest.approx(7.5)
+
+
+def test_operator_float32_error_bound():
+    # NWM fields are float32 on disk, so both paths see the same grid values
+    weights_df = make_weights_df()
+    grid = (np.random.default_rng(2).random((9, dy, dx)) * 600 - 300).astype(np.float32)
+    op = WeightsOperator.from_weights_df(weights_df, window)
+    op32 = op.astype(np.float32)
+    assert op.astype(np.float64) is op
+    assert op32.dtype == np.float32
+
+    out64 = op.apply(grid.astype(np.float64))
+    out32 = op32.apply(grid)
+    assert out32.dtype == np.float32
+
+    # documented bound: (n + 2) * 2**-24 * sum(w * |x|) for a catchment of n cells
+    ncells = np.diff(op.matrix.indptr)
+    weighted = (abs(op.matrix) @ np.abs(grid.reshape(9, -1)).T).T / op.weight_sum
+    bound = (ncells + 2) * 2.0**-24 * weighted
+    assert np.all(np.abs(out32 - out64) <= bound)
+
+
+def test_weights_cache_roundtrip(tmp_path):
+    weights_df = make_weights_df()
+    weights = WeightsTable.from_dataframe(weights_df)
+    weights.geometry_hash = np.array([f"h{x}" for x in range(len(weights))], dtype=object)
+    weights_file = tmp_path / "VPU_09_weights.json"
+    weights_file.write_text("{}")
+    key = weights_cache_key([weights_file])
+    assert load_weights_operator(tmp_path, key) == (None, None)
+
+    op = WeightsOperator.from_weights_df(weights_df, window)
+    jcatchment_dict = {
+        "VPU_09": list(weights_df.index[:20]),
+        "VPU_01": list(weights_df.index[20:]),
+    }
+    save_weights_operator(tmp_path, key, op, jcatchment_dict, weights)
+
+    cached_op, cached_dict = load_weights_operator(tmp_path, key)
+    assert cached_op.window == window
+    assert cached_op.catchments == op.catchments
+    assert cached_dict == jcatchment_dict
+    data_allvars = np.random.default_rng(2).random((9, dy, dx))
+    np.testing.assert_array_equal(cached_op.apply(data_allvars), op.apply(data_allvars))
+
+    cached = load_cached_weights(tmp_path, key)
+    assert list(cached.catchments) == list(weights.catchments)
+    np.testing.assert_array_equal(cached.indptr, weights.indptr)
+    np.testing.assert_array_equal(cached.cell_id, weights.cell_id)
+    np.testing.assert_array_equal(cached.coverage, weights.coverage)
+    assert list(cached.geometry_hash) == list(weights.geometry_hash)
+
+
+def test_weights_table_matches_lists():
+    weights_df = make_weights_df()
+    weights = WeightsTable.from_dataframe(weights_df)
+    assert list(weights.catchments) == list(weights_df.index)
+    for j, row in enumerate(weights_df.itertuples()):
+        start, end = weights.indptr[j], weights.indptr[j + 1]
+        assert weights.cell_id[start:end].tolist() == row.cell_id
+        assert weights.coverage[start:end].tolist() == row.coverage
+    op = WeightsOperator.from_weights(weights, window)
+    data_allvars = np.random.default_rng(1).random((9, dy, dx))
+    np.testing.assert_array_equal(
+        op.apply(data_allvars),
+        WeightsOperator.from_weights_df(weights_df, window).apply(data_allvars),
+    )
+
+
+def test_weights_table_parquet(tmp_path):
+    weights_df = make_weights_df()
+    weights = WeightsTable.from_dataframe(weights_df)
+    weights.to_parquet(tmp_path / "weights.parquet")
+    read = WeightsTable.read_parquet(tmp_path / "weights.parquet")
+    assert list(read.catchments) == list(weights.catchments)
+    np.testing.assert_array_equal(read.indptr, weights.indptr)
+    np.testing.assert_array_equal(read.cell_id, weights.cell_id)
+    np.testing.assert_array_equal(read.coverage, weights.coverage)
+    assert read.geometry_hash is None
+
+    # pandas still reads the divide_id indexed frame the file used to hold
+    read_df = pd.read_parquet(tmp_path / "weights.parquet")
+    assert read_df.index.name == "divide_id"
+    assert list(read_df.columns) == ["cell_id", "coverage"]
+    cat = weights_df.index[3]
+    assert list(read_df.loc[cat, "cell_id"]) == list(weights_df.loc[cat, "cell_id"])
+    assert list(read_df.loc[cat, "coverage"]) == list(weights_df.loc[cat, "coverage"])
+
+    # parquet of a weights dataframe, as metadata used to hold
+    for index_name in ["divide_id", None]:
+        weights_df.rename_axis(index_name).to_parquet(tmp_path / "weights_df.parquet")
+        read = WeightsTable.read_parquet(tmp_path / "weights_df.parquet")
+        assert list(read.catchments) == list(weights.catchments)
+        np.testing.assert_array_equal(read.cell_id, weights.cell_id)
+        np.testing.assert_array_equal(read.coverage, weights.coverage)
+
+    # long table of the hydrofabric forcing-weights, grouped like groupby
+    long = weights_df.rename_axis("divide_id").explode(["cell_id", "coverage"])
+    long = long.reset_index().rename(
+        columns={"cell_id": "cell", "coverage": "coverage_fraction"}
+    )
+    long = long.sample(frac=1, random_state=0).astype({"cell": float, "coverage_fraction": float})
+    long.to_parquet(tmp_path / "long.parquet", index=False)
+    read = WeightsTable.read_parquet(tmp_path / "long.parquet")
+    grouped = long.groupby("divide_id").agg(list)
+    assert list(read.catchments) == list(grouped.index)
+    assert read.cell_id.tolist() == [int(x) for x in np.concatenate(grouped["cell"].to_list())]
+    np.testing.assert_array_equal(read.coverage, np.concatenate(grouped["coverage_fraction"].to_list()))
+
+
+def test_weights_table_take_concat():
+    weights = WeightsTable.from_dataframe(make_weights_df())
+    rows = [7, 3, 3, 40]
+    taken = weights.take(rows)
+    assert list(taken.catchments) == [weights.catchments[x] for x in rows]
+    for j, jrow in enumerate(rows):
+        np.testing.assert_array_equal(
+            taken.cell_id[taken.indptr[j] : taken.indptr[j + 1]],
+            weights.cell_id[weights.indptr[jrow] : weights.indptr[jrow + 1]],
+        )
+    joined = WeightsTable.concat([weights.take(range(20)), weights.take(range(20, 50))])
+    np.testing.assert_array_equal(joined.indptr, weights.indptr)
+    np.testing.assert_array_equal(joined.cell_id, weights.cell_id)
+    assert list(weights.rows(["cat-3", "cat-x"])) == [3, -1]
+
+
+def test_weights_cache_key_tracks_file_stat(tmp_path, monkeypatch):
+    weights_file = tmp_path / "weights.json"
+    weights_file.write_text('{"cat-1": [[1], [1.0]]}')
+    key = weights_cache_key([weights_file])
+    assert key == weights_cache_key([weights_file])
+    weights_file.write_text('{"cat-1": [[2], [1.0]]}')
+    os.utime(weights_file, ns=(0, 0))
+    assert key != weights_cache_key([weights_file])
+    assert key != weights_cache_key([weights_file], nx=NX + 1)
+
+    # the key comes from the file's metadata, its content is never read
+    monkeypatch.setattr("builtins.open", None)
+    weights_cache_key([weights_file])
+
+
+def test_weights_cache_key_remote(monkeypatch):
+    versions = {"s3://bucket/weights.parquet": '"etag-1"'}
+    monkeypatch.setattr(
+        "forcingprocessor.regrid_tools.remote_version", lambda uri: versions.get(uri)
+    )
+    key = weights_cache_key(["s3://bucket/weights.parquet"])
+    versions["s3://bucket/weights.parquet"] = '"etag-2"'
+    assert key != weights_cache_key(["s3://bucket/weights.parquet"])
+    # no version, no caching
+    assert weights_cache_key(["s3://bucket/other.parquet"]) is None
+
+
+def test_corrupt_weights_cache_is_a_miss(tmp_path):
+    weights_df = make_weights_df()
+    op = WeightsOperator.from_weights_df(weights_df, window)
+    weights = WeightsTable.from_dataframe(weights_df)
+    cache_file = save_weights_operator(
+        tmp_path, "key", op, {"VPU_09": list(weights_df.index)}, weights
+    )
+    content = cache_file.read_bytes()
+    cache_file.write_bytes(content[: len(content) // 2])
+    assert load_weights_operator(tmp_path, "key") == (None, None)
+    assert not cache_file.exists()
+
+
+def test_weights_operator_hash_tracks_operator():
+    weights_op = WeightsOperator.from_weights_df(make_weights_df(), window)
+    key = weights_operator_hash(weights_op, ["U2D", "V2D"])
+    same = WeightsOperator.from_weights_df(make_weights_df(), window)
+    assert key == weights_operator_hash(same, ["U2D", "V2D"])
+    assert key != weights_operator_hash(weights_op, ["U2D"])
+    assert key != weights_operator_hash(weights_op.astype(np.float32), ["U2D", "V2D"])
+    other = WeightsOperator.from_weights_df(make_weights_df(seed=1), window)
+    assert key != weights_operator_hash(other, ["U2D", "V2D"])
+
+
+def test_windowed_operator_matches_hull():
+    weights_op = WeightsOperator.from_weights_df(make_weights_df(), window)
+    rng = np.random.default_rng(2)
+    data_allvars = rng.random((3, dy, dx))
+    expected = weights_op.apply(data_allvars)
+
+    # each part gets the bounding box of its rows' cells, in hull coordinates
+    rows = [np.arange(0, 20), np.arange(20, 50)]
+    windows = []
+    for jrows in rows:
+        cols = weights_op.matrix[jrows].indices
+        x, y = cols % dx + window[0], cols // dx + window[2]
+        windows.append((x.min(), x.max(), y.min(), y.max()))
+    windowed = WindowedOperator.split(weights_op, windows, rows)
+    assert windowed.windows == windows
+    assert len(windowed) == len(weights_op)
+
+    out = np.zeros_like(expected)
+    for (jop, jrows), jwindow in zip(windowed.parts, windows):
+        x_min, x_max, y_min, y_max = jwindow
+        grid = data_allvars[
+            :, y_min - window[2] : y_max - window[2] + 1, x_min - window[0] : x_max - window[0] + 1
+        ]
+        out[:, jrows] = jop.apply(grid)
+    np.testing.assert_array_equal(out, expected)
+    assert windowed.astype(np.float32).dtype == np.float32
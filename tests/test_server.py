@@ -0,0 +1,125 @@
+"""
+Tests of the forcingprocessor service, with a stand in for prep_ngen_data, and
+of the weights and worker pool it keeps resident between real runs.
+"""
+
+import os
+import threading
+import time
+import pytest
+import requests
+from forcingprocessor import processor
+from forcingprocessor.processor import prep_ngen_data
+from forcingprocessor.server import JobQueue, serve
+
+
+def _fake_run(conf):
+    time.sleep(conf["run"].get("sleep", 0))
+    if conf["run"].get("fail"):
+        raise RuntimeError("bad conf")
+
+
+def test_job_queue_runs_in_order_and_times_jobs():
+    jobs = JobQueue(_fake_run)
+    first = jobs.submit({"run": {"sleep": 0.2}})
+    second = jobs.submit({"run": {"fail": True}})
+    jobs.join()
+    first, second = jobs.get(first), jobs.get(second)
+    assert first["status"] == "done"
+    assert first["runtime_s"] >= 0.2
+    assert second["status"] == "failed"
+    assert "bad conf" in second["error"]
+    # the second job waited for the first
+    assert second["queued_s"] >= 0.2
+
+
+def test_job_queue_keeps_the_last_jobs():
+    jobs = JobQueue(_fake_run, max_jobs=2)
+    ids = [jobs.submit({"run": {}}) for _ in range(4)]
+    jobs.join()
+    assert [x["id"] for x in jobs.list()] == ids[2:]
+    assert jobs.get(ids[0]) is None
+
+
+@pytest.fixture
+def server():
+    server = serve("127.0.0.1", 0, _fake_run)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    processor.keep_resident = False
+    processor.pool_start_method = None
+
+
+def test_server_api(server):
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    response = requests.post(f"{url}/jobs", json={"run": {}})
+    assert response.status_code == 202
+    job_id = response.json()["id"]
+    server.jobs.join()
+    assert requests.get(f"{url}/jobs/{job_id}").json()["status"] == "done"
+    assert [x["id"] for x in requests.get(f"{url}/jobs").json()] == [job_id]
+    assert requests.get(f"{url}/jobs/missing").status_code == 404
+    assert requests.post(f"{url}/jobs", data=b"not json").status_code == 400
+    assert requests.get(f"{url}/health").json()["pending"] == 0
+    assert processor.keep_resident
+    assert processor.pool_start_method == "forkserver"
+
+
+def _installed_operator():
+    return type(processor.worker_state["weights_op"]).__name__
+
+
+@pytest.fixture
+def resident(monkeypatch, tmp_path):
+    # prep_ngen_data leaves its profile in the working directory
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(processor, "pool_start_method", "forkserver")
+    processor.keep_resident = True
+    yield
+    processor.shutdown_worker_pool()
+    processor.resident_weights.clear()
+    processor.keep_resident = False
+
+
+def test_resident_runs_reuse_weights_and_pool(synthetic_forcings, tmp_path, resident):
+    def run(name, **run_conf):
+        out = tmp_path / name
+        prep_ngen_data(
+            {
+                "forcing": {
+                    "nwm_file": synthetic_forcings["nwm_file"],
+                    "gpkg_file": synthetic_forcings["weight_files"],
+                },
+                "storage": {
+                    "storage_type": "local",
+                    "output_path": str(out),
+                    "output_file_type": ["csv"],
+                },
+                "run": {"verbose": False, "collect_stats": False, "nprocs": 2, **run_conf},
+            }
+        )
+        pool = processor.worker_pool
+        installed = pool.submit(_installed_operator).result()
+        files = {x: (out / "forcings" / x).read_bytes() for x in os.listdir(out / "forcings")}
+        return pool, installed, files
+
+    # the two VPUs are far apart, so by default each is read through its own window
+    pool, installed, files = run("first")
+    assert installed == "WindowedOperator"
+    assert len(processor.resident_weights) == 1
+
+    again_pool, again_installed, again_files = run("again")
+    assert again_pool is pool
+    assert again_installed == "WindowedOperator"
+    assert len(processor.resident_weights) == 1
+    assert again_files == files
+
+    # same weights, but the workers must be given the single window operator
+    single_pool, single_installed, single_files = run("single", multi_window=False)
+    assert single_pool is not pool
+    assert single_installed == "WeightsOperator"
+    assert len(processor.resident_weights) == 1
+    assert single_files == files
@@ -1,7 +1,184 @@
-from forcingprocessor.utils import normalize_vpu_id
+import os
+import time
+import concurrent.futures as cf
+import numpy as np
+import pytest
+from forcingprocessor.utils import (
+    normalize_vpu_id,
+    variable_plan,
+    ngen_variables,
+    nwm_variables,
+    SharedArray,
+    make_forcing_netcdf,
+    append_forcing_netcdf,
+    schedule_jobs,
+    job_blocks,
+    get_window,
+    get_windows,
+)
+from forcingprocessor.regrid_tools import WeightsTable
 
 
 def test_normalize_vpu_id():
     assert normalize_vpu_id("03W") == "VPU_03W"
     assert normalize_vpu_id("vpu_03w") == "VPU_03W"
-    assert normalize_vpu_id("nextgen_VPU_10L.gpkg") == "VPU_10L"
\ No newline at end of file
+    assert normalize_vpu_id("nextgen_VPU_10L.gpkg") == "VPU_10L"
+
+
+def test_variable_plan_reads_each_source_once():
+    source_vars, source_index, derived = variable_plan(ngen_variables)
+    assert len(source_vars) == len(set(nwm_variables))
+    assert source_vars.count("RAINRATE") == 1
+    assert [source_vars[x] for x in source_index] == nwm_variables
+    assert derived == {}
+
+    source_vars, source_index, _ = variable_plan(["precip_rate", "APCP_surface"])
+    assert source_vars == ["RAINRATE"]
+    assert list(source_index) == [0, 0]
+
+
+def _fill_shared(spec, value):
+    shared = SharedArray.attach(spec)
+    shared.array[1] = value
+    shared.close()
+
+
+@pytest.mark.parametrize("use_file", [False, True])
+def test_shared_array_between_processes(tmp_path, use_file):
+    shared = SharedArray.create((3, 2, 4), np.float64, tmp_path if use_file else None)
+    with cf.ProcessPoolExecutor(max_workers=1) as pool:
+        pool.submit(_fill_shared, shared.spec, 5.0).result()
+    assert np.all(shared.array[1] == 5.0)
+    assert np.all(shared.array[[0, 2]] == 0.0)
+    shared.unlink()
+    if use_file:
+        assert not os.listdir(tmp_path)
+
+
+def _sleep_then_return(delay, value):
+    time.sleep(delay)
+    return value
+
+
+def test_schedule_jobs_keeps_job_order():
+    # the first job is the slowest, the others finish before it on the other worker
+    jobs = [(0.5, 0)] + [(0.01, x) for x in range(1, 8)]
+    assert schedule_jobs(_sleep_then_return, jobs, 2) == list(range(8))
+    assert schedule_jobs(_sleep_then_return, [], 2) == []
+
+
+def test_schedule_jobs_on_given_pool():
+    with cf.ProcessPoolExecutor(max_workers=2) as pool:
+        jobs = [(0.01, x) for x in range(4)]
+        assert schedule_jobs(_sleep_then_return, jobs, 2, pool=pool) == list(range(4))
+        # the pool is left running for the next stage
+        assert schedule_jobs(_sleep_then_return, jobs, 2, pool=pool) == list(range(4))
+
+
+@pytest.mark.parametrize("shared_pool", [False, True])
+def test_schedule_jobs_cancels_queued_jobs_on_failure(shared_pool):
+    # a negative sleep raises, the 20 queued jobs would take 2 s on 2 workers
+    jobs = [(-1, 0)] + [(0.2, x) for x in range(20)]
+    with cf.ProcessPoolExecutor(max_workers=2) as pool:
+        t0 = time.perf_counter()
+        with pytest.raises(ValueError):
+            schedule_jobs(_sleep_then_return, jobs, 2, pool=pool if shared_pool else None)
+        # the next stage on the pool does not wait behind the failed one's jobs
+        assert schedule_jobs(_sleep_then_return, [(0, 1)], 2, pool=pool) == [1]
+        assert time.perf_counter() - t0 < 1.5
+
+
+def test_schedule_jobs_reports_progress():
+    done = []
+    jobs = [(0.01, x) for x in range(6)]
+    assert schedule_jobs(_sleep_then_return, jobs, 2, progress=done.append) == list(range(6))
+    # called once per job in the calling process, in the order they finished
+    assert sorted(done) == list(range(6))
+
+
+def test_job_blocks():
+    assert job_blocks(7, 3) == [(0, 3), (3, 6), (6, 7)]
+    assert job_blocks(0, 3) == []
+    assert job_blocks(2, 0) == [(0, 1), (1, 2)]
+
+
+def test_append_forcing_netcdf_matches_single_write(tmp_path):
+    import netCDF4 as nc
+
+    rng = np.random.default_rng(0)
+    catchments = np.array([f"cat-{x}" for x in range(5)])
+    t_ax = np.arange(7, dtype=np.float64) * 3600
+    data = rng.random((5, 7, len(ngen_variables)))
+
+    make_forcing_netcdf(tmp_path / "single.nc", catchments, t_ax, data)
+    make_forcing_netcdf(
+        tmp_path / "stream.nc", catchments, t_ax[:3], data[:, :3], unlimited=True
+    )
+    append_forcing_netcdf(tmp_path / "stream.nc", t_ax[3:4], data[:, 3:4])
+    append_forcing_netcdf(tmp_path / "stream.nc", t_ax[4:], data[:, 4:])
+
+    with nc.Dataset(tmp_path / "single.nc") as a, nc.Dataset(tmp_path / "stream.nc") as b:
+        assert b.dimensions["time"].isunlimited()
+        assert list(a["ids"][:]) == list(b["ids"][:])
+        for var in ["Time"] + ngen_variables:
+            np.testing.assert_array_equal(a[var][:], b[var][:])
+
+
+def test_make_forcing_netcdf_float32(tmp_path):
+    import netCDF4 as nc
+
+    catchments = np.array([f"cat-{x}" for x in range(3)])
+    t_ax = np.arange(2, dtype=np.float64) * 3600
+    data = np.random.default_rng(0).random((3, 2, len(ngen_variables)), dtype=np.float32)
+
+    make_forcing_netcdf(tmp_path / "f4.nc", catchments, t_ax, data)
+
+    with nc.Dataset(tmp_path / "f4.nc") as ds:
+        # the time axis keeps full precision
+        assert ds["Time"].dtype == np.float64
+        for i, var in enumerate(ngen_variables):
+            assert ds[var].dtype == np.float32
+            np.testing.assert_array_equal(ds[var][:], data[:, :, i])
+
+
+def _box_weights(boxes, nx=4608, seed=0):
+    """weights with 20 catchments of random cells inside each x_min, x_max, y_min, y_max box"""
+    rng = np.random.default_rng(seed)
+    cell_ids = []
+    for x_min, x_max, y_min, y_max in boxes:
+        for _ in range(20):
+            x = rng.integers(x_min, x_max + 1, size=5)
+            y = rng.integers(y_min, y_max + 1, size=5)
+            cell_ids.append((x + nx * y).tolist())
+    index = [f"cat-{x}" for x in range(len(cell_ids))]
+    weights = WeightsTable.from_lists(index, cell_ids, [[1.0] * 5 for _ in cell_ids])
+    jcatchment_dict = {
+        f"VPU_{j:02d}": index[20 * j : 20 * (j + 1)] for j in range(len(boxes))
+    }
+    return weights, jcatchment_dict
+
+
+def test_get_window_matches_per_row_bounds():
+    weights, _ = _box_weights([(100, 200, 300, 400), (150, 900, 50, 120)])
+    cell_ids = np.split(weights.cell_id, weights.indptr[1:-1])
+    x = [c % 4608 for c in cell_ids]
+    y = [c // 4608 for c in cell_ids]
+    assert get_window(weights) == (
+        min(a.min() for a in x),
+        max(a.max() for a in x),
+        min(a.min() for a in y),
+        max(a.max() for a in y),
+    )
+
+
+def test_get_windows_splits_distant_groups():
+    boxes = [(4000, 4100, 3000, 3100), (100, 200, 3200, 3300), (150, 260, 3150, 3280)]
+    weights, jcatchment_dict = _box_weights(boxes)
+    windows, members = get_windows(weights, jcatchment_dict)
+    assert len(windows) == 2
+    assert members == [["VPU_00"], ["VPU_01", "VPU_02"]]
+    assert windows[0] == get_window(weights.take(range(20)))
+    assert windows[1] == get_window(weights.take(range(20, len(weights))))
+    # a window over everything once the fill requirement is dropped
+    windows, members = get_windows(weights, jcatchment_dict, min_fill=0)
+    assert windows == [get_window(weights)]
@@ -0,0 +1,199 @@
+"""
+Unit tests for forcing file encoding tools.
+"""
+
+import gzip
+import tarfile
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from forcingprocessor.utils import ngen_variables
+from forcingprocessor.write_tools import (
+    ForcingCSVEncoder,
+    S3MultipartWriter,
+    ParallelGzipWriter,
+    open_compressed,
+    compress_bytes,
+    compressed_size,
+)
+
+# ---------------------------------------------------------------------------
+# unit tests
+# ---------------------------------------------------------------------------
+
+
+def _pandas_csv(data, t_ax, j):
+    df = pd.DataFrame(data[:, :, j], columns=ngen_variables)
+    df.insert(0, "time", t_ax)
+    buf = BytesIO()
+    df.to_csv(buf, index=False)
+    return buf.getvalue()
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+def test_csv_encoder_matches_pandas(dtype):
+    rng = np.random.default_rng(0)
+    nt, nvar, ncatch = 6, len(ngen_variables), 40
+    data = rng.random((nt, nvar, ncatch)) * 10.0 ** rng.integers(-20, 20, (nt, nvar, ncatch))
+    data[0, 0, 0] = np.nan
+    data[1, 2, 3] = -0.0
+    data[2, 1, 4] = 1e16
+    data[3, 3, 5] = 1e-5
+    data[4, 4, 6] = np.inf
+    data = data.astype(dtype)
+    t_ax = [f"2024-01-01 {x:02d}:00:00" for x in range(nt)]
+
+    encoded = list(ForcingCSVEncoder(t_ax, ngen_variables).encode(data))
+    assert len(encoded) == ncatch
+    for j in range(ncatch):
+        assert encoded[j] == _pandas_csv(data, t_ax, j)
+
+
+def test_csv_encoder_blocks(monkeypatch):
+    import forcingprocessor.write_tools as write_tools
+
+    monkeypatch.setattr(write_tools, "CSV_BLOCK_CELLS", 1)
+    data = np.arange(3 * len(ngen_variables) * 5, dtype=np.float64).reshape(
+        3, len(ngen_variables), 5
+    )
+    t_ax = ["2024-01-01 00:00:00", "2024-01-01 01:00:00", "2024-01-01 02:00:00"]
+    encoder = ForcingCSVEncoder(t_ax, ngen_variables)
+    encoded = list(encoder.encode(data))
+    for j in range(5):
+        assert encoded[j] == _pandas_csv(data, t_ax, j)
+
+    # rows appended by a later time window continue the file exactly
+    first = ForcingCSVEncoder(t_ax[:2], ngen_variables)
+    rest = ForcingCSVEncoder(t_ax[2:], ngen_variables, header=False)
+    for j, (a, b) in enumerate(zip(first.encode(data[:2]), rest.encode(data[2:]))):
+        assert a + b == encoded[j]
+
+
+class FakeS3:
+    """Records what S3MultipartWriter sends"""
+
+    def __init__(self):
+        self.objects = {}
+        self.parts = {}
+        self.aborted = []
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = Body
+
+    def create_multipart_upload(self, Bucket, Key):
+        self.parts[Key] = []
+        return {"UploadId": Key}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        assert PartNumber == len(self.parts[Key]) + 1
+        self.parts[Key].append(Body)
+        return {"ETag": str(PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        assert len(MultipartUpload["Parts"]) == len(self.parts[Key])
+        self.objects[Key] = b"".join(self.parts[Key])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted.append(Key)
+
+
+def test_s3_multipart_writer_streams_tar(monkeypatch):
+    import forcingprocessor.write_tools as write_tools
+
+    monkeypatch.setattr(write_tools, "S3_MIN_PART_SIZE", 1024)
+    rng = np.random.default_rng(0)
+    members = {f"cat-{x}.csv": rng.bytes(3000) for x in range(20)}
+    client = FakeS3()
+    with S3MultipartWriter(client, "bucket", "a.tar.gz", part_size=1024) as out:
+        with tarfile.open(fileobj=out, mode="w|gz") as jtar:
+            for name, body in members.items():
+                info = tarfile.TarInfo(name=name)
+                info.size = len(body)
+                jtar.addfile(info, BytesIO(body))
+
+    parts = client.parts["a.tar.gz"]
+    assert len(parts) > 1
+    assert all(len(x) == 1024 for x in parts[:-1])
+    with tarfile.open(fileobj=BytesIO(client.objects["a.tar.gz"])) as jtar:
+        assert {x.name: jtar.extractfile(x).read() for x in jtar} == members
+
+
+def test_s3_multipart_writer_small_and_abort():
+    client = FakeS3()
+    with S3MultipartWriter(client, "bucket", "small", part_size=1) as out:
+        out.write(b"abc")
+    assert client.objects["small"] == b"abc"
+    assert "small" not in client.parts
+
+    with pytest.raises(RuntimeError):
+        with S3MultipartWriter(client, "bucket", "big", part_size=1) as out:
+            out.write(b"x" * (6 * 1048576))
+            raise RuntimeError
+    assert client.aborted == ["big"]
+    assert "big" not in client.objects
+
+
+def test_parallel_gzip_writes_standard_gzip():
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 10, 100_000, dtype=np.uint8).tobytes()
+    buf = BytesIO()
+    writer = ParallelGzipWriter(buf, level=6, threads=3, block_size=4096)
+    for i in range(0, len(data), 1000):
+        writer.write(data[i : i + 1000])
+    writer.close()
+    assert gzip.decompress(buf.getvalue()) == data
+
+    # an empty stream is still a valid gzip file
+    buf = BytesIO()
+    ParallelGzipWriter(buf, threads=2).close()
+    assert gzip.decompress(buf.getvalue()) == b""
+
+
+def test_parallel_gzip_shuts_down_on_error():
+    buf = BytesIO()
+    with pytest.raises(RuntimeError):
+        with ParallelGzipWriter(buf, threads=2, block_size=16) as writer:
+            writer.write(b"x" * 100)
+            raise RuntimeError("write failed")
+    assert writer.closed
+    assert writer._pool._shutdown
+
+
+@pytest.mark.parametrize("threads", [1, 4])
+def test_compressed_tar_roundtrip(threads):
+    members = {f"cat-{x}.csv": f"time,x\n{x}\n".encode() * 500 for x in range(30)}
+    buf = BytesIO()
+    compressed = open_compressed(buf, "gzip", 6, threads)
+    with tarfile.open(fileobj=compressed, mode="w|") as jtar:
+        for name, body in members.items():
+            info = tarfile.TarInfo(name=name)
+            info.size = len(body)
+            jtar.addfile(info, BytesIO(body))
+    compressed.close()
+    buf.seek(0)
+    with tarfile.open(fileobj=buf, mode="r:gz") as jtar:
+        assert {x.name: jtar.extractfile(x).read() for x in jtar} == members
+
+
+def test_zstd_compression():
+    zstandard = pytest.importorskip("zstandard")
+    data = b"time,x\n" * 10000
+    for threads in [1, 2]:
+        out = compress_bytes(data, "zstd", 3, threads)
+        assert zstandard.ZstdDecompressor().decompressobj().decompress(out) == data
+
+
+def test_compressed_size():
+    data = b"time,x\n" + b"".join(b"%d,%f\n" % (x, x / 7) for x in range(10000))
+    for threads in [1, 2]:
+        assert compressed_size(data, "gzip", 9, threads) == len(
+            compress_bytes(data, "gzip", 9, threads)
+        )
+
+
+def test_unknown_compression():
+    with pytest.raises(ValueError):
+        open_compressed(BytesIO(), "lzma")